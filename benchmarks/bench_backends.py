@@ -0,0 +1,89 @@
+"""
+Benchmark of the embedded SQLite backend against PostgreSQL
+
+Sends the read heavy mix of the service (single promotions, filtered lists
+and best promotion lookups, plus one PATCH every WRITE_EVERY requests)
+through the Flask test client and prints the requests per second of every
+kind of request on each database.
+
+  python -m benchmarks.bench_backends [URI ...]
+
+Without arguments DATABASE_URI is compared with a temporary SQLite file.
+The tables of every database are dropped and seeded, use scratch databases.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from service import app
+from service.models import db
+from benchmarks.common import DATABASE_URI, PROMOTIONS, setup, seed, teardown
+
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "2000"))
+WRITE_EVERY = 20
+
+
+def workload(promotion_ids, rng):
+    """ Returns the (kind, method, url, body) requests to send """
+    requests = []
+    for i in range(REQUESTS):
+        promotion_id = rng.choice(promotion_ids)
+        if i % WRITE_EVERY == WRITE_EVERY - 1:
+            requests.append(
+                ("patch", "PATCH", "/promotions/%d" % promotion_id, {"amount": rng.randint(1, 50)})
+            )
+            continue
+        kind = rng.choice(["get", "list", "apply"])
+        if kind == "get":
+            url = "/promotions/%d" % promotion_id
+        elif kind == "list":
+            url = "/promotions?product=%d" % rng.randrange(PROMOTIONS)
+        else:
+            url = "/promotions/apply?%d=%d" % (rng.randrange(PROMOTIONS), rng.randint(1, 200))
+        requests.append((kind, "GET", url, None))
+    return requests
+
+
+def run(uri):
+    """ Returns {kind: requests per second} for the database at uri """
+    setup(uri)
+    promotion_ids = seed()
+    client = app.test_client()
+    elapsed, counts = {}, {}
+    for kind, method, url, body in workload(promotion_ids, random.Random(42)):
+        start = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        elapsed[kind] = elapsed.get(kind, 0) + time.perf_counter() - start
+        counts[kind] = counts.get(kind, 0) + 1
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s returned %d" % (method, url, response.status_code))
+    teardown()
+    db.get_engine().dispose()
+    total = sum(counts.values()) / sum(elapsed.values())
+    return dict({kind: counts[kind] / elapsed[kind] for kind in counts}, total=total)
+
+
+def main():
+    """ Prints the requests per second of every database """
+    uris = sys.argv[1:]
+    directory = None
+    if not uris:
+        directory = tempfile.mkdtemp()
+        uris = [DATABASE_URI, "sqlite:///" + os.path.join(directory, "promotions.db")]
+    try:
+        print("%d promotions, %d requests, requests/second" % (PROMOTIONS, REQUESTS))
+        kinds = ["get", "list", "apply", "patch", "total"]
+        print("%-12s" % "database" + "".join("%10s" % kind for kind in kinds))
+        for uri in uris:
+            results = run(uri)
+            name = uri.split(":", 1)[0]
+            print("%-12s" % name + "".join("%10.0f" % results[kind] for kind in kinds))
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
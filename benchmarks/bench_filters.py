@@ -0,0 +1,98 @@
+"""
+Benchmark of the compiled search plans
+
+Runs the same searches through the query built and compiled for every
+request (filter_by_args(), as find_by_query_string() used to) and through
+the compiled plan of their arguments (find_by_query_string()), and prints
+the CPU time of this process per search. The queries themselves run in
+the database server and are not counted.
+
+  python -m benchmarks.bench_filters
+
+Also compares dateutil with parse_date() on the ISO 8601 dates clients send.
+"""
+import os
+import time
+import random
+import dateutil.parser
+from sqlalchemy.orm import selectinload
+from service.models import Promotion, db, compile_args, parse_date
+from benchmarks.common import PROMOTIONS, setup, seed, teardown
+
+SEARCHES = int(os.getenv("BENCH_SEARCHES", "1000"))
+
+
+def searches(rng):
+    """ Returns {kind: the query string arguments of the searches to run} """
+    kinds = {
+        "product": lambda: {"product": str(rng.randrange(PROMOTIONS))},
+        "title": lambda: {"title": "promo %05d" % rng.randrange(PROMOTIONS), "is_site_wide": False},
+        "ranges": lambda: {
+            "promo_type": "DISCOUNT,FIXED",
+            "amount_min": rng.randint(1, 50),
+            "end_after": "2029-12-%02dT00:00:00" % rng.randint(1, 28),
+            "end_before": "2030-01-02T00:00:00",
+            "active": "1",
+            "per_page": 20,
+        },
+        "text": lambda: {"q": "promo %05d" % rng.randrange(PROMOTIONS), "per_page": 20, "page": 1},
+    }
+    return {kind: [make() for _ in range(SEARCHES)] for kind, make in kinds.items()}
+
+
+def rebuilt(args):
+    """ The search as it ran before the plans, built and compiled every time """
+    if args.get("per_page"):
+        plan, _ = compile_args(args)
+        return (
+            Promotion.filter_by_args(args)
+            .options(selectinload(Promotion.products))
+            .order_by(*Promotion._order(plan))  # pylint: disable=protected-access
+            .offset((args.get("page", 1) - 1) * args["per_page"])
+            .limit(args["per_page"])
+            .all()
+        )
+    return (
+        Promotion.filter_by_args(args)
+        .options(selectinload(Promotion.products))
+        .order_by(Promotion.title, Promotion.id)
+        .all()
+    )
+
+
+def cpu_per_call(function, calls):
+    """ Returns the CPU microseconds of this process per call """
+    start = time.process_time()
+    for args in calls:
+        function(args)
+    return (time.process_time() - start) / len(calls) * 1e6
+
+
+def main():
+    """ Prints the CPU time per search of both ways """
+    setup()
+    seed()
+    print("%d promotions, %d searches of each kind, CPU microseconds per search" % (
+        PROMOTIONS, SEARCHES))
+    print("%-12s%10s%10s%10s" % ("kind", "rebuilt", "planned", "saved"))
+    for kind, calls in searches(random.Random(42)).items():
+        for args in calls[:50]:  # warm up the connections and the plan
+            found = len(Promotion.find_by_query_string(args))
+            # every search matches, an empty one would time nothing
+            assert found, "no promotion matches %s" % args
+            assert len(rebuilt(args)) == found
+        db.session.remove()
+        rebuilt_cpu = cpu_per_call(rebuilt, calls)
+        planned_cpu = cpu_per_call(Promotion.find_by_query_string, calls)
+        print("%-12s%10.0f%10.0f%9.0f%%" % (
+            kind, rebuilt_cpu, planned_cpu, 100 - planned_cpu * 100 / rebuilt_cpu))
+    teardown()
+
+    dates = ["2020-10-%02dT%02d:30:00" % (day, day % 24) for day in range(1, 29)] * 1000
+    print("%d ISO dates, microseconds per date" % len(dates))
+    print("%-20s%10.2f" % ("dateutil", cpu_per_call(dateutil.parser.parse, dates)))
+    print("%-20s%10.2f" % ("parse_date", cpu_per_call(parse_date, dates)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the Promotion.products loading strategies
+
+Compares the old global lazy="subquery" relationship with the strategy
+each call site now asks for, counting the statements sent to the database
+and the bytes of the rows they return (measured with pg_column_size, so
+this needs PostgreSQL).
+
+The tables of DATABASE_URI are dropped and seeded, point it at a scratch
+database:
+
+  DATABASE_URI=postgres://... python -m benchmarks.bench_loading
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import subqueryload
+from service.models import Promotion, db
+from benchmarks.common import PROMOTIONS, PRODUCTS_PER_PROMOTION, setup, seed, teardown
+
+
+def measure(function):
+    """ Runs function with an empty session, returns (statements, bytes) """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    db.session.expunge_all()
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        function()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    db.session.rollback()
+    size = 0
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for statement, parameters in statements:
+            if statement.lstrip().upper().startswith("SELECT"):
+                cursor.execute(
+                    "SELECT coalesce(sum(pg_column_size(t.*)), 0) FROM ({}) AS t".format(
+                        statement
+                    ),
+                    parameters,
+                )
+                size += cursor.fetchone()[0]
+    finally:
+        connection.close()
+    return len(statements), size
+
+
+def serialize_one(loader, promotion_id):
+    """ Loads and serializes a single promotion, as GET /promotions/<id> """
+    return lambda: Promotion.query.options(loader).get(promotion_id).serialize()
+
+
+def main():
+    """ Prints statements and bytes per call site, before and after """
+    setup()
+    promotion_id = seed()[PROMOTIONS // 2]
+    old = subqueryload(Promotion.products)
+    call_sites = [
+        (
+            "list + serialize",
+            lambda: [
+                p.serialize() for p in Promotion.query.options(old).order_by(Promotion.title)
+            ],
+            lambda: [p.serialize() for p in Promotion.find_by_query_string({})],
+        ),
+        (
+            "get + serialize",
+            serialize_one(old, promotion_id),
+            lambda: Promotion.find(promotion_id).serialize(),
+        ),
+        (
+            "lookup for delete",
+            lambda: Promotion.query.options(old).get(promotion_id),
+            lambda: Promotion.find(promotion_id, products="noload"),
+        ),
+        (
+            "lookup for patch",
+            lambda: Promotion.query.options(old).get(promotion_id),
+            lambda: Promotion.find(promotion_id, products="lazy"),
+        ),
+    ]
+    print(
+        "%d promotions x %d products" % (PROMOTIONS, PRODUCTS_PER_PROMOTION)
+    )
+    print("%-20s %18s %18s" % ("call site", "subquery", "per call site"))
+    for name, before, after in call_sites:
+        print(
+            "%-20s %5d q %9d B %5d q %9d B"
+            % ((name,) + measure(before) + measure(after))
+        )
+    teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of the promotion read model used by apply_best_promo
+
+Compares evaluating full Promotion instances, loaded with their products
+and tracked by the session, with the ActivePromotion read model the
+evaluation paths use: memory per promotion (measured with tracemalloc)
+and time per evaluated candidate.
+
+The tables of DATABASE_URI are dropped and seeded, point it at a scratch
+database:
+
+  DATABASE_URI=postgres://... python -m benchmarks.bench_read_model
+"""
+import timeit
+import tracemalloc
+from datetime import datetime
+from sqlalchemy.orm import selectinload
+from service.models import Promotion, db, scheduler, select_best_promo
+from benchmarks.common import PROMOTIONS, PRODUCTS_PER_PROMOTION, setup, seed, teardown
+
+REPEAT = 200
+
+
+def load_instances():
+    """ Loads the promotions the way the evaluation used to """
+    return Promotion.query.options(selectinload(Promotion.products)).all()
+
+
+def load_read_models():
+    """ Loads the promotions the way the evaluation does now """
+    return list(scheduler.snapshot(datetime.now()).promotions.values())
+
+
+def measure(loader):
+    """ Returns (bytes per promotion, microseconds per evaluated candidate) """
+    db.session.expunge_all()
+    scheduler.invalidate()
+    tracemalloc.start()
+    promotions = loader()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    seconds = min(
+        timeit.repeat(
+            lambda: [select_best_promo(promotions, price) for price in (10, 100)],
+            number=REPEAT // 10,
+            repeat=10,
+        )
+    ) / (REPEAT // 10)
+    return size / len(promotions), seconds * 1e6 / (2 * len(promotions))
+
+
+def main():
+    """ Prints memory and evaluation time per promotion, before and after """
+    setup()
+    seed()
+    print("%d promotions x %d products" % (PROMOTIONS, PRODUCTS_PER_PROMOTION))
+    print("%-20s %14s %18s" % ("model", "bytes/promo", "us/candidate"))
+    for name, loader in [
+        ("Promotion + ORM", load_instances),
+        ("ActivePromotion", load_read_models),
+    ]:
+        print("%-20s %14.0f %18.3f" % ((name,) + measure(loader)))
+    teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,9 +14,73 @@ if 'VCAP_SERVICES' in os.environ:
     vcap = json.loads(os.environ['VCAP_SERVICES'])
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 
+# Tuning of the connections when DATABASE_URI is a SQLite file, see
+# service/sqlite.py, unset values keep its defaults
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS")
+SQLITE_MMAP_SIZE = os.getenv("SQLITE_MMAP_SIZE")
+SQLITE_CACHE_SIZE = os.getenv("SQLITE_CACHE_SIZE")
+SQLITE_BUSY_TIMEOUT = os.getenv("SQLITE_BUSY_TIMEOUT")
+
+# Optional read replicas for the GET endpoints, as a comma separated list
+READ_REPLICA_URIS = [uri for uri in os.getenv("READ_REPLICA_URIS", "").split(",") if uri]
+
+# Reads stick to the primary this many seconds after a client's own write
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
+SQLALCHEMY_BINDS = {
+    "replica_{}".format(i): uri for i, uri in enumerate(READ_REPLICA_URIS)
+}
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Logging, see service/log.py: the level of the app logger, json or text,
+# and how many records may wait for the background thread
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Identical concurrent reads wait at most this many seconds for the one in
+# flight, see service/singleflight.py
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "10"))
+
+# Promotions listed per page of a text search (q=) without per_page, and
+# at most per page of any list
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Cache of read results shared by the workers, see service/cache.py. Every
+# worker keeps the last CACHE_L1_SIZE results in memory, in front of an
+# optional shared cache: redis://host:6379/0 or sqlite:////path/cache.db.
+# Without CACHE_URL the workers only cache for themselves.
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_L1_SIZE = int(os.getenv("CACHE_L1_SIZE", "10000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))
+# After a failure the shared cache is left alone this many seconds, the
+# reads go to the database meanwhile instead of waiting for its timeout
+CACHE_RETRY_AFTER = float(os.getenv("CACHE_RETRY_AFTER", "5"))
+
+# Products whose best promotion per price band is memoized by each worker
+BEST_PROMO_MEMO_SIZE = int(os.getenv("BEST_PROMO_MEMO_SIZE", "10000"))
+
+# Promotions that ended more than this many days ago are moved to the archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+
+# Change feed: entries older than this are compacted, see PromotionChange
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", "7"))
+CHANGES_MAX_BATCH = int(os.getenv("CHANGES_MAX_BATCH", "1000"))
+# Long polls wait at most this many seconds and look for changes made by
+# other processes every CHANGES_POLL_INTERVAL seconds
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", "25"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+# Each long poll holds a worker thread (8 per worker, see the Procfile), at
+# most this many wait at once and the others are answered at once
+CHANGES_MAX_WAITERS = int(os.getenv("CHANGES_MAX_WAITERS", "4"))
+
+# Memory-mapped snapshot of the promotions shared by the workers of a host,
+# e.g. /dev/shm/promotions.snapshot, empty to let every worker load its own
+SHARED_SNAPSHOT_PATH = os.getenv("SHARED_SNAPSHOT_PATH", "")
+
 # Secret for session management
 # SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
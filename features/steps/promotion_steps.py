@@ -20,13 +20,10 @@ def step_impl(context):
     """ Delete all promotions and load new ones """
     headers = {"Content-Type": "application/json"}
     # Deleting the existing promotions
-    context.resp = requests.get(context.base_url + "/promotions", headers=headers)
+    context.resp = requests.delete(
+        context.base_url + "/promotions", params={"all": "true"}, headers=headers
+    )
     expect(context.resp.status_code).to_equal(200)
-    for promo in context.resp.json():    
-        context.resp = requests.delete(
-            context.base_url + "/promotions/" + str(promo["id"]), headers=headers
-        )
-        expect(context.resp.status_code).to_equal(204)
 
     # load the new promotions as per the Background
     create_url = context.base_url + "/promotions"
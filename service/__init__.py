@@ -15,10 +15,10 @@ app.config.from_object("config")
 
 # pylint: disable=wrong-import-position
 # Import the routes After the Flask app is created
-from service import service, models
+from service import service, models, commands, log
 
-# pylint: disable=fixme
-# Set up logging for production #TODO
+# Log from a background thread, see service/log.py
+log.init_logging(app)
 
 app.logger.info(70 * "*")
 app.logger.info("  P R O M O   S E R V I C E   R U N N I N G  ".center(70, "*"))
@@ -0,0 +1,514 @@
+"""
+Shared Cache
+
+Read results are cached in two tiers: a small LRU in every worker (L1) in
+front of a cache shared by all the workers (L2), either a SQLite file for
+the workers of one host or a Redis protocol server for every node.
+
+Entries are never deleted when the data changes. Their keys carry version
+stamps kept in L2 instead, e.g. promotion:7@3 for version 3 of the stamp
+of promotion 7. A write increments the stamps it affects, one INCR, and
+from then on every worker builds new keys; the old entries are simply not
+asked for anymore and age out. Reading the stamps costs one round trip to
+L2 per read, the entries themselves mostly come from L1.
+
+A failing L2 never fails a request: its errors are logged and the read
+goes to the database as if nothing was cached. After a failure L2 is left
+alone for a few seconds, so that the requests don't each wait for its
+timeout while it is down.
+
+Values are stored as JSON, they must be plain dicts, lists, strings and
+numbers.
+"""
+import json
+import time
+import socket
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+logger = logging.getLogger(__name__)
+
+
+class CacheError(Exception):
+    """ Used when a cache backend can't be reached or refused a command """
+
+
+class Cache:
+    """ Interface of the cache backends """
+
+    def get_many(self, keys):
+        """ Returns the values of keys as a list, None for the missing ones """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """ Stores value under key for ttl seconds, None keeps it until evicted """
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """ Stores value under key unless the key exists, returns True if it did """
+        raise NotImplementedError
+
+    def incr(self, key):
+        """ Increments the integer under key, a missing key counts as 0 """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Drops every entry """
+        raise NotImplementedError
+
+    def get(self, key):
+        """ Returns the value of key, None if it is missing """
+        return self.get_many([key])[0]
+
+
+######################################################################
+#  L 1 :   I N - P R O C E S S   L R U
+######################################################################
+class LRUCache(Cache):
+    """ Bounded in-process cache that evicts the least recently used entry """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires at)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or (entry[1] is not None and entry[1] <= now):
+                    values.append(None)
+                    continue
+                self._entries.move_to_end(key)
+                values.append(entry[0])
+        return values
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                return False
+            self._entries[key] = (value, None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def incr(self, key):
+        with self._lock:
+            value = (self._entries.get(key) or (0, None))[0] + 1
+            self._entries[key] = (value, None)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+######################################################################
+#  L 2 :   S Q L I T E   F I L E   S H A R E D   B Y   A   H O S T
+######################################################################
+class SQLiteCache(Cache):
+    """ Cache in a SQLite file shared by the worker processes of a host """
+
+    # expired entries are purged every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entry "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connection(self, write=True):
+        """ Returns a transaction on the connection of the current thread """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+                connection.execute("PRAGMA journal_mode = WAL")
+                connection.execute("PRAGMA synchronous = OFF")  # it's only a cache
+            except sqlite3.Error as error:
+                raise CacheError(str(error))
+            self._local.connection = connection
+        return _Transaction(connection, "BEGIN IMMEDIATE" if write else "BEGIN")
+
+    def get_many(self, keys):
+        keys = list(keys)
+        with self._connection(write=False) as connection:
+            rows = dict(
+                connection.execute(
+                    "SELECT key, value FROM cache_entry WHERE key IN ({}) "
+                    "AND (expires_at IS NULL OR expires_at > ?)".format(",".join("?" * len(keys))),
+                    keys + [time.time()],
+                )
+            )
+        return [json.loads(rows[key]) if key in rows else None for key in keys]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                connection.execute(
+                    "DELETE FROM cache_entry WHERE expires_at <= ?", (time.time(),)
+                )
+
+    def add(self, key, value):
+        with self._connection() as connection:
+            return connection.execute(
+                "INSERT OR IGNORE INTO cache_entry VALUES (?, ?, NULL)", (key, json.dumps(value))
+            ).rowcount == 1
+
+    def incr(self, key):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO cache_entry VALUES (?, '1', NULL) ON CONFLICT (key) "
+                "DO UPDATE SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT)",
+                (key,),
+            )
+            (value,) = connection.execute(
+                "SELECT value FROM cache_entry WHERE key = ?", (key,)
+            ).fetchone()
+        return int(value)
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache_entry")
+
+
+class _Transaction:
+    """ Runs the statements of a with block in one transaction """
+
+    def __init__(self, connection, begin):
+        self.connection = connection
+        self.begin = begin
+
+    def __enter__(self):
+        try:
+            self.connection.execute(self.begin)
+        except sqlite3.Error as error:
+            raise CacheError(str(error))
+        return self.connection
+
+    def __exit__(self, error_type, error, traceback):
+        try:
+            self.connection.execute("COMMIT" if error_type is None else "ROLLBACK")
+        except sqlite3.Error as end_error:
+            raise CacheError(str(end_error))
+        if isinstance(error, sqlite3.Error):
+            raise CacheError(str(error))
+
+
+######################################################################
+#  L 2 :   R E D I S   P R O T O C O L   S E R V E R
+######################################################################
+class RedisCache(Cache):
+    """
+    Cache in a server that speaks the Redis protocol (RESP)
+
+    Only needs MGET, SET, INCR and FLUSHDB, so any compatible server
+    works. Every thread keeps its own connection.
+    """
+
+    def __init__(self, url, timeout=1.0):
+        """
+        Args:
+            url (str): redis://[:password@]host[:port][/db]
+            timeout (float): seconds to wait for the server
+        """
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get_many(self, keys):
+        values = self.execute("MGET", *keys)
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.execute("SET", key, json.dumps(value), "PX", int(ttl * 1000))
+        else:
+            self.execute("SET", key, json.dumps(value))
+
+    def add(self, key, value):
+        return self.execute("SET", key, json.dumps(value), "NX") is not None
+
+    def incr(self, key):
+        return self.execute("INCR", key)
+
+    def clear(self):
+        self.execute("FLUSHDB")
+
+    def execute(self, *command):
+        """ Sends a command and returns its reply, reconnecting once if needed """
+        for attempt in (1, 2):
+            connection, reader = self._connection()
+            try:
+                connection.sendall(encode_command(command))
+                return read_reply(reader)
+            except (OSError, EOFError) as error:
+                self._disconnect()
+                if attempt == 2:
+                    raise CacheError("Redis at %s:%d: %s" % (self.address + (error,)))
+        return None  # not reached
+
+    def _connection(self):
+        """ Returns the (socket, reader) of the current thread """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except OSError as error:
+            raise CacheError("Redis at %s:%d: %s" % (self.address + (error,)))
+        connection = self._local.connection = (sock, sock.makefile("rb"))
+        try:
+            if self.password:
+                self.execute("AUTH", self.password)
+            if self.database:
+                self.execute("SELECT", self.database)
+        except CacheError:
+            self._disconnect()
+            raise
+        return connection
+
+    def _disconnect(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+
+def encode_command(command):
+    """ Encodes a command as a RESP array of bulk strings """
+    parts = [b"*%d\r\n" % len(command)]
+    for argument in command:
+        if not isinstance(argument, bytes):
+            argument = str(argument).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(argument), argument))
+    return b"".join(parts)
+
+
+def read_reply(stream):
+    """ Reads one RESP reply, bulk strings are decoded from utf-8 """
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise EOFError("connection closed")
+    kind, data = line[:1], line[1:-2]
+    if kind == b"+":
+        return data.decode("utf-8")
+    if kind == b"-":
+        raise CacheError(data.decode("utf-8"))
+    if kind == b":":
+        return int(data)
+    if kind == b"$":
+        length = int(data)
+        if length < 0:
+            return None
+        value = stream.read(length + 2)
+        if len(value) != length + 2:
+            raise EOFError("connection closed")
+        return value[:-2].decode("utf-8")
+    if kind == b"*":
+        length = int(data)
+        return None if length < 0 else [read_reply(stream) for _ in range(length)]
+    raise CacheError("unexpected reply %r" % line)
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R
+######################################################################
+class CircuitBreaker(Cache):
+    """
+    Fails at once for a while after a cache failed
+
+    Without it every read would wait for the timeout of an unreachable
+    cache, several times per request. After a failure the reads fail
+    without trying for retry_after seconds, then the next one tries again.
+    Increments always try, a lost one would leave stale entries behind.
+    """
+
+    def __init__(self, cache, retry_after=5):
+        """
+        Args:
+            cache (Cache): the cache that may fail
+            retry_after (float): seconds to leave it alone after a failure
+        """
+        self.cache = cache
+        self.retry_after = retry_after
+        self._down_until = 0.0
+
+    @property
+    def down(self):
+        """ True while the cache is left alone after a failure """
+        return time.monotonic() < self._down_until
+
+    def _call(self, method, *args, always=False):
+        """ Calls a method of the cache, unless it failed recently """
+        if self.down and not always:
+            raise CacheError("cache left alone after a failure")
+        try:
+            result = getattr(self.cache, method)(*args)
+        except CacheError as error:
+            if not self.down:
+                logger.warning("Cache down, retrying in %ss: %s", self.retry_after, error)
+            self._down_until = time.monotonic() + self.retry_after
+            raise
+        self._down_until = 0.0
+        return result
+
+    def get_many(self, keys):
+        return self._call("get_many", keys)
+
+    def set(self, key, value, ttl=None):
+        return self._call("set", key, value, ttl)
+
+    def add(self, key, value):
+        return self._call("add", key, value)
+
+    def incr(self, key):
+        return self._call("incr", key, always=True)
+
+    def clear(self):
+        return self._call("clear", always=True)
+
+
+######################################################################
+#  T I E R S   A N D   V E R S I O N   S T A M P S
+######################################################################
+class TieredCache:
+    """ A per-worker L1 over an optional shared L2, with version stamped keys """
+
+    def __init__(self, l1=None, l2=None, ttl=300, retry_after=5):
+        self.configure(l1, l2, ttl, retry_after)
+
+    def configure(self, l1=None, l2=None, ttl=300, retry_after=5):
+        """
+        Args:
+            l1 (Cache): the cache of this worker, a 10000 entries LRU if None
+            l2 (Cache): the cache shared with the other workers, None if there
+                is only one worker
+            ttl (float): seconds an entry is kept at most
+            retry_after (float): seconds L2 is left alone after a failure
+        """
+        self.l1 = l1 if l1 is not None else LRUCache()
+        self.l2 = CircuitBreaker(l2, retry_after) if l2 is not None else None
+        self.ttl = ttl
+
+    @property
+    def _stamps(self):
+        """ The stamps must be shared, they live in L2 when there is one """
+        return self.l2 if self.l2 is not None else self.l1
+
+    def stamps(self, names):
+        """
+        Returns the current version stamp of each name
+
+        A stamp that doesn't exist yet (or was evicted) starts at the current
+        time in microseconds, so it never goes back to a value used before.
+        """
+        stamps = self._stamps.get_many(["stamp:" + name for name in names])
+        for index, stamp in enumerate(stamps):
+            if stamp is None:
+                start = int(time.time() * 1e6)
+                self._stamps.add("stamp:" + names[index], start)
+                stamps[index] = self._stamps.get("stamp:" + names[index]) or start
+        return stamps
+
+    def bump(self, names):
+        """
+        Increments the stamps of names, orphaning the entries built on them
+
+        Returns the new stamps as a list, None for those that could not be bumped.
+        """
+        stamps = []
+        for name in names:
+            try:
+                stamps.append(self._stamps.incr("stamp:" + name))
+            except CacheError as error:
+                logger.warning("Could not bump the cache stamp %s: %s", name, error)
+                stamps.append(None)
+        return stamps
+
+    def fetch(self, key, stamp_names, compute, local=True):
+        """
+        Returns the cached value of key under the current stamps, or compute()
+
+        Args:
+            key (str): identifies the value among those with the same stamps
+            stamp_names (list): the stamps whose bump must invalidate the value
+            compute (callable): computes the value when it is not cached
+            local (bool): False keeps the value out of L1, for values too
+                large to keep thousands of in every worker
+        """
+        try:
+            stamps = self.stamps(stamp_names)
+        except CacheError as error:
+            logger.warning("Cache unavailable, reading through: %s", error)
+            return compute()
+        full_key = "{}@{}".format(key, ".".join(str(stamp) for stamp in stamps))
+        value = self.l1.get(full_key) if local else None
+        if value is not None:
+            return value
+        if self.l2 is not None:
+            try:
+                value = self.l2.get(full_key)
+            except CacheError as error:
+                logger.warning("Cache unavailable, reading through: %s", error)
+                return compute()
+        if value is None:
+            value = compute()
+            if value is None:
+                return None
+            if self.l2 is not None:
+                try:
+                    self.l2.set(full_key, value, self.ttl)
+                except CacheError as error:
+                    logger.warning("Could not store %s in the cache: %s", full_key, error)
+        if local:
+            self.l1.set(full_key, value, self.ttl)
+        return value
+
+    def clear(self):
+        """ Drops the entries of this worker, the stamps make L2's unreachable """
+        self.l1.clear()
+
+
+def backend(url):
+    """
+    Returns the L2 backend of a CACHE_URL, None if it is empty
+
+    redis://host:port/db uses a Redis protocol server, sqlite:///path a
+    SQLite file.
+    """
+    if not url:
+        return None
+    if url.startswith("redis://"):
+        return RedisCache(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):])
+    raise ValueError("Unsupported CACHE_URL " + url)
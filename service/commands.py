@@ -0,0 +1,113 @@
+"""
+Command line tasks for the Promotion Service
+
+Run them with the flask command, for example:
+  FLASK_APP=service:app flask promotions archive --days 90
+  FLASK_APP=service:app flask promotions compact-changes --days 7
+  FLASK_APP=service:app flask promotions price-catalog catalog.csv priced.csv
+  FLASK_APP=service:app flask promotions seed --promotions 1000000 --products 100000
+"""
+import time
+from datetime import timedelta
+import click
+from flask.cli import AppGroup
+from service.models import Promotion, PromotionChange, PromoType
+from service.pricing import load_promotions, price_catalog
+from service.seeding import Distribution, seed
+
+# Import Flask application
+from . import app
+
+promotions_cli = AppGroup("promotions", help="Maintenance tasks for promotions")
+app.cli.add_command(promotions_cli)
+
+
+######################################################################
+# ARCHIVE EXPIRED PROMOTIONS
+######################################################################
+@promotions_cli.command("archive")
+@click.option("--days", type=int, default=None, help="Archive promotions that ended this many days ago")
+@click.option("--batch-size", type=int, default=None, help="Promotions moved per transaction")
+def archive(days, batch_size):
+    """ Moves promotions that ended long ago to the archive tables """
+    days = app.config["ARCHIVE_AFTER_DAYS"] if days is None else days
+    batch_size = batch_size or app.config["ARCHIVE_BATCH_SIZE"]
+    archived = Promotion.archive_expired(timedelta(days=days), batch_size)
+    click.echo("Archived {} promotions".format(archived))
+
+
+######################################################################
+# COMPACT THE CHANGE LOG
+######################################################################
+@promotions_cli.command("compact-changes")
+@click.option("--days", type=int, default=None, help="Compact changes older than this many days")
+def compact_changes(days):
+    """ Removes the superseded entries of the promotion change log """
+    days = app.config["CHANGES_RETENTION_DAYS"] if days is None else days
+    removed = PromotionChange.compact(timedelta(days=days))
+    click.echo("Removed {} promotion changes".format(removed))
+
+
+######################################################################
+# PRICE A CATALOG
+######################################################################
+@promotions_cli.command("price-catalog")
+@click.argument("in_file", type=click.File("r"))
+@click.argument("out_file", type=click.File("w", lazy=True))
+@click.option("--workers", type=int, default=None, help="Worker processes, defaults to the number of CPUs")
+@click.option("--chunk-size", type=int, default=10000, help="Rows handed to a worker at a time")
+def price_catalog_command(in_file, out_file, workers, chunk_size):
+    """ Writes the best promotion of every product_id,price row of a catalog CSV """
+    promotions = load_promotions()
+
+    def progress(rows, seconds):
+        click.echo("Priced {} rows, {:.0f} rows/s".format(rows, rows / max(seconds, 1e-9)), err=True)
+
+    try:
+        rows = price_catalog(in_file, out_file, promotions, workers, chunk_size, progress)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo("Priced {} rows".format(rows))
+
+
+######################################################################
+# SEED SYNTHETIC DATA
+######################################################################
+@promotions_cli.command("seed")
+@click.option("--promotions", type=int, default=1000, help="Promotions to generate")
+@click.option("--products", type=int, default=1000, help="Products to generate")
+@click.option("--types", default="DISCOUNT=6,FIXED=3,BOGO=1", help="Weights of the promo types")
+@click.option("--site-wide-ratio", type=float, default=0.05, help="Share of site wide promotions")
+@click.option("--date-spread", type=int, default=365, help="Starts are spread this many days around today")
+@click.option("--max-duration", type=int, default=90, help="The longest a promotion lasts, in days")
+@click.option("--fan-out-alpha", type=float, default=1.2, help="Pareto shape of the products per promotion")
+@click.option("--max-fan-out", type=int, default=1000, help="The most products a promotion has")
+@click.option("--unique-codes", type=float, default=0.9, help="Share of promotions with their own promo code")
+@click.option("--seed", "random_seed", type=int, default=None, help="Random seed, to generate the same data again")
+def seed_command(promotions, products, types, site_wide_ratio, date_spread, max_duration,
+                 fan_out_alpha, max_fan_out, unique_codes, random_seed):
+    """ Bulk inserts synthetic promotions and products """
+    try:
+        type_weights = {
+            PromoType[name.strip()]: float(weight)
+            for name, weight in (item.split("=") for item in types.split(","))
+        }
+    except (KeyError, ValueError):
+        raise click.BadParameter("expected TYPE=weight pairs like DISCOUNT=6,BOGO=1", param_hint="--types")
+    distribution = Distribution(
+        type_weights=type_weights,
+        site_wide_ratio=site_wide_ratio,
+        date_spread_days=date_spread,
+        max_duration_days=max_duration,
+        fan_out_alpha=fan_out_alpha,
+        max_fan_out=max_fan_out,
+        unique_code_ratio=unique_codes,
+    )
+    started = time.monotonic()
+    linked = seed(promotions, products, distribution, random_seed)
+    seconds = time.monotonic() - started
+    click.echo(
+        "Seeded {} promotions, {} products and {} links in {:.1f}s".format(
+            promotions, products, linked, seconds
+        )
+    )
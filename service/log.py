@@ -0,0 +1,171 @@
+"""
+Structured Logging off the request path
+
+The handler of the app logger only puts the records on a queue: a
+listener thread merges their arguments, formats them and writes them to
+the handlers that were there before (gunicorn's when it runs the app), so
+the requests don't wait for the formatting nor for the I/O.
+
+- LOG_FORMAT=json (the default) writes one JSON object per line, with the
+  fields passed as extra= next to the message; text keeps the format of
+  the handlers
+- LOG_LEVEL is the level of the app logger, the records below it are
+  dropped before anything is computed
+- LOG_QUEUE_SIZE bounds the queue, the records that don't fit are dropped
+  rather than blocking a request and their count is logged later
+
+As the arguments are merged in the listener thread they must not change
+after the call: lists, dicts and sets are copied when the record is
+queued, other objects must be immutable. Values that cost something to
+compute are wrapped in lazy() so that only the listener computes them,
+and only for the records that are kept.
+"""
+import json
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask.logging import default_handler
+
+# the attributes every LogRecord has, the others come from extra=
+STANDARD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None))
+) | {"message", "asctime"}
+
+
+class lazy:  # pylint: disable=invalid-name,too-few-public-methods
+    """
+    A log argument or field computed when the record is formatted
+
+    lazy(len, promotions) is len(promotions), computed at most once and only
+    by the listener thread.
+    """
+
+    __slots__ = ("function", "args", "computed")
+    _missing = object()
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.computed = self._missing
+
+    def value(self):
+        """ Returns the value, computed on first use """
+        if self.computed is self._missing:
+            self.computed = self.function(*self.args)
+        return self.computed
+
+    def __str__(self):
+        return str(self.value())
+
+    def __repr__(self):
+        return repr(self.value())
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a JSON object with its extra fields """
+
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_ATTRIBUTES:
+                entry[name] = value.value() if isinstance(value, lazy) else value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return super().formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".%03dZ" % record.msecs
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts the records on a queue without formatting them
+
+    QueueHandler merges the message and formats the exception before
+    queuing the record, in the thread that logs it; here the listener does.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the listener formats the arguments later, don't let them change
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                type(arg)(arg) if type(arg) in (list, dict, set) else arg for arg in record.args
+            )
+        return record
+
+    def enqueue(self, record):
+        # called with the lock of the handler held
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord({
+                        "name": record.name,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": "Dropped %d log records, the log queue was full",
+                        "args": (self.dropped,),
+                    })
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def init_logging(app):
+    """
+    Moves the handlers of the app logger behind a queue and starts the listener
+
+    Returns the QueueListener, which is stopped at exit after writing the
+    records that are left. Calling it again returns the same listener.
+    """
+    logger = app.logger
+    listener = app.extensions.get("log_listener")
+    if listener:
+        return listener
+    # under gunicorn, log where it logs
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    handlers = list(gunicorn_logger.handlers or logger.handlers or [default_handler])
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        for handler in handlers:
+            handler.setFormatter(JSONFormatter())
+    logger.setLevel(app.config.get("LOG_LEVEL", "INFO"))
+    records = queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(records))
+    # handlers above it would format the records in the thread that logs them
+    logger.propagate = False
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop, listener)
+    app.extensions["log_listener"] = listener
+    return listener
+
+
+def stop(listener):
+    """ Writes the records that are left and stops the listener, if it runs """
+    if listener._thread:  # pylint: disable=protected-access
+        listener.stop()
+
+
+def flush(app):
+    """ Waits until the listener has written the records queued so far """
+    listener = app.extensions.get("log_listener")
+    if listener:
+        listener.queue.join()
@@ -0,0 +1,113 @@
+"""
+Promo Code Lookup
+
+In-process index of promo codes used to redeem customer-entered codes
+without going through the generic query string search.
+
+The index holds every known code, so a code that is not in it is known
+not to exist and is rejected without a database round trip. Writes that
+go through the Promotion model of this process keep the index in sync,
+and the index reloads when the version shared with the other processes
+moved, so that it also sees their writes. The writes of this process
+move the version too, they tell the index with written() so that it only
+reloads for the writes of the others.
+"""
+import threading
+
+
+class PromoCodeIndex:
+    """
+    Hash map of promo code -> promotions carrying that code
+
+    The map is loaded lazily on first use with a single query and then
+    maintained incrementally by add() and discard(). It is loaded again
+    once the version changed.
+    """
+
+    def __init__(self, loader, version=None):
+        """
+        Args:
+            loader (callable): returns (id, promo_code) rows
+            version (callable): returns a number that changes when another
+                process changed the promotions, None if nothing is shared
+        """
+        self._loader = loader
+        self._version = version or (lambda: 0)
+        self._lock = threading.Lock()
+        self._by_code = None
+        self._code_of = None
+        self._loaded_version = None
+
+    def _load(self):
+        """ Builds the map from the database if it isn't loaded or is outdated """
+        # read before the rows, so that rows never are older than their version
+        version = self._version()
+        if self._by_code is not None and self._loaded_version == version:
+            return
+        with self._lock:
+            if self._by_code is not None and self._loaded_version == version:
+                return  # another thread loaded it while we waited
+            by_code, code_of = {}, {}
+            for promotion_id, promo_code in self._loader():
+                by_code.setdefault(promo_code, []).append(promotion_id)
+                code_of[promotion_id] = promo_code
+            self._code_of = code_of
+            self._by_code = by_code
+            self._loaded_version = version
+
+    def lookup(self, promo_code):
+        """ Returns the ids of the promotions with this code, oldest first """
+        self._load()
+        return sorted(self._by_code.get(promo_code, ()))
+
+    def __contains__(self, promo_code):
+        self._load()
+        return promo_code in self._by_code
+
+    def add(self, promotion):
+        """ Adds or replaces the entry of a promotion after it was written """
+        if self._by_code is None:
+            return  # will pick up the promotion when it is loaded
+        with self._lock:
+            self._remove(promotion.id)
+            if promotion.promo_code is None:
+                return
+            self._by_code.setdefault(promotion.promo_code, []).append(promotion.id)
+            self._code_of[promotion.id] = promotion.promo_code
+
+    def discard(self, promotion_id):
+        """ Removes the entry of a promotion after it was deleted """
+        if self._by_code is None:
+            return
+        with self._lock:
+            self._remove(promotion_id)
+
+    def written(self, version):
+        """
+        Records that a write of this process, already added, moved the version
+
+        The version moves by one per write, so if it moved by more since
+        the index was loaded another process wrote too and the index is
+        left to reload.
+        """
+        if version is None:
+            return  # the version could not be moved
+        with self._lock:
+            if self._by_code is not None and self._loaded_version == version - 1:
+                self._loaded_version = version
+
+    def clear(self):
+        """ Forgets everything so the next lookup reloads from the database """
+        with self._lock:
+            self._by_code = None
+            self._code_of = None
+
+    def _remove(self, promotion_id):
+        promo_code = self._code_of.pop(promotion_id, None)
+        if promo_code is None:
+            return
+        promotion_ids = [i for i in self._by_code[promo_code] if i != promotion_id]
+        if promotion_ids:
+            self._by_code[promo_code] = promotion_ids
+        else:
+            del self._by_code[promo_code]
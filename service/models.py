@@ -9,37 +9,158 @@ Promotion - A Promotion used in the eCommerce website
 - id: (int) primary key
 - title: (str) the name of the promotion
 - description: (str) string/text
-- promo_code: (str) the promo_code associated with this promotion
+- promo_code: (str) the promo_code associated with this promotion (indexed)
 - promo_type: (str or enum) [BOGO | DISCOUNT | FIXED]
 - amount: (int) the amount of the promotion base on promo_type
 - start_date: (date) the starting date
 - end_date: (date) the ending date
+- duration_days: (float) days from start_date to end_date, computed by the database (indexed)
 - is_site_wide: (bool) whether the promotion is site wide
                 (not associated with only certain product(s))
+- version: (int) incremented by every write, used for optimistic concurrency
+- created_at: (datetime) when the promotion was created (indexed)
+- updated_at: (datetime) when the promotion was last written (indexed)
 -----------
 promotion_products - The relationship between promotion and product
 - id: (int) primary key, product_id + promotion_id
 - product_id: (int) foreign key, id of a product the promotion is valid for
 - promotion_id: (int) foreign key, get to promotions.id
 -----------
+PromotionChange - An entry of the append-only change log
+- seq: (int) primary key, increases with every change
+- promotion_id: (int) the promotion that changed (indexed)
+- operation: (str) [create | update | cancel | delete | archive]
+- changed_at: (datetime) when the change was made
+-----------
 
 """
+import json
+import time
 import logging
+import threading
+import warnings
 from enum import Enum
-from datetime import timedelta, datetime
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy import Computed, and_, bindparam, inspect, literal_column, or_, true, false
+from sqlalchemy.ext import baked
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.orm import joinedload, lazyload, noload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
 import dateutil.parser
+from service.lookup import PromoCodeIndex
+from service.scheduler import BoundaryScheduler, ActivePromotion, END_GRACE
+from service.snapshot import SharedSnapshot
+from service.routing import RoutingSQLAlchemy, primary, reading_from_replica
+from service.singleflight import SingleFlight, normalize
+from service.cache import CacheError, LRUCache, TieredCache, backend
+from service import textsearch
+from service.log import lazy
+from service.pricebands import PriceBands
 
-logger = logging.getLogger("flask.app")
+logger = logging.getLogger(__name__)
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Reads of GET endpoints may be routed to read replicas, see service.routing
+db = RoutingSQLAlchemy()
+
+
+# How Promotion.products is loaded, chosen per call site
+PRODUCT_LOADERS = {
+    "joined": joinedload,  # same query, for single promotions that are serialized
+    "selectin": selectinload,  # one extra IN query, for serialized lists
+    "lazy": lazyload,  # only when touched
+    "noload": noload,  # never, for callers that don't need the products
+}
+
+
+def _dialect():
+    """ Returns the name of the dialect of the database of the session """
+    return db.session.get_bind().dialect.name
+
+
+def insert_ignore(table, rows):
+    """ Inserts rows into table, skipping those whose primary key is taken """
+    if not rows:
+        return
+    dialect = _dialect()
+    if dialect == "postgresql":
+        db.session.execute(postgresql.insert(table).on_conflict_do_nothing(), rows)
+    elif dialect == "sqlite":
+        db.session.execute(table.insert().prefix_with("OR IGNORE"), rows)
+    else:
+        keys = list(table.primary_key)
+        taken = set(
+            db.session.query(*keys).filter(
+                db.or_(*[db.and_(*[key == row[key.name] for key in keys]) for row in rows])
+            )
+        )
+        rows = [row for row in rows if tuple(row[key.name] for key in keys) not in taken]
+        if rows:
+            db.session.execute(table.insert(), rows)
+
+
+def upsert(table, rows):
+    """ Inserts rows into table, replacing those whose primary key is taken """
+    if not rows:
+        return
+    dialect = _dialect()
+    keys = list(table.primary_key)
+    if dialect == "postgresql":
+        statement = postgresql.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in table.columns
+                if not column.primary_key
+            },
+        )
+        db.session.execute(statement, rows)
+    elif dialect == "sqlite":
+        db.session.execute(table.insert().prefix_with("OR REPLACE"), rows)
+    else:
+        for row in rows:
+            db.session.execute(
+                table.delete().where(db.and_(*[key == row[key.name] for key in keys]))
+            )
+        db.session.execute(table.insert(), rows)
+
+
+class days_between(FunctionElement):  # pylint: disable=invalid-name
+    """ SQL expression of the number of days from a start to an end timestamp """
+
+    type = db.Float()
+    name = "days_between"
+
+
+@compiles(days_between)
+def _days_between(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "EXTRACT(EPOCH FROM ({} - {})) / 86400".format(
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
+
+
+@compiles(days_between, "sqlite")
+def _days_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "(julianday({}) - julianday({}))".format(
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class VersionConflictError(Exception):
+    """ Used when a Promotion was changed since the client last read it """
+
+
 class PromoType(Enum):
     """ Enumeration of valid promotion types"""
 
@@ -54,7 +175,17 @@ promotion_products = db.Table(
     db.Column(
         'promotion_id', db.Integer, db.ForeignKey('promotion.id'), primary_key=True
     ),
-    db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True),
+    # the product filters look up the promotions of products
+    db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, index=True),
+)
+
+promotion_products_archive = db.Table(
+    'promotion_products_archive',
+    db.Column(
+        'promotion_id', db.Integer, db.ForeignKey('promotion_archive.id'), primary_key=True
+    ),
+    # the product filters look up the promotions of products
+    db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, index=True),
 )
 
 
@@ -76,6 +207,12 @@ class Product(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @classmethod
+    def ensure(cls, product_ids):
+        """ Creates the Products that are not in the database yet """
+        logger.info("Ensuring %d Products exist", len(product_ids))
+        insert_ignore(cls.__table__, [{"id": product_id} for product_id in sorted(product_ids)])
+
     @classmethod
     def all(cls):
         """ Returns all of the Products in the database """
@@ -83,8 +220,108 @@ class Product(db.Model):
         return cls.query.all()
 
 
+def _now():
+    """ Column default for the current time, looked up at call time """
+    return datetime.now()
+
+
+class PromotionMixin:
+    """
+    Columns and behavior shared by live and archived Promotions
+    """
+
+    # Table Schema
+    title = db.Column(db.String(63), nullable=False)
+    description = db.Column(db.Text(), nullable=True)
+    promo_code = db.Column(db.String(63), nullable=True, index=True)
+    promo_type = db.Column(db.Enum(PromoType), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    start_date = db.Column(db.DateTime(), nullable=False, index=True)
+    end_date = db.Column(db.DateTime(), nullable=False, index=True)
+    # computed and stored by the database so that the duration filters use an index
+    duration_days = db.Column(
+        db.Float(),
+        Computed(days_between(literal_column("start_date"), literal_column("end_date"))),
+        index=True,
+    )
+    is_site_wide = db.Column(db.Boolean(), nullable=False, default=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    created_at = db.Column(
+        db.DateTime(),
+        nullable=False,
+        index=True,
+        default=_now,
+        server_default=db.text("CURRENT_TIMESTAMP"),
+    )
+    updated_at = db.Column(
+        db.DateTime(),
+        nullable=False,
+        index=True,
+        default=_now,
+        onupdate=_now,
+        server_default=db.text("CURRENT_TIMESTAMP"),
+    )
+
+    def serialize(self):
+        """ Serializes a Promotion into a dictionary """
+        return {
+            "id": self.id,
+            "title": self.title,
+            "description": self.description,
+            "promo_code": self.promo_code,
+            "promo_type": self.promo_type.name,
+            "amount": self.amount,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat(),
+            "is_site_wide": self.is_site_wide,
+            "products": [product.id for product in self.products],
+        }
+
+    @classmethod
+    def filter_by_args(cls, args):
+        """ Returns a query filtered by the query string arguments """
+        plan, params = compile_args(args)
+        return cls.query.filter(*cls._criteria(plan)).params(**params)
+
+    @classmethod
+    def _criteria(cls, plan):
+        """ Returns the criteria of the filters of a plan, see compile_args() """
+        return [QUERY_FILTERS[name][1](cls, variant) for name, variant in plan[1:]]
+
+    @classmethod
+    def _order(cls, plan):
+        """ Returns the ORDER BY clauses of a plan, the best text matches first """
+        order = [cls.title, cls.id]
+        if ("q", False) in plan:
+            rank = textsearch.rank(cls.__table__.name, cls.id, bindparam("q"), plan[0])
+            if rank is not None:
+                order.insert(0, rank)
+        return order
+
+    @classmethod
+    def _planned(cls, plan, params, paged=False):
+        """
+        Returns the results of the compiled query of a plan with its parameters
+
+        The SQL of a plan is built and compiled by its first search only, the
+        following ones just bind their values. Paged queries also bind offset
+        and limit.
+        """
+        query = plans(
+            lambda session: session.query(cls)
+            .options(selectinload(cls.products))
+            .filter(*cls._criteria(plan))
+            .order_by(*cls._order(plan)),
+            cls,
+            plan,
+        )
+        if paged:
+            query += lambda query: query.offset(bindparam("offset")).limit(bindparam("limit"))
+        return query(db.session()).params(**params)
+
+
 # pylint: disable=raise-missing-from
-class Promotion(db.Model):
+class Promotion(PromotionMixin, db.Model):
     """
     Class that represents a Promotion
 
@@ -96,16 +333,15 @@ class Promotion(db.Model):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(63), nullable=False)
-    description = db.Column(db.Text(), nullable=True)
-    promo_code = db.Column(db.String(63), nullable=True)
-    promo_type = db.Column(db.Enum(PromoType), nullable=False)
-    amount = db.Column(db.Integer, nullable=False)
-    start_date = db.Column(db.DateTime(), nullable=False)
-    end_date = db.Column(db.DateTime(), nullable=False)
-    is_site_wide = db.Column(db.Boolean(), nullable=False, default=False)
     # for promotion_products Many-to-Many relationship
-    products = db.relationship("Product", secondary=promotion_products, lazy="subquery")
+    # loaded lazily unless the call site asks for a strategy, see PRODUCT_LOADERS
+    products = db.relationship("Product", secondary=promotion_products, lazy="select")
+
+    # every UPDATE and DELETE is conditional on the version that was read
+    __mapper_args__ = {"version_id_col": PromotionMixin.version}
+    # SQLite would hand the ids of deleted and archived promotions out again,
+    # to promotions that the archive, the change log and clients would mix up
+    __table_args__ = {"sqlite_autoincrement": True}
 
     def __repr__(self):
         return "<Promotion %r id=[%s]>" % (self.title, self.id)
@@ -117,7 +353,13 @@ class Promotion(db.Model):
         logger.info("Creating %s", self.title)
         self.id = None  # id must be none to generate next primary key. pylint: disable=C0103
         db.session.add(self)
+        product_ids = self._product_ids()
+        db.session.flush()
+        ProductBestPromotion.refresh(product_ids)
+        PromotionChange.record("create", [self.id])
         db.session.commit()
+        code_index.add(self)
+        _promotions_changed([self.id])
 
     def update(self):
         """
@@ -126,19 +368,194 @@ class Promotion(db.Model):
         logger.info("Updating %s", self.title)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        product_ids = self._product_ids()
+        self._flush_new_version()
+        ProductBestPromotion.refresh(product_ids)
+        PromotionChange.record("update", [self.id])
         db.session.commit()
+        code_index.add(self)
+        _promotions_changed([self.id])
 
     def delete(self):
         """ Removes a Promotion from the database """
         logger.info("Deleting %s", self.title)
+        promotion_id = self.id
+        product_ids = self._linked_product_ids([promotion_id])
+        db.session.execute(
+            promotion_products.delete().where(
+                promotion_products.c.promotion_id == promotion_id
+            )
+        )
+        # the rows are gone, don't let the flush delete them a second time
+        set_committed_value(self, "products", [])
         db.session.delete(self)
+        self._flush_checked()
+        ProductBestPromotion.refresh(product_ids)
+        PromotionChange.record("delete", [promotion_id])
+        db.session.commit()
+        code_index.discard(promotion_id)
+        _promotions_changed([promotion_id])
+
+    def check_version(self, versions):
+        """
+        Raises VersionConflictError unless the Promotion has one of the versions
+
+        Args:
+            versions (list): the versions the client expects, None skips the check
+        """
+        if versions is not None and self.version not in versions:
+            raise VersionConflictError(
+                "Promotion with id '{}' was changed, its version is now {}".format(
+                    self.id, self.version
+                )
+            )
+
+    def _flush_new_version(self):
+        """ Flushes the changes with a version bump, even if only products changed """
+        if not db.session.is_modified(self, include_collections=False):
+            self.version = self.version + 1  # forces the conditional UPDATE
+        self._flush_checked()
+
+    def _flush_checked(self):
+        """ Flushes the changes, failing if someone else wrote the row meanwhile """
+        try:
+            db.session.flush()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflictError(
+                "Promotion with id '{}' was changed by someone else".format(self.id)
+            )
+
+    def _product_ids(self):
+        """ Ids of the products this Promotion is or was associated with """
+        with db.session.no_autoflush:
+            product_ids = {product.id for product in self.products}
+        history = inspect(self).attrs.products.history
+        return product_ids | {product.id for product in history.deleted}
+
+    def patch(self, data):
+        """
+        Partially updates a Promotion in the database
+
+        Only the fields present in data are changed. Products are changed with
+        products_add and products_remove (or products, which is diffed against
+        the current ones), touching only the promotion_products rows that
+        actually change instead of rewriting the whole collection.
+
+        Args:
+            data (dict): A dictionary with the fields to change
+        """
+        logger.info("Patching %s", self.id)
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid promotion: body of request contained bad or no data"
+            )
+        unknown = set(data) - set(PATCHABLE_FIELDS) - set(PATCHABLE_PRODUCTS)
+        if unknown:
+            raise DataValidationError(
+                "Invalid promotion: unknown field " + sorted(unknown)[0]
+            )
+        changes = {field: data[field] for field in PATCHABLE_FIELDS if field in data}
+        for field, valid in PATCH_CHECKS.items():
+            if field in changes and not valid(changes[field]):
+                raise DataValidationError("Invalid promotion: bad " + field)
+        if "promo_type" in changes:
+            promo_type = changes["promo_type"]
+            if not isinstance(promo_type, str) or promo_type not in PromoType.__members__:
+                raise DataValidationError("Invalid promotion: bad promo_type")
+            changes["promo_type"] = PromoType[promo_type]
+        for field in ("start_date", "end_date"):
+            if field in changes:
+                changes[field] = _date(data, field)
+        to_add = set(_product_id_list(data, "products_add"))
+        to_remove = set(_product_id_list(data, "products_remove"))
+        wanted = set(_product_id_list(data, "products")) if "products" in data else None
+        current = None
+        if wanted is not None:
+            current = self._linked_product_ids([self.id])
+            to_add |= wanted - current
+            to_remove |= current - wanted
+        to_add -= to_remove
+
+        affected = to_add | to_remove
+        if set(data) & set(EVALUATED_FIELDS):
+            # every product of the promotion may have a new best promotion
+            if current is None:
+                current = self._linked_product_ids([self.id])
+            affected |= current
+        # everything is validated, nothing was changed before this point
+        for field, value in changes.items():
+            setattr(self, field, value)
+        self._flush_new_version()
+        if to_remove:
+            db.session.execute(
+                promotion_products.delete()
+                .where(promotion_products.c.promotion_id == self.id)
+                .where(promotion_products.c.product_id.in_(to_remove))
+            )
+        if to_add:
+            Product.ensure(to_add)
+            insert_ignore(
+                promotion_products,
+                [
+                    {"promotion_id": self.id, "product_id": product_id}
+                    for product_id in sorted(to_add)
+                ],
+            )
+        ProductBestPromotion.refresh(affected)
+        PromotionChange.record("update", [self.id])
         db.session.commit()
+        db.session.expire(self, ["products"])
+        code_index.add(self)
+        _promotions_changed([self.id])
+        return self
 
     @classmethod
-    def find(cls, promotion_id):
-        """ Finds a Promotion by it's ID """
+    def find(cls, promotion_id, products="joined"):
+        """
+        Finds a Promotion by it's ID
+
+        Args:
+            promotion_id (int): the id of the Promotion
+            products (str): how to load the products, a key of PRODUCT_LOADERS
+        """
         logger.info("Processing lookup for id %s ...", promotion_id)
-        return cls.query.get(promotion_id)
+        if products == "joined" and _dialect() == "sqlite":
+            # SQLite materializes the nested join with the secondary table,
+            # scanning every link, and a second query costs no round trip
+            products = "selectin"
+        loader = PRODUCT_LOADERS[products]
+        return cls.query.options(loader(cls.products)).get(promotion_id)
+
+    @classmethod
+    def read(cls, promotion_id):
+        """
+        Returns the serialized Promotion with an id and its version
+
+        Served from the shared cache until the promotion is written.
+
+        Returns:
+            {"promotion": dict, "version": int}, None if there is no such Promotion
+        """
+
+        def load():
+            promotion = cls.find(promotion_id)
+            if not promotion:
+                return None
+            return {"promotion": promotion.serialize(), "version": promotion.version}
+
+        stamp = "promotion:{}".format(promotion_id)
+        return _cached(stamp, ["all", stamp], load)
+
+    @classmethod
+    def find_by_ids(cls, promotion_ids):
+        """ Finds the Promotions with some ids, those that don't exist are skipped """
+        promotions = []
+        for chunk in _chunks(sorted(promotion_ids)):
+            promotions += (
+                cls.query.options(selectinload(cls.products)).filter(cls.id.in_(chunk)).all()
+            )
+        return promotions
 
     @classmethod
     def find_or_404(cls, promotion_id):
@@ -146,93 +563,172 @@ class Promotion(db.Model):
         logger.info("Processing lookup or 404 for id %s ...", promotion_id)
         return cls.query.get_or_404(promotion_id)
 
+    @classmethod
+    def find_by_promo_code(cls, promo_code):
+        """
+        Finds the active Promotion a customer can redeem with a promo code
+
+        Unknown codes are answered from the in-process code index without
+        touching the database. When several active promotions share a code
+        the oldest one wins.
+        """
+        logger.info("Processing redemption lookup for code %s ...", promo_code)
+        active = scheduler.snapshot().promotions
+        for promotion_id in code_index.lookup(promo_code):
+            if promotion_id in active:
+                return cls.find(promotion_id)
+        return None
+
     @classmethod
     def find_by_query_string(cls, args):
-        """ Find a Promotion by query string """
+        """
+        Find a Promotion by query string
+
+        With per_page only that page of the results is returned, page 1
+        by default. Archived promotions come after the live ones then.
+        """
         logger.info(" Processing lookup based on query string %s ...", args)
-        data = cls.query
-        if "id" in args and args["id"] is not None:
-            data = data.filter(cls.id == args["id"])
-        if "title" in args and args["title"] is not None:
-            data = data.filter(cls.title == args["title"])
-        if "promo_code" in args and args["promo_code"] is not None:
-            data = data.filter(cls.promo_code == args["promo_code"])
-        if "promo_type" in args and args["promo_type"] is not None:
-            data = data.filter(cls.promo_type == args["promo_type"])
-        if "amount" in args and args["amount"] is not None:
-            data = data.filter(cls.amount == args["amount"])
-        if "is_site_wide" in args and args["is_site_wide"] is not None:
-            data = data.filter(cls.is_site_wide == args["is_site_wide"])
-        if "start_date" in args and args["start_date"] is not None:
-            data = data.filter(
-                cls.start_date == dateutil.parser.parse(args["start_date"])
-            )
-        if "end_date" in args and args["end_date"] is not None:
-            data = data.filter(cls.end_date == dateutil.parser.parse(args["end_date"]))
-        if "duration" in args and args["duration"] is not None:
-            # returns promotions that last the number of days specified
-            data = data.filter(
-                cls.start_date + timedelta(days=int(args.get("duration")))
-                == cls.end_date
+        plan, params = compile_args(args)
+        if args.get("per_page"):
+            return cls._page(plan, params, args)
+        promotions = cls._planned(plan, params).all()
+        if args.get("include_archived"):
+            archived = ArchivedPromotion._planned(plan, params).all()
+            promotions = sorted(promotions + archived, key=lambda promo: promo.title)
+        return promotions
+
+    @classmethod
+    def _page(cls, plan, params, args):
+        """ Returns one page of the results of find_by_query_string() """
+        per_page = args["per_page"]
+        offset = (max(args.get("page") or 1, 1) - 1) * per_page
+        promotions = cls._planned(plan, dict(params, offset=offset, limit=per_page), True).all()
+        if args.get("include_archived") and len(promotions) < per_page:
+            # the archived results start where the live ones end
+            archived_offset = max(offset - cls._planned(plan, params).count(), 0)
+            promotions += ArchivedPromotion._planned(
+                plan,
+                dict(params, offset=archived_offset, limit=per_page - len(promotions)),
+                True,
+            ).all()
+        return promotions
+
+    @classmethod
+    def search(cls, args, timeout=None):
+        """
+        Serialized find_by_query_string(), shared by identical concurrent searches
+
+        Args:
+            args (dict): the query string arguments
+            timeout (float): seconds to wait for an identical search in flight
+        """
+        key = normalize("search", args) + (reading_from_replica(),)
+
+        def search():
+            # the active filter changes at the next boundary even without writes;
+            # its active set follows the stamps too, so a result is never older
+            # than the stamps it is cached under
+            boundary = scheduler.snapshot().next_boundary.isoformat()
+            return _cached(
+                "search:{}:{}".format(json.dumps(key[1:-1]), boundary),
+                ["lists"],
+                lambda: [promo.serialize() for promo in cls.find_by_query_string(args)],
+                # whole lists have no bound, thousands of them don't fit in L1
+                local=bool(args.get("per_page")),
             )
-        if "active" in args and args["active"] is not None:
-            if args.get("active") == "1":
-                data = data.filter(cls.start_date <= datetime.now()).filter(
-                    cls.end_date >= datetime.now()
-                )
-            if args.get("active") == "0":
-                data = data.filter(
-                    (cls.start_date > datetime.now()) | (datetime.now() > cls.end_date)
-                )
-        if "product" in args and args["product"] is not None:
-            data = data.filter(cls.products.any(id=int(args.get("product"))))
-        return data.order_by(Promotion.title).all()
+
+        return flights.do(key, search, timeout)
 
     @classmethod
-    def apply_best_promo(cls, product_id, pricing):
-        """ Find a Promotion by query string """
-        logger.info(" Finding best promotion for the product %s ...", product_id)
-        promos = cls.query.filter(cls.start_date <= datetime.now()).filter(
-            cls.end_date >= datetime.now()
-        )
+    def active_filter(cls, active):
+        """
+        Filter on the active status at the instant of the active set
 
-        product_promos = promos.filter(cls.products.any(id=product_id))
-        site_wide_promos = promos.filter(cls.is_site_wide)
-        logger.info("  Available site wide promos: " + str(site_wide_promos.all()))
-        logger.info("  Available promos for this product: " + str(product_promos.all()))
-
-        best_promo, best_discount = None, 0
-        for p in site_wide_promos.all() + product_promos.all():
-            if p.promo_type == PromoType.DISCOUNT:
-                if p.amount > best_discount:
-                    best_promo, best_discount = p, p.amount
-            elif p.promo_type == PromoType.BOGO and best_discount < 50:
-                best_promo, best_discount = p, 50
-            elif p.promo_type == PromoType.FIXED:
-                fixed_discount = (p.amount / pricing) * 100
-                if fixed_discount > best_discount:
-                    best_promo, best_discount = p, fixed_discount
+        The instant the active set was taken at is bound to active_at, so
+        the filter matches it exactly and can use the date indexes.
+        """
+        active_at = bindparam("active_at")
+        if active == "1":
+            return and_(cls.start_date <= active_at, cls.end_date >= active_at)
+        return or_(cls.start_date > active_at, cls.end_date < active_at)
 
+    @classmethod
+    def apply_best_promo(cls, product_id, pricing):
+        """ Find the best active Promotion for a product at a price """
+        bands = cls._price_bands(product_id)
+        best_promo = bands.best(pricing)
+        # the promotions are immutable, the listener formats them
         logger.info(
-            "  Promotion selected: "
-            + str(best_promo.promo_code if best_promo else None)
+            " Best promotion for the product %s: %s",
+            product_id,
+            best_promo.promo_code if best_promo else None,
+            extra={"pricing": pricing, "candidates": lazy(_promo_codes, bands.candidates)},
         )
         return {product_id: best_promo.promo_code} if best_promo else None
 
-    def serialize(self):
-        """ Serializes a Promotion into a dictionary """
-        return {
-            "id": self.id,
-            "title": self.title,
-            "description": self.description,
-            "promo_code": self.promo_code,
-            "promo_type": self.promo_type.name,
-            "amount": self.amount,
-            "start_date": self.start_date.isoformat(),
-            "end_date": self.end_date.isoformat(),
-            "is_site_wide": self.is_site_wide,
-            "products": [product.id for product in self.products],
-        }
+    @classmethod
+    def _price_bands(cls, product_id):
+        """
+        The PriceBands of the active promotions of a product
+
+        They are memoized per active set: a write of this worker, a time
+        boundary or a move of the version shared by the workers (which the
+        site wide promotions of the active set follow too) starts a new one.
+        """
+        # read before the snapshot: a write in between can make the key older
+        # than the promotions, never the other way around
+        generation = scheduler.generation
+        now = datetime.now()
+        snapshot = scheduler.snapshot(now)
+        if not shared_snapshot.enabled and reading_from_replica():
+            # the replica may not have caught up with the version
+            return cls._load_price_bands(product_id, now, snapshot)
+        key = (product_id, generation, snapshot.taken_at, snapshot.version)
+        bands = best_promos.get(key)
+        if bands is None:
+            bands = cls._load_price_bands(product_id, now, snapshot)
+            best_promos.set(key, bands)
+        return bands
+
+    @classmethod
+    def _load_price_bands(cls, product_id, now, snapshot):
+        """ Collects the candidates of a product, site wide ones first """
+        if shared_snapshot.enabled:
+            product_promos = [
+                snapshot.promotions[promotion_id]
+                for promotion_id in shared_snapshot.view().promotion_ids_for(product_id)
+                if promotion_id in snapshot.promotions
+                and not snapshot.promotions[promotion_id].is_site_wide
+            ]
+        else:
+            product_promos = ProductBestPromotion.cached_lookup(
+                product_id, now, snapshot.next_boundary
+            )
+        candidates = snapshot.site_wide + tuple(product_promos)
+        return PriceBands(candidates, select_best_promo, price_breakpoints(candidates))
+
+    @classmethod
+    def apply_best_promos(cls, prices, timeout=None):
+        """
+        apply_best_promo() for several products, shared by identical concurrent calls
+
+        Args:
+            prices (dict): the price of each product id
+            timeout (float): seconds to wait for an identical call in flight
+        Returns:
+            the results of apply_best_promo() in the order of prices, without
+            the products that have no promotion
+        """
+        key = normalize("apply", prices) + (reading_from_replica(),)
+        best = flights.do(
+            key,
+            lambda: {
+                product_id: cls.apply_best_promo(product_id, price)
+                for product_id, price in prices.items()
+            },
+            timeout,
+        )
+        return [best[product_id] for product_id in prices if best[product_id]]
 
     def deserialize(self, data):
         """
@@ -249,8 +745,8 @@ class Promotion(db.Model):
                 PromoType, data["promo_type"]
             )  # create enum from string
             self.amount = data["amount"]
-            self.start_date = data["start_date"]
-            self.end_date = data["end_date"]
+            self.start_date = _date(data, "start_date")
+            self.end_date = _date(data, "end_date")
             self.is_site_wide = data["is_site_wide"]
             self.products = []
             for product_id in data["products"]:
@@ -269,7 +765,204 @@ class Promotion(db.Model):
     def all(cls):
         """ Returns all of the Promotions in the database """
         logger.info("Processing all Promotions")
-        return cls.query.order_by(Promotion.title).all()
+        return cls.query.options(selectinload(cls.products)).order_by(cls.title).all()
+
+    @classmethod
+    def delete_matching(cls, args, everything=False):
+        """
+        Deletes every Promotion matching the query string arguments
+
+        The promotions and their promotion_products rows are removed with set
+        based DELETE statements in a single transaction.
+
+        Args:
+            args (dict): query string arguments, as for find_by_query_string
+            everything (bool): must be True to delete every Promotion when no
+                argument filters them
+        Returns:
+            the number of deleted promotions
+        """
+        logger.info("Deleting promotions matching %s", args)
+        cls._check_filtered(args, everything)
+        promotion_ids = cls._matching_ids(args)
+        product_ids = cls._linked_product_ids(promotion_ids)
+        deleted = 0
+        for chunk in _chunks(promotion_ids):
+            db.session.execute(
+                promotion_products.delete().where(
+                    promotion_products.c.promotion_id.in_(chunk)
+                )
+            )
+            deleted += db.session.execute(
+                cls.__table__.delete().where(cls.id.in_(chunk))
+            ).rowcount
+        ProductBestPromotion.refresh(product_ids)
+        PromotionChange.record("delete", promotion_ids)
+        db.session.commit()
+        for promotion_id in promotion_ids:
+            code_index.discard(promotion_id)
+        _promotions_changed()
+        return deleted
+
+    @classmethod
+    def cancel(cls, promotion_id, versions=None):
+        """
+        Cancels a Promotion with a single conditional UPDATE statement
+
+        Args:
+            promotion_id (int): the id of the promotion to cancel
+            versions (list): only cancel the promotion if it has one of these
+                versions, None cancels it whatever its version
+        Returns:
+            False if there is no Promotion with that id
+        """
+        logger.info("Cancelling promotion %s", promotion_id)
+        now = datetime.now()
+        statement = (
+            cls.__table__.update()
+            .where(cls.id == promotion_id)
+            .values(end_date=now, version=cls.version + 1, updated_at=now)
+        )
+        if versions is not None:
+            statement = statement.where(cls.version.in_(versions))
+        if db.session.execute(statement).rowcount == 0:
+            db.session.rollback()
+            promotion = cls.find(promotion_id, products="noload")
+            if promotion is None:
+                return False
+            promotion.check_version(versions)
+        ProductBestPromotion.refresh(cls._linked_product_ids([promotion_id]), now)
+        PromotionChange.record("cancel", [promotion_id], now)
+        db.session.commit()
+        _promotions_changed([promotion_id])
+        return True
+
+    @classmethod
+    def cancel_matching(cls, args, promotion_ids=None, everything=False):
+        """
+        Cancels every Promotion matching the query string arguments
+
+        Cancelling ends a promotion now, with one set based UPDATE statement.
+        Promotions that already ended are left alone.
+
+        Args:
+            args (dict): query string arguments, as for find_by_query_string
+            promotion_ids (list): only cancel promotions with these ids
+            everything (bool): must be True to cancel every Promotion when
+                neither args nor promotion_ids filter them
+        Returns:
+            the number of cancelled promotions
+        """
+        logger.info("Cancelling promotions matching %s %s", args, promotion_ids or "")
+        if promotion_ids is None:
+            cls._check_filtered(args, everything)
+        now = datetime.now()
+        query = cls.filter_by_args(args).filter(cls.end_date > now)
+        if promotion_ids is not None:
+            query = query.filter(cls.id.in_(promotion_ids))
+        promotion_ids = [promotion_id for (promotion_id,) in query.with_entities(cls.id)]
+        product_ids = cls._linked_product_ids(promotion_ids)
+        cancelled = 0
+        for chunk in _chunks(promotion_ids):
+            cancelled += db.session.execute(
+                cls.__table__.update()
+                .where(cls.id.in_(chunk))
+                .values(end_date=now, version=cls.version + 1, updated_at=now)
+            ).rowcount
+        ProductBestPromotion.refresh(product_ids, now)
+        PromotionChange.record("cancel", promotion_ids, now)
+        db.session.commit()
+        _promotions_changed()
+        return cancelled
+
+    @staticmethod
+    def _check_filtered(args, everything):
+        """ Refuses a bulk write of every Promotion unless everything is asked for """
+        if not everything and len(compile_args(args)[0]) == 1:
+            raise DataValidationError(
+                "Invalid query: no filter given, pass all=true to change every promotion"
+            )
+
+    @classmethod
+    def _matching_ids(cls, args):
+        """ Ids of the Promotions matching the query string arguments """
+        query = cls.filter_by_args(args).with_entities(cls.id)
+        return [promotion_id for (promotion_id,) in query]
+
+    @staticmethod
+    def _linked_product_ids(promotion_ids):
+        """ Ids of the products associated with some Promotions """
+        product_ids = set()
+        for chunk in _chunks(promotion_ids):
+            product_ids.update(
+                product_id
+                for (product_id,) in db.session.query(promotion_products.c.product_id)
+                .filter(promotion_products.c.promotion_id.in_(chunk))
+                .distinct()
+            )
+        return product_ids
+
+    @classmethod
+    def archive_expired(cls, older_than, batch_size=1000):
+        """
+        Moves the Promotions that ended before now - older_than to the archive
+
+        Promotions are moved in batches, each in its own transaction, together
+        with their promotion_products rows.
+
+        Args:
+            older_than (timedelta): how long ago a promotion must have ended
+            batch_size (int): how many promotions to move per transaction
+        Returns:
+            the number of archived promotions
+        """
+        now = datetime.now()
+        cutoff = now - older_than
+        logger.info("Archiving promotions that ended before %s", cutoff)
+        # the archive computes the generated columns itself
+        columns = [column.name for column in cls.__table__.columns if column.computed is None]
+        archived = 0
+        while True:
+            promotion_ids = [
+                promotion_id
+                for (promotion_id,) in db.session.query(cls.id)
+                .filter(cls.end_date < cutoff)
+                .order_by(cls.id)
+                .limit(batch_size)
+            ]
+            if not promotion_ids:
+                break
+            db.session.execute(
+                ArchivedPromotion.__table__.insert().from_select(
+                    columns + ["archived_at"],
+                    db.select(
+                        [cls.__table__.c[name] for name in columns]
+                        + [db.literal(now, db.DateTime()).label("archived_at")]
+                    ).where(cls.id.in_(promotion_ids)),
+                )
+            )
+            db.session.execute(
+                promotion_products_archive.insert().from_select(
+                    ["promotion_id", "product_id"],
+                    db.select(
+                        [promotion_products.c.promotion_id, promotion_products.c.product_id]
+                    ).where(promotion_products.c.promotion_id.in_(promotion_ids)),
+                )
+            )
+            db.session.execute(
+                promotion_products.delete().where(
+                    promotion_products.c.promotion_id.in_(promotion_ids)
+                )
+            )
+            db.session.execute(cls.__table__.delete().where(cls.id.in_(promotion_ids)))
+            PromotionChange.record("archive", promotion_ids, now)
+            db.session.commit()
+            for promotion_id in promotion_ids:
+                code_index.discard(promotion_id)
+            archived += len(promotion_ids)
+            logger.info("Archived %d promotions", archived)
+        _promotions_changed()
+        return archived
 
     @classmethod
     def init_db(cls, app):
@@ -280,3 +973,853 @@ class Promotion(db.Model):
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        upgrade_db()  # bring tables created by older versions up to date
+        cache.configure(
+            LRUCache(app.config.get("CACHE_L1_SIZE", 10000)),
+            backend(app.config.get("CACHE_URL")),
+            app.config.get("CACHE_TTL", 300),
+            app.config.get("CACHE_RETRY_AFTER", 5),
+        )
+        best_promos.max_entries = app.config.get("BEST_PROMO_MEMO_SIZE", 10000)
+        clear_caches()
+        shared_snapshot.configure(app.config.get("SHARED_SNAPSHOT_PATH") or None)
+        if ProductBestPromotion.query.first() is None:
+            ProductBestPromotion.refresh_all()
+        db.session.commit()  # don't hold the startup transaction open
+
+
+class ArchivedPromotion(PromotionMixin, db.Model):
+    """
+    Class that represents a Promotion moved to the archive
+
+    Promotions that ended long ago are moved here by Promotion.archive_expired()
+    so they stop slowing down every query on the promotion table.
+    """
+
+    __tablename__ = "promotion_archive"
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    archived_at = db.Column(db.DateTime(), nullable=False)
+    products = db.relationship(
+        "Product", secondary=promotion_products_archive, lazy="select"
+    )
+
+    def __repr__(self):
+        return "<ArchivedPromotion %r id=[%s]>" % (self.title, self.id)
+
+    @classmethod
+    def active_filter(cls, active):
+        """ Archived promotions have all ended """
+        return false() if active == "1" else true()
+
+
+# first key of the advisory locks of ProductBestPromotion.refresh() on PostgreSQL
+REFRESH_LOCK = 28
+
+# advisory lock of PromotionChange.record() on PostgreSQL, held until the commit
+CHANGES_LOCK = 37
+
+
+class ProductBestPromotion(db.Model):
+    """
+    Class that represents the materialized best promotions of a Product
+
+    Only the product specific (not site wide) active promotions are kept.
+    DISCOUNT and BOGO promotions are worth the same at every price so only
+    the best one is stored. FIXED promotions are worth more the larger their
+    amount, so only the largest one is stored. Which of the two wins depends
+    on the price band: the FIXED one wins below amount * 100 / percent.
+    """
+
+    __tablename__ = "product_best_promotion"
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    percent_promotion_id = db.Column(db.Integer, nullable=True)
+    percent_promo_code = db.Column(db.String(63), nullable=True)
+    percent_promo_type = db.Column(db.Enum(PromoType), nullable=True)
+    percent_amount = db.Column(db.Integer, nullable=True)
+    fixed_promotion_id = db.Column(db.Integer, nullable=True)
+    fixed_promo_code = db.Column(db.String(63), nullable=True)
+    fixed_amount = db.Column(db.Integer, nullable=True)
+    valid_until = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self):
+        return "<ProductBestPromotion product_id=[%s]>" % self.product_id
+
+    def candidates(self):
+        """ Returns the stored promotions ordered by id """
+        return self._candidates(self)
+
+    @staticmethod
+    def _candidates(row):
+        """ Builds the read models of a row, which may be a plain result row """
+        candidates = []
+        if row.percent_promotion_id is not None:
+            candidates.append(
+                ActivePromotion(
+                    row.percent_promotion_id,
+                    row.percent_promo_code,
+                    row.percent_promo_type,
+                    row.percent_amount,
+                    False,
+                )
+            )
+        if row.fixed_promotion_id is not None:
+            candidates.append(
+                ActivePromotion(
+                    row.fixed_promotion_id,
+                    row.fixed_promo_code,
+                    PromoType.FIXED,
+                    row.fixed_amount,
+                    False,
+                )
+            )
+        return sorted(candidates, key=lambda promo: promo.id)
+
+    @classmethod
+    def _row(cls, product_id):
+        """ Reads the row of a product as plain columns, without ORM state """
+        return (
+            db.session.query(*cls.__table__.columns)
+            .filter(cls.product_id == product_id)
+            .first()
+        )
+
+    @classmethod
+    def lookup(cls, product_id, now):
+        """ Returns the best product specific promotions of a product at now """
+        row = cls._row(product_id)
+        if row is not None and row.valid_until <= now:
+            # a promotion of this product started or ended since it was computed
+            with primary():
+                cls.refresh([product_id], now)
+                db.session.commit()
+                row = cls._row(product_id)
+        return cls._candidates(row) if row else []
+
+    @classmethod
+    def cached_lookup(cls, product_id, now, boundary):
+        """
+        lookup() through the shared cache
+
+        Args:
+            boundary (datetime): the next time a promotion starts or ends,
+                the cached promotions are not used after it
+        """
+
+        def load():
+            return [
+                [promo.id, promo.promo_code, promo.promo_type.name, promo.amount]
+                for promo in cls.lookup(product_id, now)
+            ]
+
+        rows = _cached("best:{}:{}".format(product_id, boundary.isoformat()), ["lists"], load)
+        return [
+            ActivePromotion(promotion_id, promo_code, PromoType[promo_type], amount, False)
+            for promotion_id, promo_code, promo_type, amount in rows
+        ]
+
+    @classmethod
+    def refresh(cls, product_ids, now=None):
+        """
+        Recomputes the rows of some products in the current transaction
+
+        Args:
+            product_ids (iterable): the products whose promotions changed
+            now (datetime): the instant to compute the rows for
+        """
+        product_ids = set(product_ids)
+        if not product_ids:
+            return
+        now = now or datetime.now()
+        logger.info("Refreshing best promotions of %d products", len(product_ids))
+        cls._lock(product_ids)
+        rows = {
+            product_id: {
+                "product_id": product_id,
+                "percent_promotion_id": None,
+                "percent_promo_code": None,
+                "percent_promo_type": None,
+                "percent_amount": None,
+                "fixed_promotion_id": None,
+                "fixed_promo_code": None,
+                "fixed_amount": None,
+                "valid_until": datetime.max,
+            }
+            for product_id in product_ids
+        }
+        percent = {}
+        promotions = (
+            db.session.query(
+                promotion_products.c.product_id,
+                Promotion.id,
+                Promotion.promo_code,
+                Promotion.promo_type,
+                Promotion.amount,
+                Promotion.start_date,
+                Promotion.end_date,
+            )
+            .join(Promotion, Promotion.id == promotion_products.c.promotion_id)
+            .filter(promotion_products.c.product_id.in_(product_ids))
+            .filter(~Promotion.is_site_wide)
+            .filter(Promotion.end_date >= now)
+            .order_by(Promotion.id)
+        )
+        for product_id, promotion_id, promo_code, promo_type, amount, start, end in promotions:
+            row = rows[product_id]
+            if start > now:
+                row["valid_until"] = min(row["valid_until"], start)
+                continue
+            row["valid_until"] = min(row["valid_until"], end + END_GRACE)
+            if promo_type == PromoType.FIXED:
+                if row["fixed_amount"] is None or amount > row["fixed_amount"]:
+                    row["fixed_promotion_id"] = promotion_id
+                    row["fixed_promo_code"] = promo_code
+                    row["fixed_amount"] = amount
+                continue
+            value = 50 if promo_type == PromoType.BOGO else amount
+            if product_id not in percent or value > percent[product_id]:
+                percent[product_id] = value
+                row["percent_promotion_id"] = promotion_id
+                row["percent_promo_code"] = promo_code
+                row["percent_promo_type"] = promo_type
+                row["percent_amount"] = amount
+        upsert(cls.__table__, list(rows.values()))
+
+    @classmethod
+    def _lock(cls, product_ids):
+        """
+        Waits for the other transactions refreshing the same products
+
+        Each writer computes the rows from the links committed when it
+        reads them, so two writers linking promotions to the same product
+        concurrently would each write a row missing the other's promotion.
+        On PostgreSQL the products are locked until the end of the
+        transaction, in id order so that refreshes never deadlock, and the
+        rows are read once the writers before have committed. SQLite has a
+        single writer at a time, and refuses to write from a read older
+        than the last commit.
+        """
+        if _dialect() != "postgresql":
+            return
+        db.session.execute(
+            db.text(
+                "SELECT pg_advisory_xact_lock(:namespace, product_id) FROM "
+                "(SELECT unnest(CAST(:product_ids AS integer[])) AS product_id "
+                "ORDER BY product_id) AS products"
+            ),
+            {"namespace": REFRESH_LOCK, "product_ids": sorted(product_ids)},
+        )
+
+    @classmethod
+    def refresh_all(cls):
+        """ Recomputes the rows of every product that has promotions """
+        product_ids = [
+            product_id
+            for (product_id,) in db.session.query(
+                promotion_products.c.product_id
+            ).distinct()
+        ]
+        db.session.query(cls).delete(synchronize_session=False)
+        for chunk in _chunks(product_ids, 10000):
+            cls.refresh(chunk)
+        db.session.commit()
+
+
+class PromotionChange(db.Model):
+    """
+    Class that represents an entry of the append-only change log
+
+    Every write of a Promotion appends one entry per changed promotion in
+    the same transaction, so downstream consumers can fetch only what
+    changed since the last seq they saw instead of polling every promotion.
+    """
+
+    __tablename__ = "promotion_change"
+
+    seq = db.Column(db.Integer, primary_key=True)
+    promotion_id = db.Column(db.Integer, nullable=False, index=True)
+    operation = db.Column(db.String(16), nullable=False)
+    changed_at = db.Column(db.DateTime(), nullable=False)
+
+    # operations after which the promotion is gone from the promotion table
+    REMOVALS = ("delete", "archive")
+
+    def __repr__(self):
+        return "<PromotionChange %s %s id=[%s]>" % (
+            self.seq,
+            self.operation,
+            self.promotion_id,
+        )
+
+    def serialize(self):
+        """ Serializes a PromotionChange into a dictionary """
+        return {
+            "seq": self.seq,
+            "promotion_id": self.promotion_id,
+            "operation": self.operation,
+            "changed_at": self.changed_at.isoformat(),
+        }
+
+    @classmethod
+    def record(cls, operation, promotion_ids, now=None):
+        """
+        Appends the changes of some promotions in the current transaction
+
+        It must be the last statement before the commit: the seqs are
+        numbered in commit order, so a consumer that saw a seq never gets
+        an older one later. On PostgreSQL a sequence number is drawn at
+        insert time but becomes visible at commit time, so the writers
+        hold a lock from their insert until their commit. SQLite has a
+        single writer at a time.
+
+        Args:
+            operation (str): what happened to the promotions
+            promotion_ids (iterable): the ids of the changed promotions
+            now (datetime): when it happened
+        """
+        now = now or datetime.now()
+        rows = [
+            {"promotion_id": promotion_id, "operation": operation, "changed_at": now}
+            for promotion_id in promotion_ids
+        ]
+        if rows:
+            if _dialect() == "postgresql":
+                db.session.execute(
+                    db.text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGES_LOCK}
+                )
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def since(cls, seq, limit):
+        """ Returns at most limit changes that came after seq, oldest first """
+        return cls.query.filter(cls.seq > seq).order_by(cls.seq).limit(limit).all()
+
+    @classmethod
+    def wait_since(cls, seq, limit, timeout, poll_interval=1.0):
+        """
+        Returns the changes after seq, waiting up to timeout seconds for one
+
+        Writes made by this process wake the waiters up at once, writes made
+        by other processes are noticed every poll_interval seconds.
+        """
+        remaining = timeout
+        while True:
+            changes = cls.since(seq, limit)
+            if changes or remaining <= 0:
+                return changes
+            db.session.rollback()  # don't hold a connection while waiting
+            interval = min(remaining, poll_interval)
+            with change_signal:
+                change_signal.wait(interval)
+            remaining -= interval
+
+    @classmethod
+    def compact(cls, older_than):
+        """
+        Keeps the change log bounded
+
+        Entries older than older_than that were superseded by a newer entry
+        of the same promotion are removed, and so are old entries of
+        promotions that are gone. What is left is the latest entry of every
+        promotion plus the recent history, so a consumer that replays the
+        log from the start still ends with the current state, as long as it
+        does not fall further behind than older_than.
+
+        Returns:
+            the number of removed entries
+        """
+        cutoff = datetime.now() - older_than
+        logger.info("Compacting promotion changes before %s", cutoff)
+        newer = db.aliased(cls)
+        superseded = db.session.query(newer.seq).filter(
+            newer.promotion_id == cls.promotion_id, newer.seq > cls.seq
+        )
+        removed = (
+            cls.query.filter(cls.changed_at < cutoff)
+            .filter(superseded.exists() | cls.operation.in_(cls.REMOVALS))
+            .delete(synchronize_session=False)
+        )
+        db.session.commit()
+        logger.info("Removed %d promotion changes", removed)
+        return removed
+
+
+# Fields that can be changed with Promotion.patch()
+PATCHABLE_FIELDS = (
+    "title",
+    "description",
+    "promo_code",
+    "promo_type",
+    "amount",
+    "start_date",
+    "end_date",
+    "is_site_wide",
+)
+
+# What the values of the fields of a patch must be, before they are set on
+# the Promotion; promo_type and the dates are checked while they are parsed
+PATCH_CHECKS = {
+    "title": lambda value: isinstance(value, str) and 0 < len(value) <= 63,
+    "description": lambda value: value is None or isinstance(value, str),
+    "promo_code": lambda value: value is None or (isinstance(value, str) and len(value) <= 63),
+    "amount": lambda value: (
+        isinstance(value, int) and not isinstance(value, bool) and -2 ** 31 <= value < 2 ** 31
+    ),
+    "is_site_wide": lambda value: isinstance(value, bool),
+}
+
+# Keys of a patch that change the products of a Promotion (or are ignored)
+PATCHABLE_PRODUCTS = ("id", "products", "products_add", "products_remove")
+
+# Fields that change which promotion is best for a product
+EVALUATED_FIELDS = (
+    "promo_code",
+    "promo_type",
+    "amount",
+    "start_date",
+    "end_date",
+    "is_site_wide",
+)
+
+
+def _product_id_list(data, field):
+    """ Validates a list of product ids in a request body """
+    product_ids = data.get(field, [])
+    if not isinstance(product_ids, list):
+        raise DataValidationError("Invalid promotion: {} must be a list".format(field))
+    try:
+        return [int(product_id) for product_id in product_ids if product_id != ""]
+    except (TypeError, ValueError):
+        raise DataValidationError(
+            "Invalid promotion: {} must contain product ids".format(field)
+        )
+
+
+def parse_date(text):
+    """ Parses an ISO 8601 date quickly, the other formats with dateutil """
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        return dateutil.parser.parse(text)
+
+
+def _date(data, field, kind="promotion"):
+    """ Parses a date of a request body or query, the database won't do it for us """
+    value = data[field]
+    if isinstance(value, str):
+        try:
+            value = parse_date(value)
+        except (ValueError, OverflowError):
+            pass
+    if not isinstance(value, datetime):
+        raise DataValidationError("Invalid {}: bad {}".format(kind, field))
+    # the columns are timestamps without time zone, like PostgreSQL drop it
+    return value.replace(tzinfo=None)
+
+
+def _values(args, field, parse):
+    """ Parses a query argument that is one value or several separated by commas """
+    value = args[field]
+    items = value if isinstance(value, (list, tuple, set)) else str(value).split(",")
+    try:
+        values = [parse(item.strip() if isinstance(item, str) else item) for item in items]
+    except (KeyError, ValueError):
+        values = []
+    if not values:
+        raise DataValidationError("Invalid query: bad {}".format(field))
+    return values
+
+
+def _promo_type(name):
+    """ The PromoType of a name, whatever its case """
+    return name if isinstance(name, PromoType) else PromoType[name.upper()]
+
+
+def _scalar(convert):
+    """ Parses the value of a query argument into its bound parameter """
+
+    def parse(args, name):
+        try:
+            return None, {name: convert(args[name])}
+        except (TypeError, ValueError):
+            raise DataValidationError("Invalid query: bad {}".format(name))
+
+    return parse
+
+
+def _listed(convert):
+    """ Parses the comma separated values of a query argument into its bound parameter """
+    return lambda args, name: (None, {name: _values(args, name, convert)})
+
+
+def _dated(args, name):
+    """ Parses the date of a query argument into its bound parameter """
+    return None, {name: _date(args, name, "query")}
+
+
+def _active(args, name):
+    """ Parses the active status, 0 or 1, any other value doesn't filter """
+    if args[name] not in ("0", "1"):
+        return None
+    return args[name], {"active_at": scheduler.snapshot().taken_at}
+
+
+def _text_query(args, name):
+    """ Parses a text search, whether it has no words is part of the plan """
+    search_query = textsearch.query(args[name], _dialect())
+    return search_query is None, {name: search_query}
+
+
+def _linked_to_products(cls):
+    """ Promotions linked to products, straight from the index of the link table """
+    links = cls.products.property.secondary
+    return cls.id.in_(
+        db.select([links.c.promotion_id]).where(
+            links.c.product_id.in_(bindparam("product", expanding=True))
+        )
+    )
+
+
+def _identity(value):
+    """ Values that are bound as they are """
+    return value
+
+
+# The filters of the query string arguments, in the order of the plans:
+# name -> (parses the value of the argument into a variant of the filter and
+#          its bound parameters,
+#          builds the criterion of a variant for a class of promotions)
+# The ranges include their start (min, after) and exclude their end (before).
+QUERY_FILTERS = OrderedDict(
+    [
+        ("id", (_listed(int), lambda cls, _: cls.id.in_(bindparam("id", expanding=True)))),
+        ("title", (_scalar(_identity), lambda cls, _: cls.title == bindparam("title"))),
+        (
+            "promo_code",
+            (_scalar(_identity), lambda cls, _: cls.promo_code == bindparam("promo_code")),
+        ),
+        (
+            "promo_type",
+            (
+                _listed(_promo_type),
+                lambda cls, _: cls.promo_type.in_(bindparam("promo_type", expanding=True)),
+            ),
+        ),
+        ("amount", (_scalar(int), lambda cls, _: cls.amount == bindparam("amount"))),
+        ("amount_min", (_scalar(int), lambda cls, _: cls.amount >= bindparam("amount_min"))),
+        ("amount_max", (_scalar(int), lambda cls, _: cls.amount <= bindparam("amount_max"))),
+        ("start_after", (_dated, lambda cls, _: cls.start_date >= bindparam("start_after"))),
+        ("start_before", (_dated, lambda cls, _: cls.start_date < bindparam("start_before"))),
+        ("end_after", (_dated, lambda cls, _: cls.end_date >= bindparam("end_after"))),
+        ("end_before", (_dated, lambda cls, _: cls.end_date < bindparam("end_before"))),
+        (
+            "is_site_wide",
+            (_scalar(_identity), lambda cls, _: cls.is_site_wide == bindparam("is_site_wide")),
+        ),
+        ("start_date", (_dated, lambda cls, _: cls.start_date == bindparam("start_date"))),
+        ("end_date", (_dated, lambda cls, _: cls.end_date == bindparam("end_date"))),
+        # promotions that last the number of days specified
+        ("duration", (_scalar(int), lambda cls, _: cls.duration_days == bindparam("duration"))),
+        (
+            "duration_min",
+            (_scalar(int), lambda cls, _: cls.duration_days >= bindparam("duration_min")),
+        ),
+        (
+            "duration_max",
+            (_scalar(int), lambda cls, _: cls.duration_days <= bindparam("duration_max")),
+        ),
+        (
+            "modified_since",
+            (_dated, lambda cls, _: cls.updated_at >= bindparam("modified_since")),
+        ),
+        ("active", (_active, lambda cls, active: cls.active_filter(active))),
+        ("product", (_listed(int), lambda cls, _: _linked_to_products(cls))),
+        (
+            "q",
+            (
+                _text_query,
+                lambda cls, empty: false()
+                if empty
+                else textsearch.match(cls.__table__.name, cls.id, bindparam("q"), _dialect()),
+            ),
+        ),
+    ]
+)
+
+
+def compile_args(args):
+    """
+    Returns the plan of the filters of query string arguments and their parameters
+
+    The plan only says which filters apply (and which variant for the
+    few that have several), not their values. Searches with the same
+    plan share one compiled query that their values are bound to.
+    """
+    plan, params = [_dialect()], {}
+    for name, (parse, _) in QUERY_FILTERS.items():
+        if args.get(name) is None:
+            continue
+        parsed = parse(args, name)
+        if parsed is not None:
+            plan.append((name, parsed[0]))
+            params.update(parsed[1])
+    return tuple(plan), params
+
+
+def _chunks(values, size=1000):
+    """ Splits a list in chunks that are small enough for an IN clause """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _promo_codes(promotions):
+    """ The promo codes of some promotions, for the logs """
+    return [promotion.promo_code for promotion in promotions]
+
+
+def price_breakpoints(candidates):
+    """
+    The prices where the choice of select_best_promo() among candidates may change
+
+    Only the value of FIXED promotions depends on the price, so the choice
+    can only change where one of them is worth as much as a promotion of
+    another type, or at 0 where their value changes sign.
+    """
+    fixed = {p.amount for p in candidates if p.promo_type == PromoType.FIXED}
+    if not fixed:
+        return []
+    others = {p.amount for p in candidates if p.promo_type == PromoType.DISCOUNT}
+    if any(p.promo_type == PromoType.BOGO for p in candidates):
+        others.add(50)
+    breakpoints = {0}
+    for amount in fixed:
+        breakpoints.update(amount * 100 / value for value in others if value)
+    return sorted(breakpoints)
+
+
+def select_best_promo(candidates, pricing):
+    """
+    Picks the Promotion that gives the biggest discount at a price
+
+    DISCOUNT is worth its amount in percent, BOGO is worth 50% and FIXED is
+    worth its amount relative to the price. Ties go to the first candidate.
+
+    Args:
+        candidates (iterable): objects with promo_type and amount attributes
+        pricing (int): the price of the product
+    """
+    best_promo, best_discount = None, 0
+    for p in candidates:
+        if p.promo_type == PromoType.DISCOUNT:
+            if p.amount > best_discount:
+                best_promo, best_discount = p, p.amount
+        elif p.promo_type == PromoType.BOGO and best_discount < 50:
+            best_promo, best_discount = p, 50
+        elif p.promo_type == PromoType.FIXED:
+            fixed_discount = (p.amount / pricing) * 100
+            if fixed_discount > best_discount:
+                best_promo, best_discount = p, fixed_discount
+    return best_promo
+
+
+# The caches below are shared by every request of the process, so they are
+# always loaded from the primary and never from a possibly lagging replica
+
+
+def _promo_code_rows():
+    """ Loads the rows needed to build the promo code index """
+    with primary():
+        return (
+            db.session.query(Promotion.id, Promotion.promo_code)
+            .filter(Promotion.promo_code.isnot(None))
+            .all()
+        )
+
+
+def _unfinished_promotion_rows(now):
+    """ Loads the rows needed to build the active set """
+    with primary():
+        return (
+            db.session.query(
+                Promotion.id,
+                Promotion.promo_code,
+                Promotion.promo_type,
+                Promotion.amount,
+                Promotion.is_site_wide,
+                Promotion.start_date,
+                Promotion.end_date,
+            )
+            .filter(Promotion.end_date >= now)
+            .all()
+        )
+
+
+def _shared_snapshot_rows():
+    """ Loads the promotions and product links of the shared snapshot """
+    now = datetime.now()
+    promotions = _unfinished_promotion_rows(now)
+    with primary():
+        links = (
+            db.session.query(
+                promotion_products.c.product_id, promotion_products.c.promotion_id
+            )
+            .join(Promotion, Promotion.id == promotion_products.c.promotion_id)
+            .filter(Promotion.end_date >= now)
+            .all()
+        )
+    return promotions, links
+
+
+def _active_set_rows(now):
+    """ Reads the rows of the active set from the shared snapshot if there is one """
+    if shared_snapshot.enabled:
+        return list(shared_snapshot.view().rows(now))
+    return _unfinished_promotion_rows(now)
+
+
+def _shared_version():
+    """
+    A number that changes whenever any worker changed the promotions
+
+    It is the generation of the shared snapshot when there is one, else
+    the "lists" stamp of the cache, which every write bumps after its
+    commit. While the cache is unreachable it changes every second, so
+    what depends on it is at most a second behind the other workers.
+    """
+    if shared_snapshot.enabled:
+        return shared_snapshot.generation()
+    try:
+        return cache.stamps(["lists"])[0]
+    except CacheError:
+        return ("unavailable", int(time.time()))
+
+
+# Snapshot of the unfinished promotions shared by the workers of a host,
+# only used when SHARED_SNAPSHOT_PATH is configured
+shared_snapshot = SharedSnapshot(_shared_snapshot_rows, PromoType)
+
+# In-process promo code -> promotion index, kept in sync by the write methods
+# and reloaded after the writes of other workers
+code_index = PromoCodeIndex(_promo_code_rows, version=_shared_version)
+
+# Precomputed active promotions, invalidated by the write methods and
+# rebuilt after the writes of other workers
+scheduler = BoundaryScheduler(_active_set_rows, version=_shared_version)
+
+
+# Compiled queries of the search plans, see compile_args()
+plans = baked.bakery(size=500)
+
+# Identical concurrent searches and best promotion lookups run only once
+flights = SingleFlight()
+
+# The best promotion of the products at each price band, see apply_best_promo()
+best_promos = LRUCache()
+
+# Read results cached in this worker and in the L2 configured by CACHE_URL,
+# invalidated by bumping the stamps of what a write changed
+cache = TieredCache()
+
+
+def _cached(key, stamp_names, compute, local=True):
+    """ Reads through the cache, except for reads served by a replica """
+    if reading_from_replica():
+        return compute()  # the replica may not have caught up with the stamps
+    return cache.fetch(key, stamp_names, compute, local)
+
+
+# Wakes up the requests waiting for new entries of the change log
+change_signal = threading.Condition()
+
+
+def _promotions_changed(promotion_ids=None):
+    """
+    Drops the active set after a write and republishes the shared snapshot
+
+    Args:
+        promotion_ids (list): the promotions that were written, None if it
+            was a bulk write that may have changed any of them
+    """
+    if promotion_ids is None:
+        lists = cache.bump(["all", "lists"])[1]
+    else:
+        lists = cache.bump(["lists"] + ["promotion:{}".format(i) for i in promotion_ids])[0]
+    scheduler.invalidate()
+    best_promos.clear()
+    flights.forget()  # don't hand out results read before the write
+    if shared_snapshot.enabled:
+        lists = shared_snapshot.publish().generation
+    # the code index already has the write, it only reloads for other workers'
+    code_index.written(lists)
+    with change_signal:
+        change_signal.notify_all()
+
+
+def clear_caches():
+    """ Drops the in-process lookup structures so they reload from the database """
+    code_index.clear()
+    scheduler.invalidate()
+    best_promos.clear()
+    flights.forget()
+    cache.clear()
+    cache.bump(["all", "lists"])
+
+
+def upgrade_db():
+    """
+    Adds the columns and indexes that db.create_all() skips on existing tables
+
+    create_all() only creates missing tables, so databases created by an
+    older version of the service would otherwise never get new columns or
+    indexes. New NOT NULL columns need a server_default for this to work.
+    The text search indexes are created here too, see service/textsearch.py.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                logger.info("Adding missing column %s.%s", table.name, column.name)
+                ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(dialect=engine.dialect)
+                )
+                if column.computed is not None:
+                    # filled in for the existing rows by the database, SQLite
+                    # can only add virtual ones but indexes them all the same
+                    ddl += " GENERATED ALWAYS AS ({}) {}".format(
+                        column.computed.sqltext.compile(dialect=engine.dialect),
+                        "VIRTUAL" if engine.dialect.name == "sqlite" else "STORED",
+                    )
+                elif column.server_default is not None:
+                    ddl += " DEFAULT {}".format(column.server_default.arg)
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                engine.execute(ddl)
+        with warnings.catch_warnings():
+            # the text search indexes are expressions, see textsearch.setup()
+            warnings.filterwarnings("ignore", "Skipped unsupported reflection of expression")
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info("Creating missing index %s", index.name)
+                index.create(bind=engine)
+    if engine.dialect.name == "sqlite" and Promotion.__tablename__ in existing_tables:
+        # AUTOINCREMENT can't be added to an existing SQLite table
+        ddl = engine.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            Promotion.__tablename__,
+        ).scalar()
+        if "AUTOINCREMENT" not in ddl.upper():
+            logger.warning(
+                "The promotion table reuses the ids of removed promotions, "
+                "recreate the database to stop it"
+            )
+    with engine.begin() as connection:
+        for table in (Promotion.__table__, ArchivedPromotion.__table__):
+            textsearch.setup(connection, table.name)
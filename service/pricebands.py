@@ -0,0 +1,62 @@
+"""
+Price Bands of the best promotion
+
+The best promotion among some candidates only depends on the price through
+the value of the FIXED ones, amount / price, which is compared with the
+values of the others, and those don't depend on the price. Between two
+consecutive prices where such a comparison can turn (the breakpoints),
+every comparison made by the selection has the same outcome, so the same
+promotion wins at every price of the band.
+
+PriceBands keeps the breakpoints of the candidates of a product, selects
+the best promotion of a band the first time one of its prices is asked
+for and answers the other prices of the band from memory. Prices at or
+very close to a breakpoint are always selected again, so that the
+rounding of the values never makes a band disagree with the selection.
+"""
+from bisect import bisect_right
+
+# prices closer than this, relatively, to a breakpoint are not memoized
+TOLERANCE = 1e-9
+
+
+class PriceBands:
+    """ The best promotion of some candidates, memoized per price band """
+
+    __slots__ = ("candidates", "breakpoints", "_select", "_winners")
+
+    _missing = object()
+
+    def __init__(self, candidates, select, breakpoints):
+        """
+        Args:
+            candidates (tuple): the immutable promotions to choose from
+            select (callable): select(candidates, price) returns the best one
+            breakpoints (iterable): the prices where the choice may change
+        """
+        self.candidates = candidates
+        self.breakpoints = sorted(breakpoints)
+        self._select = select
+        self._winners = {}  # band -> the best promotion, None included
+
+    def best(self, price):
+        """ Returns select(candidates, price), selected once per band """
+        band = bisect_right(self.breakpoints, price)
+        if self._near(band - 1, price) or self._near(band, price):
+            return self._select(self.candidates, price)
+        winner = self._winners.get(band, self._missing)
+        if winner is self._missing:
+            # selections of the same band are equal, racing threads can both store
+            winner = self._winners[band] = self._select(self.candidates, price)
+        return winner
+
+    def _near(self, index, price):
+        """ True if price is at or next to the breakpoint at index """
+        if not 0 <= index < len(self.breakpoints):
+            return False
+        breakpoint = self.breakpoints[index]
+        return abs(price - breakpoint) <= TOLERANCE * max(abs(price), abs(breakpoint))
+
+    def __len__(self):
+        """ The number of bands selected so far """
+        return len(self._winners)
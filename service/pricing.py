@@ -0,0 +1,139 @@
+"""
+Catalog Pricing
+
+Finds the best promotion of every (product, price) row of a catalog CSV,
+for what-if reports over millions of rows. The active promotions are
+loaded once and handed to a pool of worker processes, which price the
+catalog chunk by chunk with the same select_best_promo rules as
+Promotion.apply_best_promo, so nothing is queried per row.
+
+The input has product_id and price columns (a header row is optional),
+the output repeats them followed by the promo code of the best promotion,
+empty when no promotion applies.
+"""
+import csv
+import time
+import itertools
+import multiprocessing
+from datetime import datetime
+from service.models import (
+    Promotion,
+    db,
+    promotion_products,
+    scheduler,
+    select_best_promo,
+)
+from service.routing import primary
+
+HEADER = ["product_id", "price", "promo_code"]
+
+# the promotions of the current worker process, set by _init_worker
+_promotions = None
+
+
+def load_promotions(now=None):
+    """
+    Loads the promotions active at now, once for the whole catalog
+
+    Returns:
+        (site_wide, by_product): the site wide promotions and a dict of
+        product id -> its product specific promotions, both ordered by id
+        like the candidates of apply_best_promo
+    """
+    snapshot = scheduler.snapshot(now or datetime.now())
+    by_product = {}
+    with primary():
+        # only the links of the promotions of the snapshot, not of those that ended
+        links = (
+            db.session.query(
+                promotion_products.c.product_id, promotion_products.c.promotion_id
+            )
+            .join(Promotion, Promotion.id == promotion_products.c.promotion_id)
+            .filter(~Promotion.is_site_wide)
+            .filter(Promotion.start_date <= snapshot.taken_at)
+            .filter(Promotion.end_date >= snapshot.taken_at)
+            .order_by(promotion_products.c.promotion_id)
+        )
+        for product_id, promotion_id in links:
+            promotion = snapshot.promotions.get(promotion_id)
+            if promotion is not None:
+                by_product.setdefault(product_id, []).append(promotion)
+    return snapshot.site_wide, {
+        product_id: tuple(promotions) for product_id, promotions in by_product.items()
+    }
+
+
+def price_catalog(in_file, out_file, promotions, workers=None, chunk_size=10000, progress=None):
+    """
+    Writes the best promotion of every row of a catalog
+
+    Args:
+        in_file: the catalog CSV, opened for reading
+        out_file: where the priced CSV is written, row chunks as they are done
+        promotions (tuple): what load_promotions() returned
+        workers (int): number of worker processes, 1 prices in this process
+        chunk_size (int): rows sent to a worker at a time
+        progress (callable): called with (rows, seconds) after every chunk
+    Returns:
+        the number of priced rows
+    """
+    started = time.monotonic()
+    writer = csv.writer(out_file)
+    writer.writerow(HEADER)
+    chunks = _read_chunks(in_file, chunk_size)
+    if workers == 1:
+        _init_worker(promotions)
+        return _write(writer, map(_price_chunk, chunks), started, progress)
+    with multiprocessing.Pool(workers, _init_worker, (promotions,)) as pool:
+        return _write(writer, pool.imap(_price_chunk, chunks), started, progress)
+
+
+def _write(writer, results, started, progress):
+    """ Writes the priced chunks in input order as they come in """
+    rows = 0
+    for priced in results:
+        writer.writerows(priced)
+        rows += len(priced)
+        if progress:
+            progress(rows, time.monotonic() - started)
+    return rows
+
+
+def _read_chunks(in_file, chunk_size):
+    """ Streams the catalog in chunks of (line number, row) """
+    lines = enumerate(csv.reader(in_file), start=1)
+    first = next(lines, None)
+    if first is None:
+        return
+    if first[1] and first[1][0].strip().lower() == "product_id":
+        first = None  # a header row
+    lines = itertools.chain([first] if first else [], lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _init_worker(promotions):
+    """ Keeps the promotions of the catalog in the worker process """
+    global _promotions  # pylint: disable=global-statement
+    _promotions = promotions
+
+
+def _price_chunk(chunk):
+    """ Prices a chunk of catalog rows """
+    site_wide, by_product = _promotions
+    priced = []
+    for line, row in chunk:
+        try:
+            product_id, price = row[0].strip(), row[1].strip()
+            pricing = float(price)
+            candidates = site_wide + by_product.get(int(product_id), ())
+        except (IndexError, ValueError):
+            raise ValueError("line {}: expected a product id and a price".format(line))
+        if pricing <= 0:
+            raise ValueError("line {}: the price must be positive".format(line))
+        best_promo = select_best_promo(candidates, pricing)
+        priced.append([product_id, price, best_promo.promo_code if best_promo else ""])
+    return priced
@@ -0,0 +1,128 @@
+"""
+Read Replica Routing
+
+Sends the reads of GET endpoints to read replicas and everything else to
+the primary database. Replicas are configured as SQLALCHEMY_BINDS whose
+key starts with "replica" (see READ_REPLICA_URIS in config.py).
+
+A client that just wrote something reads from the primary for a short
+while afterwards (REPLICA_STICKY_SECONDS) so it always sees its own
+writes. The time of the last write travels in a cookie, which keeps it
+working no matter which worker or node serves the next request.
+"""
+import time
+import random
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from flask import request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from service import sqlite
+
+LAST_WRITE_COOKIE = "promotions_last_write"
+
+# the replica engine the current thread reads from, None means the primary
+_routing = threading.local()
+
+
+class RoutingSession(SignallingSession):
+    """ Session that reads from the replica selected for the current request """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = getattr(_routing, "replica", None)
+        if replica is not None and not self._flushing and not isinstance(clause, UpdateBase):
+            return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy object whose sessions can be routed to read replicas
+
+    SQLite engines are tuned on the way, see service.sqlite
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if sa_url.drivername == "sqlite":
+            sqlite.apply_engine_options(app.config, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("pragmas", None)
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if pragmas is not None:
+            sqlite.listen(engine, pragmas)
+        return engine
+
+    def replica_engines(self, app):
+        """ Returns the engines of the configured read replicas """
+        binds = app.config.get("SQLALCHEMY_BINDS") or {}
+        return [
+            self.get_engine(app, bind=key)
+            for key in sorted(binds)
+            if key.startswith("replica")
+        ]
+
+
+def reading_from_replica():
+    """ True if the reads of the current thread go to a replica """
+    return getattr(_routing, "replica", None) is not None
+
+
+@contextmanager
+def primary():
+    """ Forces the reads made inside the block to go to the primary """
+    replica = getattr(_routing, "replica", None)
+    _routing.replica = None
+    try:
+        yield
+    finally:
+        _routing.replica = replica
+
+
+def read_from_replica(db):
+    """
+    Decorator for read only endpoints that may be served by a replica
+
+    Falls back to the primary when no replica is configured or when the
+    client wrote something less than REPLICA_STICKY_SECONDS ago.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            app = db.get_app()
+            replicas = db.replica_engines(app)
+            if not replicas or _recently_wrote(app):
+                return function(*args, **kwargs)
+            _routing.replica = random.choice(replicas)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _routing.replica = None
+                db.session.close()  # give the replica connection back to the pool
+
+        return wrapper
+
+    return decorator
+
+
+def remember_write(response):
+    """ after_request hook that marks clients that just wrote something """
+    if request.method != "GET" and response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, "%.3f" % time.time(), httponly=True)
+    return response
+
+
+def _recently_wrote(app):
+    """ True if the client of the current request wrote within the window """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < app.config.get("REPLICA_STICKY_SECONDS", 0)
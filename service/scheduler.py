@@ -0,0 +1,150 @@
+"""
+Active Promotion Scheduler
+
+The set of active promotions only changes when a promotion starts or ends,
+so instead of comparing every row against datetime.now() on each request
+the scheduler keeps a precomputed snapshot of the active set together with
+the next instant at which it changes (the next boundary).
+
+Snapshots are immutable and replaced by a single reference assignment, so
+readers never see a half built snapshot. A snapshot is rebuilt lazily by
+the first request that arrives after the boundary, or after a write
+invalidated it. A snapshot is also rebuilt once the version shared by the
+processes moved, after another process wrote.
+"""
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# A promotion stops being active right after its end_date
+END_GRACE = timedelta(microseconds=1)
+
+
+class ActivePromotion:
+    """
+    Immutable read model of an active promotion, used to evaluate it
+
+    Only holds the fields the evaluation needs, in slots, so it is much
+    smaller and faster to read than a Promotion with its ORM state.
+    """
+
+    __slots__ = ("id", "promo_code", "promo_type", "amount", "is_site_wide")
+
+    def __init__(self, promotion_id, promo_code, promo_type, amount, is_site_wide):
+        set_field = object.__setattr__
+        set_field(self, "id", promotion_id)
+        set_field(self, "promo_code", promo_code)
+        set_field(self, "promo_type", promo_type)
+        set_field(self, "amount", amount)
+        set_field(self, "is_site_wide", is_site_wide)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ActivePromotion is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ActivePromotion is immutable")
+
+    def _fields(self):
+        return (self.id, self.promo_code, self.promo_type, self.amount, self.is_site_wide)
+
+    def __reduce__(self):
+        return (ActivePromotion, self._fields())
+
+    def __eq__(self, other):
+        if not isinstance(other, ActivePromotion):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return "<ActivePromotion %r id=[%s]>" % (self.promo_code, self.id)
+
+
+ActiveSet = namedtuple(
+    "ActiveSet", ["promotions", "site_wide", "taken_at", "next_boundary", "version"]
+)
+ActiveSet.__doc__ = """
+Snapshot of the active promotions
+
+- promotions: (dict) promotion id -> ActivePromotion
+- site_wide: (tuple) the active site wide promotions ordered by id
+- taken_at: (datetime) the instant the snapshot was computed for
+- next_boundary: (datetime) the snapshot is valid until this instant
+- version: the version of the shared data the snapshot was built from
+"""
+
+
+class BoundaryScheduler:
+    """ Serves the active promotion set and swaps it at each time boundary """
+
+    def __init__(self, loader, version=None):
+        """
+        Args:
+            loader (callable): called with now, returns the (id, promo_code,
+                promo_type, amount, is_site_wide, start_date, end_date) rows
+                of every promotion that has not ended yet
+            version (callable): returns a number that changes when another
+                process changed the promotions, None if nothing is shared
+        """
+        self._loader = loader
+        self._version = version or (lambda: 0)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """ Incremented on every write so rebuilds in flight can be discarded """
+        return self._generation
+
+    def snapshot(self, now=None):
+        """ Returns the active set for now, rebuilding it if a boundary passed """
+        now = now or datetime.now()
+        version = self._version()
+        snapshot = self._snapshot
+        if self._is_valid(snapshot, now, version):
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if self._is_valid(snapshot, now, version):
+                return snapshot  # another thread rebuilt it while we waited
+            generation = self._generation
+            snapshot = self._build(now, version)
+            if generation == self._generation:
+                self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        """ Drops the current snapshot after a write """
+        self._generation += 1
+        self._snapshot = None
+
+    @staticmethod
+    def _is_valid(snapshot, now, version):
+        """ True if the snapshot can be used at now """
+        return (
+            snapshot is not None
+            and snapshot.taken_at <= now < snapshot.next_boundary
+            and snapshot.version == version
+        )
+
+    def _build(self, now, version):
+        """ Computes the active set at now and the next boundary after it """
+        promotions, site_wide = {}, []
+        next_boundary = datetime.max
+        for row in self._loader(now):
+            promotion_id, promo_code, promo_type, amount, is_site_wide, start, end = row
+            if start > now:
+                next_boundary = min(next_boundary, start)
+                continue
+            next_boundary = min(next_boundary, end + END_GRACE)
+            promotion = ActivePromotion(
+                promotion_id, promo_code, promo_type, amount, is_site_wide
+            )
+            promotions[promotion_id] = promotion
+            if is_site_wide:
+                site_wide.append(promotion)
+        site_wide.sort(key=lambda promotion: promotion.id)
+        return ActiveSet(promotions, tuple(site_wide), now, next_boundary, version)
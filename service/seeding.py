@@ -0,0 +1,220 @@
+"""
+Synthetic Promotions
+
+Generates promotions and products with a configurable distribution, for
+benchmarks and load tests that need production sized data:
+
+- the mix of promo types and the ratio of site wide promotions
+- start dates spread around today and durations up to a maximum
+- a skewed (Pareto) number of products per promotion, most promotions
+  have a few products and some have a great many
+- the ratio of promotions with a unique promo code, the others share
+  codes from a small pool like real seasonal campaigns do
+
+Rows are bulk inserted in batches with COPY on PostgreSQL and with
+executemany elsewhere, bypassing the ORM.
+"""
+import io
+import csv
+import random
+from datetime import datetime, timedelta
+from service.models import (
+    Promotion,
+    Product,
+    ProductBestPromotion,
+    PromoType,
+    db,
+    promotion_products,
+    clear_caches,
+)
+
+SEASONS = ["Spring", "Summer", "Autumn", "Winter", "Holiday", "Weekend", "Flash"]
+THINGS = ["Sale", "Deal", "Savings", "Special", "Clearance", "Offer", "Bonanza"]
+SHARED_CODES = ["{}{}".format(season.upper(), year) for season in SEASONS for year in (20, 21)]
+
+PROMOTION_COLUMNS = [
+    "id",
+    "title",
+    "description",
+    "promo_code",
+    "promo_type",
+    "amount",
+    "start_date",
+    "end_date",
+    "is_site_wide",
+    "version",
+    "created_at",
+    "updated_at",
+]
+
+
+class Distribution:
+    """ The shape of the generated data """
+
+    def __init__(
+        self,
+        type_weights=None,
+        site_wide_ratio=0.05,
+        date_spread_days=365,
+        max_duration_days=90,
+        fan_out_alpha=1.2,
+        max_fan_out=1000,
+        unique_code_ratio=0.9,
+    ):
+        """
+        Args:
+            type_weights (dict): PromoType -> relative weight
+            site_wide_ratio (float): share of site wide promotions
+            date_spread_days (int): starts are spread this far around today
+            max_duration_days (int): the longest a promotion lasts
+            fan_out_alpha (float): Pareto shape of the products per promotion,
+                smaller is more skewed
+            max_fan_out (int): the most products a promotion has
+            unique_code_ratio (float): share of promotions with their own code
+        """
+        self.type_weights = type_weights or {
+            PromoType.DISCOUNT: 6,
+            PromoType.FIXED: 3,
+            PromoType.BOGO: 1,
+        }
+        self.site_wide_ratio = site_wide_ratio
+        self.date_spread_days = date_spread_days
+        self.max_duration_days = max_duration_days
+        self.fan_out_alpha = fan_out_alpha
+        self.max_fan_out = max_fan_out
+        self.unique_code_ratio = unique_code_ratio
+
+
+def generate_promotions(count, first_id, product_ids, distribution, rng, now=None):
+    """
+    Yields (promotion row, linked product ids) for count promotions
+
+    Args:
+        count (int): how many promotions to generate
+        first_id (int): the id of the first promotion
+        product_ids (list): the products promotions can be linked to
+        distribution (Distribution): the shape of the data
+        rng (random.Random): the source of randomness, seed it to repeat a run
+    """
+    now = now or datetime.now()
+    types = list(distribution.type_weights)
+    weights = [distribution.type_weights[promo_type] for promo_type in types]
+    max_fan_out = min(distribution.max_fan_out, len(product_ids))
+    for promotion_id in range(first_id, first_id + count):
+        promo_type = rng.choices(types, weights)[0]
+        if promo_type == PromoType.DISCOUNT:
+            amount = rng.randint(5, 70)
+        elif promo_type == PromoType.FIXED:
+            amount = rng.randint(1, 100)
+        else:
+            amount = 1
+        start = now + timedelta(
+            days=rng.uniform(-distribution.date_spread_days, distribution.date_spread_days)
+        )
+        end = start + timedelta(days=rng.uniform(1, distribution.max_duration_days))
+        if rng.random() < distribution.unique_code_ratio:
+            promo_code = "P{}X{:04X}".format(promotion_id, rng.randrange(0x10000))
+        else:
+            promo_code = rng.choice(SHARED_CODES)
+        is_site_wide = rng.random() < distribution.site_wide_ratio
+        linked = []
+        if not is_site_wide and max_fan_out:
+            fan_out = min(max_fan_out, int(rng.paretovariate(distribution.fan_out_alpha)))
+            linked = rng.sample(product_ids, fan_out)
+        row = {
+            "id": promotion_id,
+            "title": "{} {} {}".format(rng.choice(SEASONS), rng.choice(THINGS), promotion_id),
+            "description": "Generated promotion",
+            "promo_code": promo_code,
+            "promo_type": promo_type.name,
+            "amount": amount,
+            "start_date": start,
+            "end_date": end,
+            "is_site_wide": is_site_wide,
+            "version": 1,
+            "created_at": now,
+            "updated_at": now,
+        }
+        yield row, linked
+
+
+def seed(promotions, products, distribution=None, random_seed=None, batch_size=50000):
+    """
+    Inserts generated promotions and products next to the existing ones
+
+    The materialized best promotions are recomputed and the in-process
+    caches dropped afterwards. The change log is not written.
+
+    Returns:
+        the number of inserted promotion_products rows
+    """
+    distribution = distribution or Distribution()
+    rng = random.Random(random_seed)
+    first_product = (db.session.query(db.func.max(Product.id)).scalar() or 0) + 1
+    product_ids = list(range(first_product, first_product + products))
+    for start in range(0, len(product_ids), batch_size):
+        _bulk_insert(
+            Product.__table__, ["id"], [[i] for i in product_ids[start:start + batch_size]]
+        )
+    first_promotion = (db.session.query(db.func.max(Promotion.id)).scalar() or 0) + 1
+    rows, links, linked = [], [], 0
+    for row, product_batch in generate_promotions(
+        promotions, first_promotion, product_ids, distribution, rng
+    ):
+        rows.append([row[column] for column in PROMOTION_COLUMNS])
+        links += [[row["id"], product_id] for product_id in product_batch]
+        if len(rows) >= batch_size or len(links) >= batch_size:
+            linked += _flush(rows, links)
+            rows, links = [], []
+    linked += _flush(rows, links)
+    _sync_sequence(Promotion.__table__)
+    db.session.commit()
+    ProductBestPromotion.refresh_all()
+    clear_caches()
+    return linked
+
+
+def _flush(rows, links):
+    """ Inserts a batch of promotions and then their product links """
+    _bulk_insert(Promotion.__table__, PROMOTION_COLUMNS, rows)
+    _bulk_insert(promotion_products, ["promotion_id", "product_id"], links)
+    return len(links)
+
+
+def _bulk_insert(table, columns, rows):
+    """ Inserts rows (lists ordered like columns) with COPY when possible """
+    if not rows:
+        return
+    connection = db.session.connection()
+    if connection.dialect.name != "postgresql":
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+        return
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [[_copy_value(value) for value in row] for row in rows]
+    )
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table.name, ", ".join(columns)),
+        buffer,
+    )
+
+
+def _copy_value(value):
+    """ Formats a value for COPY, which spells booleans and dates its own way """
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def _sync_sequence(table):
+    """ Moves the id sequence past the explicitly inserted ids """
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "(SELECT COALESCE(MAX(id), 0) + 1 FROM {0}), false)".format(table.name)
+        )
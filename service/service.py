@@ -5,18 +5,34 @@ Paths:
 ------
 GET / - Returns the UI and 200 code, for Selenium testing
 POST /promotions - creates a new Promotion record in the database
+GET /promotions/redeem/{promo_code} - returns the active Promotion for a promo code
+DELETE /promotions - deletes the Promotions matching the query string, all=true for every one
+POST /promotions/cancel - cancels the Promotions matching an id list or the query string, all=true for every one
+GET /promotions/changes - returns the changes made since a sequence number, long polling
 """
 # pylint: disable=R0201
-from datetime import datetime
+import math
+import threading
 from flask import Flask, jsonify, request, url_for, make_response, abort
 from flask_api import status  # HTTP Status Codes
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Promotion, DataValidationError, Product
+from service.models import (
+    Promotion,
+    PromotionChange,
+    DataValidationError,
+    VersionConflictError,
+    Product,
+    db,
+)
+from service.routing import read_from_replica, remember_write
+from service.singleflight import FlightTimeout
+from service.log import lazy
 
 # Import Flask application
 from . import app
@@ -31,6 +47,10 @@ def index():
     return app.send_static_file("index.html")
 
 
+# Reads stick to the primary for a while after a client's own write
+app.after_request(remember_write)
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -81,6 +101,23 @@ create_model = api.model(
     },
 )
 
+patch_model = api.inherit(
+    'PromotionPatch',
+    create_model,
+    {
+        'products_add': fields.List(
+            cls_or_instance=fields.Integer,
+            required=False,
+            description='Products to associate with the promotion.',
+        ),
+        'products_remove': fields.List(
+            cls_or_instance=fields.Integer,
+            required=False,
+            description='Products to no longer associate with the promotion.',
+        ),
+    },
+)
+
 promotion_model = api.inherit(
     'PromotionModel',
     create_model,
@@ -97,7 +134,7 @@ promotion_model = api.inherit(
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
-    app.logger.error(str(error))
+    app.logger.error("%s", error, extra={"status_code": status.HTTP_400_BAD_REQUEST})
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': 'Bad Request',
@@ -105,19 +142,63 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """ Handles writes whose If-Match precondition failed """
+    app.logger.warning("%s", error, extra={"status_code": status.HTTP_412_PRECONDITION_FAILED})
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': str(error),
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
+@api.errorhandler(FlightTimeout)
+def flight_timeout_error(error):
+    """ Handles reads that waited too long for an identical request """
+    app.logger.warning("%s", error, extra={"status_code": status.HTTP_503_SERVICE_UNAVAILABLE})
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': str(error),
+    }, status.HTTP_503_SERVICE_UNAVAILABLE
+
+
 # query string arguments
 # --------------------------------------------------------------------------------------------------
 promotion_args = reqparse.RequestParser()
+promotion_args.add_argument('id', type=str, required=False, location='args', help='List Promotions by id, several separated by commas')
 promotion_args.add_argument('title', type=str, required=False, location='args', help='List Promotions by title')
 promotion_args.add_argument('promo_code', type=str, required=False, location='args', help='List Promotions by promo code')
-promotion_args.add_argument('promo_type', type=str, required=False, location='args', help='List Promotions by promo type')
+promotion_args.add_argument('promo_type', type=str, required=False, location='args', help='List Promotions by promo type, several separated by commas')
 promotion_args.add_argument('amount', type=int, required=False, location='args', help='List Promotions by the amount discounted')
 promotion_args.add_argument('start_date', type=str, required=False, location='args', help='List Promotions by start date')
 promotion_args.add_argument('end_date', type=str, required=False, location='args', help='List Promotions by end date')
+promotion_args.add_argument('amount_min', type=int, required=False, location='args', help='List Promotions whose amount is at least this')
+promotion_args.add_argument('amount_max', type=int, required=False, location='args', help='List Promotions whose amount is at most this')
+promotion_args.add_argument('start_after', type=str, required=False, location='args', help='List Promotions starting at or after this date')
+promotion_args.add_argument('start_before', type=str, required=False, location='args', help='List Promotions starting before this date')
+promotion_args.add_argument('end_after', type=str, required=False, location='args', help='List Promotions ending at or after this date')
+promotion_args.add_argument('end_before', type=str, required=False, location='args', help='List Promotions ending before this date')
 promotion_args.add_argument('duration', type=int, required=False, location='args', help='List Promotions by duration')
+promotion_args.add_argument('duration_min', type=int, required=False, location='args', help='List Promotions lasting at least this many days')
+promotion_args.add_argument('duration_max', type=int, required=False, location='args', help='List Promotions lasting at most this many days')
 promotion_args.add_argument('active', type=str, required=False, location='args', help='List Promotions by active status')
-promotion_args.add_argument('is_site_wide', type=str, required=False, location='args', help='List Promotions by site wide status')
-promotion_args.add_argument('product', type=int, required=False, location='args', help='List Promotions by a product')
+promotion_args.add_argument('is_site_wide', type=inputs.boolean, required=False, location='args', help='List Promotions by site wide status')
+promotion_args.add_argument('product', type=str, required=False, location='args', help='List Promotions by product, several separated by commas')
+promotion_args.add_argument('modified_since', type=str, required=False, location='args', help='List Promotions written at or after this date')
+promotion_args.add_argument('include_archived', type=inputs.boolean, required=False, location='args', help='Also list archived Promotions')
+promotion_args.add_argument('q', type=str, required=False, location='args', help='List Promotions whose title, promo code or description contain these words, best matches first')
+promotion_args.add_argument('page', type=int, required=False, location='args', help='The page of the results to list, starting at 1')
+promotion_args.add_argument('per_page', type=int, required=False, location='args', help='List at most this many Promotions, all of them by default or SEARCH_PAGE_SIZE with q')
+
+# query string arguments of the bulk writes, parsed strictly: a misspelled
+# or invalid filter must not widen them to every promotion
+bulk_args = promotion_args.copy()
+for name in ('page', 'per_page', 'include_archived'):
+    bulk_args.remove_argument(name)
+bulk_args.replace_argument('active', type=str, required=False, choices=('0', '1'), location='args', help='Only the Promotions with this active status, 0 or 1')
+bulk_args.add_argument('all', type=inputs.boolean, required=False, default=False, location='args', help='Needed to change every Promotion when no other argument filters them')
 
 
 ######################################################################
@@ -132,6 +213,7 @@ class PromotionResource(Resource):
     Allows the retrieval/manipulation of a single promotion
     GET /promotion/{id}     - Retrieves the promotion with the id
     PUT /promotion/{id}     - Update the promotion with the id
+    PATCH /promotion/{id}   - Update some fields or products of the promotion with the id
     DELETE /promotion/{id}  - Delete the promotion with the id
     """
 
@@ -140,20 +222,22 @@ class PromotionResource(Resource):
     ######################################################################
     @api.doc('get_promotions')
     @api.response(404, 'Promotion not found')
+    @api.header('ETag', 'The version of the promotion, for If-Match')
     @api.marshal_with(promotion_model)
+    @read_from_replica(db)
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
         This endpoint will return a Promotion based on it's id
         """
         app.logger.info("Request for promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
+        found = Promotion.read(promotion_id)
+        if not found:
             api.abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promotion_id}' was not found.",
             )
-        return promotion.serialize(), status.HTTP_200_OK
+        return found["promotion"], status.HTTP_200_OK, etag_header(found["version"])
 
     ######################################################################
     # UPDATE AN EXISTING PROMOTION
@@ -161,6 +245,7 @@ class PromotionResource(Resource):
     @api.doc('update_promotions')
     @api.response(404, 'Promotion not found')
     @api.response(400, 'The posted data was not valid')
+    @api.response(412, 'The promotion changed since the If-Match version')
     @api.expect(promotion_model)
     @api.marshal_with(promotion_model)
     def put(self, promotion_id):
@@ -177,6 +262,7 @@ class PromotionResource(Resource):
                 status.HTTP_404_NOT_FOUND,
                 "Promotion with id '{}' was not found.".format(promotion_id),
             )
+        promotion.check_version(if_match_versions())
         json = request.get_json()
         if "products" in json:
             for product_id in json["products"]:
@@ -186,7 +272,34 @@ class PromotionResource(Resource):
         promotion.id = promotion_id
         promotion.update()
         app.logger.info("Promotion with ID [%s] updated.", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, etag_header(promotion.version)
+
+    ######################################################################
+    # PARTIALLY UPDATE AN EXISTING PROMOTION
+    ######################################################################
+    @api.doc('patch_promotions')
+    @api.response(404, 'Promotion not found')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(412, 'The promotion changed since the If-Match version')
+    @api.expect(patch_model)
+    @api.marshal_with(promotion_model)
+    def patch(self, promotion_id):
+        """
+        Partially update a Promotion
+        This endpoint will only change the fields and products given in the body
+        """
+        app.logger.info("Request to patch promotion with id: %s", promotion_id)
+        check_content_type("application/json")
+        promotion = Promotion.find(promotion_id, products="lazy")
+        if not promotion:
+            api.abort(
+                status.HTTP_404_NOT_FOUND,
+                "Promotion with id '{}' was not found.".format(promotion_id),
+            )
+        promotion.check_version(if_match_versions())
+        promotion.patch(request.get_json())
+        app.logger.info("Promotion with ID [%s] patched.", promotion.id)
+        return promotion.serialize(), status.HTTP_200_OK, etag_header(promotion.version)
 
     ######################################################################
     # DELETE A PROMOTION
@@ -201,7 +314,7 @@ class PromotionResource(Resource):
         """
         # pylint: disable=R1705
         app.logger.info('Request to Delete a promotion with id [%s]', promotion_id)
-        promo = Promotion.find(promotion_id)
+        promo = Promotion.find(promotion_id, products="noload")
         if promo:
             promo.delete()
             return '', status.HTTP_204_NO_CONTENT
@@ -222,6 +335,7 @@ class PromotionCollection(Resource):
     @api.doc('list_promotions')
     @api.expect(promotion_args, validate=True)
     @api.marshal_list_with(promotion_model)
+    @read_from_replica(db)
     def get(self):
         """ Returns all of the Promotions """
         args = promotion_args.parse_args()
@@ -238,10 +352,45 @@ class PromotionCollection(Resource):
             "active",
             "product",
         ]
-        promotions = Promotion.find_by_query_string(args)
-        results = [promo.serialize() for promo in promotions]
+        if (args["page"] is not None and args["page"] < 1) or (
+            args["per_page"] is not None and args["per_page"] < 1
+        ):
+            raise DataValidationError("Invalid page: page and per_page start at 1")
+        if args["q"] is not None and args["per_page"] is None:
+            args["per_page"] = app.config["SEARCH_PAGE_SIZE"]
+        if args["per_page"] is not None:
+            args["per_page"] = min(args["per_page"], app.config["MAX_PAGE_SIZE"])
+            args["page"] = args["page"] or 1
+        # identical concurrent requests share one search
+        results = Promotion.search(args, timeout=app.config["SINGLE_FLIGHT_TIMEOUT"])
         app.logger.info("Returning %d promotions", len(results))
-        return results, status.HTTP_200_OK
+        headers = {}
+        if args["per_page"] is not None and len(results) == args["per_page"]:
+            next_page = request.args.to_dict()
+            next_page.update(page=args["page"] + 1, per_page=args["per_page"])
+            headers["Link"] = '<{}>; rel="next"'.format(
+                url_for(request.endpoint, _external=True, **next_page)
+            )
+        return results, status.HTTP_200_OK, headers
+
+    # ------------------------------------------------------------------
+    # DELETE PROMOTIONS IN BULK
+    # ------------------------------------------------------------------
+    @api.doc('delete_all_promotions')
+    @api.expect(bulk_args, validate=True)
+    @api.response(200, 'Promotions deleted')
+    @api.response(400, 'The query string was not valid or had no filter')
+    def delete(self):
+        """
+        Deletes Promotions in bulk
+        This endpoint will delete every Promotion matching the query string,
+        all=true deletes them all
+        """
+        args = parse_strictly(bulk_args)
+        app.logger.info("Request to delete promotions based on query string %s ...", args)
+        deleted = Promotion.delete_matching(args, everything=args.pop("all"))
+        app.logger.info("Deleted %d promotions", deleted)
+        return {"deleted": deleted}, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
@@ -250,6 +399,7 @@ class PromotionCollection(Resource):
     @api.expect(create_model)
     @api.response(400, 'The posted data was not valid')
     @api.response(201, 'Promotion created successfully')
+    @api.header('ETag', 'The version of the promotion, for If-Match')
     @api.marshal_with(promotion_model, code=201)
     def post(self):
         """
@@ -270,11 +420,9 @@ class PromotionCollection(Resource):
             PromotionResource, promotion_id=promotion.id, _external=True
         )
         app.logger.info("Promotion with ID [%s] created.", promotion.id)
-        return (
-            promotion.serialize(),
-            status.HTTP_201_CREATED,
-            {"Location": location_url},
-        )
+        headers = etag_header(promotion.version)
+        headers["Location"] = location_url
+        return promotion.serialize(), status.HTTP_201_CREATED, headers
 
 
 ######################################################################
@@ -286,21 +434,151 @@ class PromotionCancellation(Resource):
     @api.doc('cancel_promotions')
     @api.response(404, 'Promotion not found')
     @api.response(200, 'Promotion cancelled')
+    @api.response(412, 'The promotion changed since the If-Match version')
     def post(self, promotion_id):
         """
         Cancels a single Promotion
         This endpoint will cancel a Promotion based on it's id
         """
         app.logger.info("Request to cancel Promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
+        if not Promotion.cancel(promotion_id, if_match_versions()):
             raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
-        promotion.end_date = datetime.now()
-        promotion.update()
         app.logger.info("Promotion with ID [%s] cancelled", promotion_id)
         return make_response("", status.HTTP_200_OK)
 
 
+######################################################################
+#  CANCEL PROMOTIONS IN BULK - /promotions/cancel
+######################################################################
+cancel_model = api.model(
+    'PromotionCancellation',
+    {
+        'ids': fields.List(
+            cls_or_instance=fields.Integer,
+            required=False,
+            description='Only cancel the Promotions with these ids.',
+        ),
+    },
+)
+
+
+@api.route("/promotions/cancel")
+class PromotionBulkCancellation(Resource):
+    @api.doc('cancel_all_promotions')
+    @api.expect(bulk_args, cancel_model)
+    @api.response(200, 'Promotions cancelled')
+    @api.response(400, 'The posted data or the query string was not valid, or had no filter')
+    def post(self):
+        """
+        Cancels Promotions in bulk
+        This endpoint will cancel the Promotions matching the query string and,
+        if the body has an ids list, with one of those ids; all=true cancels
+        them all
+        """
+        args = parse_strictly(bulk_args)
+        json = request.get_json(silent=True)
+        if json is None:
+            json = {}
+        if not isinstance(json, dict) or set(json) - {"ids"}:
+            raise DataValidationError("Invalid cancellation: the body can only have ids")
+        promotion_ids = json.get("ids")
+        if promotion_ids is not None and (
+            not isinstance(promotion_ids, list)
+            or not all(isinstance(i, int) for i in promotion_ids)
+        ):
+            raise DataValidationError("Invalid cancellation: ids must be a list of integers")
+        app.logger.info("Request to cancel promotions %s %s", args, promotion_ids or "")
+        cancelled = Promotion.cancel_matching(args, promotion_ids, everything=args.pop("all"))
+        app.logger.info("Cancelled %d promotions", cancelled)
+        return {"cancelled": cancelled}, status.HTTP_200_OK
+
+
+######################################################################
+#  CHANGE FEED - /promotions/changes
+######################################################################
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=int, required=False, default=0, location='args', help='Only return changes after this sequence number')
+change_args.add_argument('limit', type=int, required=False, default=100, location='args', help='Return at most this many changes')
+change_args.add_argument('wait', type=float, required=False, default=0, location='args', help='Seconds to wait for a change when there is none yet')
+
+# Every long poll holds a thread of the worker until a change arrives, the
+# threads beyond CHANGES_MAX_WAITERS are left to the rest of the API
+long_polls = threading.BoundedSemaphore(app.config.get("CHANGES_MAX_WAITERS", 4))
+
+
+@api.route("/promotions/changes")
+class PromotionChangeFeed(Resource):
+    @api.doc('list_promotion_changes')
+    @api.expect(change_args, validate=True)
+    @api.response(400, 'The query string was not valid')
+    def get(self):
+        """
+        Returns the changes made to Promotions after a sequence number
+        Each change carries the current state of the promotion, null when it
+        is gone. Pass the last_seq of a response as since to get the next
+        batch; with wait the request is held until a change arrives, unless
+        too many requests wait already: it is answered at once with a
+        Retry-After header then.
+        """
+        args = change_args.parse_args()
+        if args["since"] < 0 or args["limit"] < 1 or args["wait"] < 0:
+            raise DataValidationError("Invalid change query: since, limit and wait can't be negative")
+        limit = min(args["limit"], app.config["CHANGES_MAX_BATCH"])
+        wait = min(args["wait"], app.config["CHANGES_MAX_WAIT"])
+        app.logger.info("Request for promotion changes since %s", args["since"])
+        headers = {}
+        waiting = wait > 0 and long_polls.acquire(blocking=False)
+        if wait > 0 and not waiting:
+            app.logger.warning("Too many long polls, answering without waiting")
+            wait = 0
+            headers["Retry-After"] = str(math.ceil(app.config["CHANGES_POLL_INTERVAL"]))
+        try:
+            changes = PromotionChange.wait_since(
+                args["since"], limit, wait, app.config["CHANGES_POLL_INTERVAL"]
+            )
+        finally:
+            if waiting:
+                long_polls.release()
+        promotions = {
+            promotion.id: promotion.serialize()
+            for promotion in Promotion.find_by_ids(
+                {change.promotion_id for change in changes}
+            )
+        }
+        results = []
+        for change in changes:
+            result = change.serialize()
+            result["promotion"] = promotions.get(change.promotion_id)
+            results.append(result)
+        last_seq = changes[-1].seq if changes else args["since"]
+        app.logger.info("Returning %d changes", len(results))
+        return {"changes": results, "last_seq": last_seq}, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  REDEEM A PROMO CODE - /promotions/redeem/{promo_code}
+######################################################################
+@api.route("/promotions/redeem/<string:promo_code>")
+@api.param('promo_code', 'The promo code entered by the customer')
+class PromotionRedemption(Resource):
+    @api.doc('redeem_promotions')
+    @api.response(404, 'No active promotion with that promo code')
+    @api.marshal_with(promotion_model)
+    def get(self, promo_code):
+        """
+        Looks up the active Promotion for a promo code
+        This endpoint is meant for checkout and only returns active promotions
+        """
+        app.logger.info("Request to redeem promo code: %s", promo_code)
+        promotion = Promotion.find_by_promo_code(promo_code)
+        if not promotion:
+            api.abort(
+                status.HTTP_404_NOT_FOUND,
+                f"No active promotion with promo code '{promo_code}'.",
+            )
+        return promotion.serialize(), status.HTTP_200_OK
+
+
 @api.route('/promotions/apply', strict_slashes=False)
 class PromotionCollection(Resource):
 
@@ -308,20 +586,23 @@ class PromotionCollection(Resource):
     # APPLY BEST PROMOTION
     ######################################################################
     @api.doc('apply_best_promotions')
+    @read_from_replica(db)
     def get(self):
         """
         Apply best promotions
         """
-        app.logger.info("Apply best promotions")
-        app.logger.info(request.args)
-        if len(request.args) > 0:
-            results = [
-                Promotion.apply_best_promo(product, int(request.args.get(product)))
-                for product in request.args
-            ]
-            results = list(filter(None, results))
-        else:
-            results = []
+        app.logger.info("Apply best promotions", extra={"prices": lazy(request.args.to_dict)})
+        try:
+            prices = {int(product): int(price) for product, price in request.args.items()}
+        except ValueError:
+            raise DataValidationError("Invalid cart: product ids and prices must be integers")
+        if any(price <= 0 for price in prices.values()):
+            # FIXED promotions are worth their amount relative to the price
+            raise DataValidationError("Invalid cart: prices must be positive")
+        # identical concurrent requests share one evaluation
+        results = Promotion.apply_best_promos(
+            prices, timeout=app.config["SINGLE_FLIGHT_TIMEOUT"]
+        )
         app.logger.info("Returning %d results.", len(results))
         return results, status.HTTP_200_OK
 
@@ -335,6 +616,35 @@ def init_db():
     Promotion.init_db(app)
 
 
+def parse_strictly(parser):
+    """ Parses the query string, refusing the arguments the parser doesn't know """
+    unknown = set(request.args) - {argument.name for argument in parser.args}
+    if unknown:
+        raise DataValidationError(
+            "Invalid query: unknown argument " + ", ".join(sorted(unknown))
+        )
+    return parser.parse_args()
+
+
+def etag_header(version):
+    """ Returns the ETag header carrying the version of a Promotion """
+    return {"ETag": quote_etag(str(version))}
+
+
+def if_match_versions():
+    """ Returns the versions allowed by the If-Match header, None if any is """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = []
+    for etag in if_match.as_set():
+        try:
+            versions.append(int(etag))
+        except ValueError:
+            pass  # can't be one of our versions
+    return versions
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -0,0 +1,89 @@
+"""
+Request Coalescing
+
+When identical reads arrive at the same time (a flash sale sends thousands
+of shoppers to the same URLs within milliseconds) only the first one runs
+its queries. The others wait for it and get the same result, or the same
+exception, instead of sending the same queries again.
+
+Only calls that are in flight are shared, nothing is cached: a call that
+starts after the previous one finished runs again. After a write forget()
+makes the next calls start afresh, so a client never joins a computation
+that began before its own write.
+"""
+import threading
+
+
+class FlightTimeout(Exception):
+    """ Used when a shared computation did not finish in time """
+
+
+class _Call:
+    """ A computation in flight and what the waiters need to get its outcome """
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Runs a function once for all the concurrent callers with the same key """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, timeout=None):
+        """
+        Returns function(), sharing it with the concurrent calls with this key
+
+        Args:
+            key (hashable): identifies identical calls, see normalize()
+            function (callable): computes the result, called without arguments
+            timeout (float): seconds to wait for a call in flight, None waits
+                as long as it takes
+        Raises:
+            FlightTimeout: the call in flight did not finish in time
+            whatever function() raised, also in the callers that waited for it
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(timeout):
+                raise FlightTimeout("Gave up waiting for an identical request after %ss" % timeout)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self):
+        """ Makes the next calls start new computations instead of joining one """
+        with self._lock:
+            self._calls = {}
+
+
+def normalize(name, args):
+    """
+    Returns a key for calls of name with some arguments
+
+    Arguments that are not set don't matter and their order doesn't either.
+    """
+    return (name,) + tuple(
+        sorted((key, str(value)) for key, value in args.items() if value is not None)
+    )
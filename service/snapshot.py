@@ -0,0 +1,281 @@
+"""
+Shared Promotion Snapshot
+
+With several gunicorn workers each process would load the promotions that
+have not ended yet, and the products they apply to, into its own memory.
+The shared snapshot is built once, written to a file and memory-mapped by
+every worker, which reads it in place without copying or parsing it.
+
+File layout, every number is a native int64:
+
+- header: magic, format, generation and the number of promotions (n),
+  products (m), links (k) and promo code bytes
+- promotions: one array of n values per column in PROMOTION_COLUMNS,
+  ordered by promotion id, dates in microseconds since the epoch
+- products: the m sorted product ids, m + 1 offsets into the links and
+  the k links, which are indexes into the promotion arrays (CSR style)
+- the utf-8 promo codes, sliced with code_start and code_end
+
+A new snapshot is written aside and renamed over the old one, then its
+generation is stored in a small memory-mapped counter file. Readers compare
+the counter with the generation of the file they mapped and switch to the
+new file once it moved on.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+MAGIC = int.from_bytes(b"PROMOSNP", "little")
+FORMAT = 1
+
+HEADER = struct.Struct("=7q")
+COUNTER = struct.Struct("=q")
+ITEM_SIZE = 8
+
+PROMOTION_COLUMNS = (
+    "ids",
+    "promo_types",
+    "amounts",
+    "site_wide",
+    "starts",
+    "ends",
+    "code_start",
+    "code_end",
+)
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(value):
+    """ Converts a naive datetime to microseconds since the epoch """
+    return (value - EPOCH) // MICROSECOND
+
+
+def from_micros(value):
+    """ Converts microseconds since the epoch back to a naive datetime """
+    return EPOCH + timedelta(microseconds=value)
+
+
+def encode(generation, promotions, links):
+    """
+    Serializes promotions and their product links in the snapshot format
+
+    Args:
+        generation (int): the generation stored in the header
+        promotions (iterable): (id, promo_code, promo_type, amount,
+            is_site_wide, start_date, end_date) rows
+        links (iterable): (product_id, promotion_id) pairs
+    """
+    promotions = sorted(promotions, key=lambda row: row[0])
+    columns = {name: array("q") for name in PROMOTION_COLUMNS}
+    codes = bytearray()
+    index = {}
+    for row in promotions:
+        promotion_id, promo_code, promo_type, amount, is_site_wide, start, end = row
+        index[promotion_id] = len(columns["ids"])
+        columns["ids"].append(promotion_id)
+        columns["promo_types"].append(promo_type.value)
+        columns["amounts"].append(amount)
+        columns["site_wide"].append(1 if is_site_wide else 0)
+        columns["starts"].append(to_micros(start))
+        columns["ends"].append(to_micros(end))
+        if promo_code is None:
+            columns["code_start"].append(-1)
+            columns["code_end"].append(-1)
+        else:
+            columns["code_start"].append(len(codes))
+            codes += promo_code.encode("utf-8")
+            columns["code_end"].append(len(codes))
+
+    by_product = {}
+    for product_id, promotion_id in links:
+        if promotion_id in index:
+            by_product.setdefault(product_id, set()).add(index[promotion_id])
+    product_ids = array("q", sorted(by_product))
+    offsets = array("q", [0])
+    targets = array("q")
+    for product_id in product_ids:
+        targets.extend(sorted(by_product[product_id]))
+        offsets.append(len(targets))
+
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT,
+        generation,
+        len(promotions),
+        len(product_ids),
+        len(targets),
+        len(codes),
+    )
+    parts = [header] + [columns[name].tobytes() for name in PROMOTION_COLUMNS]
+    parts += [product_ids.tobytes(), offsets.tobytes(), targets.tobytes(), bytes(codes)]
+    return b"".join(parts)
+
+
+class SnapshotView:
+    """ Read only, zero-copy view over an encoded snapshot """
+
+    def __init__(self, buffer, promo_types):
+        """
+        Args:
+            buffer: a bytes like object holding an encoded snapshot
+            promo_types (Enum): the enumeration of the promo type codes
+        """
+        magic, file_format, generation, count, products, links, code_size = (
+            HEADER.unpack_from(buffer)
+        )
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError("Not a promotion snapshot")
+        self.generation = generation
+        self._promo_types = promo_types
+        data = memoryview(buffer)
+        offset = HEADER.size
+        arrays = {}
+        for name, size in [(name, count) for name in PROMOTION_COLUMNS] + [
+            ("product_ids", products),
+            ("offsets", products + 1),
+            ("links", links),
+        ]:
+            end = offset + size * ITEM_SIZE
+            arrays[name] = data[offset:end].cast("q")
+            offset = end
+        self._codes = data[offset:offset + code_size]
+        self._columns = arrays
+
+    def __len__(self):
+        return len(self._columns["ids"])
+
+    def promotion(self, index):
+        """ Returns the row of the promotion at an index of the arrays """
+        columns = self._columns
+        start, end = columns["code_start"][index], columns["code_end"][index]
+        return (
+            columns["ids"][index],
+            str(self._codes[start:end], "utf-8") if start >= 0 else None,
+            self._promo_types(columns["promo_types"][index]),
+            columns["amounts"][index],
+            bool(columns["site_wide"][index]),
+            from_micros(columns["starts"][index]),
+            from_micros(columns["ends"][index]),
+        )
+
+    def rows(self, now):
+        """ Yields the rows of the promotions that have not ended at now """
+        now = to_micros(now)
+        ends = self._columns["ends"]
+        for index in range(len(ends)):
+            if ends[index] >= now:
+                yield self.promotion(index)
+
+    def promotion_ids_for(self, product_id):
+        """ Returns the ids of the promotions of a product, in id order """
+        columns = self._columns
+        product_ids = columns["product_ids"]
+        position = bisect_left(product_ids, product_id)
+        if position == len(product_ids) or product_ids[position] != product_id:
+            return []
+        ids = columns["ids"]
+        start, end = columns["offsets"][position], columns["offsets"][position + 1]
+        return [ids[index] for index in columns["links"][start:end]]
+
+
+class SharedSnapshot:
+    """ Snapshot file shared by the worker processes of one host """
+
+    def __init__(self, loader, promo_types):
+        """
+        Args:
+            loader (callable): returns (promotions, links) as for encode()
+            promo_types (Enum): the enumeration of the promo type codes
+        """
+        self._loader = loader
+        self._promo_types = promo_types
+        self._lock = threading.Lock()
+        self._counter = None
+        self._view = None
+        self.path = None
+
+    @property
+    def enabled(self):
+        """ True if a snapshot file is configured """
+        return self.path is not None
+
+    def configure(self, path):
+        """ Shares the snapshot through the file at path, None turns it off """
+        with self._lock:
+            self.path = path
+            self._view = None
+            self._counter = None
+            if path is None:
+                return
+            with self._file_lock():
+                fd = os.open(path + ".gen", os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if os.fstat(fd).st_size < COUNTER.size:
+                        os.ftruncate(fd, COUNTER.size)
+                    self._counter = mmap.mmap(fd, COUNTER.size)
+                finally:
+                    os.close(fd)
+
+    def generation(self):
+        """ The generation of the latest published snapshot, 0 if there is none """
+        counter = self._counter
+        return COUNTER.unpack_from(counter)[0] if counter is not None else 0
+
+    def view(self):
+        """ Returns the latest snapshot, mapping or building it if needed """
+        generation = self.generation()
+        view = self._view
+        if view is not None and view.generation >= generation:
+            return view
+        with self._lock:
+            view = self._view
+            if view is None or view.generation < generation:
+                view = self._open()
+                if view is None or view.generation < generation:
+                    view = self.publish()  # missing or left behind by a crash
+                self._view = view
+            return view
+
+    def publish(self):
+        """ Rebuilds the snapshot from the loader and hands it to every worker """
+        with self._file_lock():
+            generation = self.generation() + 1
+            promotions, links = self._loader()
+            temporary = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temporary, "wb") as snapshot_file:
+                snapshot_file.write(encode(generation, promotions, links))
+            os.replace(temporary, self.path)
+            COUNTER.pack_into(self._counter, 0, generation)
+        view = self._open()
+        current = self._view
+        if current is None or view.generation > current.generation:
+            self._view = view
+        return view
+
+    def _open(self):
+        """ Maps the snapshot file, None if there is none yet """
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None  # ValueError: the file is empty
+        # the mapping is unmapped once no view of it is left
+        return SnapshotView(buffer, self._promo_types)
+
+    @contextmanager
+    def _file_lock(self):
+        """ Serializes the writers of all the processes """
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
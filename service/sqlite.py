@@ -0,0 +1,72 @@
+"""
+Embedded SQLite Backend
+
+Edge instances can keep their promotions in a local SQLite file instead of
+PostgreSQL by pointing DATABASE_URI at it (sqlite:////var/lib/promotions.db).
+Every connection is tuned when it is opened:
+
+- journal_mode=WAL lets readers go on while a writer commits
+- synchronous=NORMAL only syncs the WAL at checkpoints, which is safe in
+  WAL mode (a power loss may lose the last commits, never corrupt the file)
+- mmap_size and cache_size keep the hot pages in memory
+- busy_timeout makes writers wait for each other instead of failing
+
+The values come from the SQLITE_* settings in config.py. Connections are
+pooled, so the page cache survives between requests, and pysqlite's own
+transaction handling is replaced by plain BEGIN statements so that
+SAVEPOINTs work.
+"""
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative means KiB: 64 MiB
+    "busy_timeout": 5000,  # milliseconds
+    "foreign_keys": "ON",
+}
+
+
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+def pragmas(config):
+    """ Returns the pragmas to set on every connection from the app config """
+    settings = dict(DEFAULT_PRAGMAS)
+    synchronous = config.get("SQLITE_SYNCHRONOUS")
+    if synchronous:
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError("SQLITE_SYNCHRONOUS must be one of " + ", ".join(SYNCHRONOUS_LEVELS))
+        settings["synchronous"] = synchronous.upper()
+    for name in ("mmap_size", "cache_size", "busy_timeout"):
+        value = config.get("SQLITE_" + name.upper())
+        if value not in (None, ""):
+            settings[name] = int(value)
+    return settings
+
+
+def apply_engine_options(config, sa_url, options):
+    """ Adds the options of a SQLite engine to those of Flask-SQLAlchemy """
+    if sa_url.database not in (None, "", ":memory:"):
+        # a pool instead of Flask-SQLAlchemy's NullPool, one connection per thread
+        options["poolclass"] = QueuePool
+        options.setdefault("connect_args", {})["check_same_thread"] = False
+    options["pragmas"] = pragmas(config)
+
+
+def listen(engine, settings):
+    """ Tunes every connection of a SQLite engine with the pragmas in settings """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):  # pylint: disable=unused-variable
+        dbapi_connection.isolation_level = None  # transactions are begun below
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):  # pylint: disable=unused-variable
+        connection.execute("BEGIN")
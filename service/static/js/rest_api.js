@@ -22,6 +22,7 @@ $(function () {
     /// Clears all form fields
     function clear_form_data() {
         $("#promotion_id").val("");
+        $("#promotion_query").val("");
         $("#promotion_title").val("");
         $("#promotion_description").val("");
         $("#promotion_promo_code").val("");
@@ -284,6 +285,7 @@ $(function () {
     $("#search-btn").click(function () {
 
         var queryString = encodeGetParams({
+            q : $("#promotion_query").val(),
             title : $("#promotion_title").val(),
             promo_code : $("#promotion_promo_code").val(),
             promo_type : $("#promotion_promo_type").val(),
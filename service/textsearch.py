@@ -0,0 +1,186 @@
+"""
+Full-Text Search
+
+The q= query string argument matches the words of the title, promo code
+and description of promotions, ranked by relevance. Each word also
+matches the words it starts with, so q=summ finds "Summer sale".
+
+- PostgreSQL matches an english tsvector with a GIN expression index,
+  the title and promo code weigh more than the description in ts_rank
+- SQLite matches an external content FTS5 table kept up to date by
+  triggers on the promotion table, ranked by bm25 with the same weights
+- other databases fall back to case insensitive LIKE of the words in
+  order, unranked
+
+The indexes are created by setup(), which can run on every start: it
+only creates what is missing, and fills a new FTS5 table with the rows
+that are already there.
+"""
+import re
+from sqlalchemy import column, func, literal_column, or_, select, table
+
+# the searched columns and their weight, A is the highest
+FIELDS = (("title", "A"), ("promo_code", "A"), ("description", "B"))
+
+# extra words of a query are ignored
+MAX_TERMS = 10
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def terms(text):
+    """ Returns the words of a query in lower case """
+    return WORD.findall(text.lower())[:MAX_TERMS]
+
+
+def setup(connection, table_name):
+    """ Creates the text index of a table of promotions if it is missing """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_{0}_search ON {0} USING gin (({1}))".format(
+                table_name, _vector_sql("")
+            )
+        )
+    elif dialect == "sqlite":
+        _setup_fts(connection, table_name)
+
+
+def rebuild(connection, table_name):
+    """ Indexes every row of a table of promotions again, e.g. after it was recreated """
+    if connection.dialect.name == "sqlite":
+        connection.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(table_name + "_search"))
+
+
+def query(text, dialect):
+    """
+    Returns the search query of the words of a text for a dialect, None if
+    the text has no words
+
+    It is bound to the statements built by match() and rank(), which
+    don't depend on the text and can be cached.
+    """
+    words = terms(text)
+    if not words:
+        return None
+    if dialect == "postgresql":
+        # all the words, each as a prefix
+        return " & ".join(word + ":*" for word in words)
+    if dialect == "sqlite":
+        # all the words, each as a prefix, quoted so that none is an FTS5 operator
+        return " ".join('"{}"*'.format(word) for word in words)
+    return "%{}%".format("%".join(words))
+
+
+def match(table_name, id_column, search_query, dialect):
+    """
+    Returns the criterion of the rows of a table of promotions matching a query
+
+    Args:
+        table_name (str): the table of id_column
+        id_column (Column): the primary key of the promotions
+        search_query (ColumnElement): the value of query(), usually bound
+        dialect (str): the name of the database dialect
+    """
+    if dialect == "postgresql":
+        return _vector(table_name).op("@@")(_tsquery(search_query))
+    if dialect == "sqlite":
+        fts = _fts_table(table_name)
+        return id_column.in_(select([fts.c.rowid]).where(_fts_match(fts, search_query)))
+    # the words in this order, all in the same field
+    return or_(
+        *[
+            literal_column("{}.{}".format(table_name, name)).ilike(search_query)
+            for name, _ in FIELDS
+        ]
+    )
+
+
+def rank(table_name, id_column, search_query, dialect):
+    """ Returns the ORDER BY clause putting the best matches first, None if unranked """
+    if dialect == "postgresql":
+        return func.ts_rank(_vector(table_name), _tsquery(search_query)).desc()
+    if dialect == "sqlite":
+        fts = _fts_table(table_name)
+        # bm25 is negative, the more relevant the lower
+        return (
+            select([fts.c.rank])
+            .where(_fts_match(fts, search_query))
+            .where(fts.c.rowid == id_column)
+            .as_scalar()
+            .asc()
+        )
+    return None
+
+
+######################################################################
+#  P O S T G R E S Q L
+######################################################################
+def _vector_sql(prefix):
+    """ SQL of the weighted tsvector of a row, the same for the index and the queries """
+    return " || ".join(
+        "setweight(to_tsvector('english', coalesce({}{}, '')), '{}')".format(prefix, name, weight)
+        for name, weight in FIELDS
+    )
+
+
+def _vector(table_name):
+    """ The weighted tsvector of the rows of a table """
+    return literal_column("({})".format(_vector_sql(table_name + ".")))
+
+
+def _tsquery(search_query):
+    """ The tsquery of the value of query() """
+    return func.to_tsquery(literal_column("'english'"), search_query)
+
+
+######################################################################
+#  S Q L I T E
+######################################################################
+def _setup_fts(connection, table_name):
+    """ Creates the FTS5 table of a table and the triggers that keep it in sync """
+    fts = table_name + "_search"
+    names = ", ".join(name for name, _ in FIELDS)
+    new_values = ", ".join("new." + name for name, _ in FIELDS)
+    old_values = ", ".join("old." + name for name, _ in FIELDS)
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)
+    ).scalar()
+    if not exists:
+        connection.execute(
+            "CREATE VIRTUAL TABLE {fts} USING fts5({names}, content='{table}', "
+            "content_rowid='id', tokenize='porter unicode61')".format(
+                fts=fts, names=names, table=table_name
+            )
+        )
+        weights = ", ".join("10.0" if weight == "A" else "1.0" for _, weight in FIELDS)
+        connection.execute(
+            "INSERT INTO {0}({0}, rank) VALUES ('rank', 'bm25({1})')".format(fts, weights)
+        )
+        connection.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts))
+    triggers = {
+        "insert": "AFTER INSERT ON {table} BEGIN {add}; END",
+        "delete": "AFTER DELETE ON {table} BEGIN {remove}; END",
+        "update": "AFTER UPDATE OF id, {names} ON {table} BEGIN {remove}; {add}; END",
+    }
+    add = "INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {values})".format(
+        fts=fts, names=names, values=new_values
+    )
+    remove = "INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {values})".format(
+        fts=fts, names=names, values=old_values
+    )
+    for operation, body in triggers.items():
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS {fts}_{operation} ".format(fts=fts, operation=operation)
+            + body.format(table=table_name, names=names, add=add, remove=remove)
+        )
+
+
+def _fts_table(table_name):
+    """ The FTS5 table of a table, with its hidden columns """
+    return table(table_name + "_search", column("rowid"), column("rank"))
+
+
+def _fts_match(fts, search_query):
+    """ Matches the FTS5 table with the value of query() """
+    return literal_column(fts.name).op("MATCH")(search_query)
@@ -1,3 +1,6 @@
 # NOTE: nose will duplicate test cases when including the following lines
 # from tests.test_models import TestPromotion
 # from tests.test_service import TestPromotionService
+
+# gives this test process its own database schema before the service starts
+from tests import database  # pylint: disable=unused-import
@@ -0,0 +1,109 @@
+"""
+Redis Protocol Stand-in for testing
+
+A tiny threaded server that speaks enough of RESP for RedisCache: AUTH,
+SELECT, MGET, SET (with PX and NX), INCR and FLUSHDB. It keeps everything
+in memory, so the cache tests don't need a Redis server.
+"""
+import time
+import threading
+import socketserver
+from service.cache import encode_command
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """ Serves the commands of RedisCache on a free port of localhost """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.password = password
+        self.databases = {}  # number -> {key: (value, expires at)}
+        self.lock = threading.Lock()
+        self.commands = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.01,), daemon=True)
+
+    @property
+    def url(self):
+        """ The CACHE_URL of the stand-in """
+        auth = ":{}@".format(self.password) if self.password else ""
+        return "redis://{}127.0.0.1:{}/1".format(auth, self.server_address[1])
+
+    def start(self):
+        """ Starts serving in a background thread """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving and closes the listening socket """
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """ Answers the commands of one connection """
+
+    def setup(self):
+        super().setup()
+        self.database = 0
+        self.authenticated = self.server.password is None
+
+    def handle(self):
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            self.server.commands.append(command[0].upper())
+            with self.server.lock:
+                reply = self._execute(command[0].upper(), command[1:])
+            self.wfile.write(reply)
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        arguments = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            arguments.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return arguments
+
+    def _execute(self, name, arguments):  # pylint: disable=too-many-return-statements
+        if name == "AUTH":
+            if arguments[0] != self.server.password:
+                return b"-WRONGPASS invalid password\r\n"
+            self.authenticated = True
+            return b"+OK\r\n"
+        if not self.authenticated:
+            return b"-NOAUTH Authentication required.\r\n"
+        entries = self.server.databases.setdefault(self.database, {})
+        now = time.monotonic()
+        for key in [key for key, (_, expires) in entries.items() if expires and expires <= now]:
+            del entries[key]
+        if name == "SELECT":
+            self.database = int(arguments[0])
+            return b"+OK\r\n"
+        if name == "MGET":
+            values = [entries.get(key, (None, None))[0] for key in arguments]
+            return b"*%d\r\n" % len(values) + b"".join(
+                b"$-1\r\n" if value is None else encode_command([value])[4:] for value in values
+            )
+        if name == "SET":
+            key, value, options = arguments[0], arguments[1], [a.upper() for a in arguments[2:]]
+            if "NX" in options and key in entries:
+                return b"$-1\r\n"
+            expires = None
+            if "PX" in options:
+                expires = now + int(options[options.index("PX") + 1]) / 1000
+            entries[key] = (value, expires)
+            return b"+OK\r\n"
+        if name == "INCR":
+            value = int(entries.get(arguments[0], ("0", None))[0]) + 1
+            entries[arguments[0]] = (str(value), None)
+            return b":%d\r\n" % value
+        if name == "FLUSHDB":
+            entries.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name.encode("utf-8")
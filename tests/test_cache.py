@@ -0,0 +1,288 @@
+"""
+Test cases for the Shared Cache
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from service.cache import (
+    CacheError,
+    CircuitBreaker,
+    LRUCache,
+    RedisCache,
+    SQLiteCache,
+    TieredCache,
+    backend,
+)
+from .redis_standin import RedisStandIn
+
+
+class BackendTests:
+    """ Tests that every cache backend must pass, mixed into the TestCases below """
+
+    def test_set_and_get(self):
+        """ Values come back as they were stored """
+        self.cache.set("a", {"id": 1, "products": [2, 3]})
+        self.cache.set("b", "text")
+        self.assertEqual(self.cache.get_many(["a", "missing", "b"]), [
+            {"id": 1, "products": [2, 3]}, None, "text",
+        ])
+        self.cache.set("a", 2)
+        self.assertEqual(self.cache.get("a"), 2)
+
+    def test_ttl(self):
+        """ Entries are gone once their time to live has passed """
+        self.cache.set("short", 1, ttl=0.05)
+        self.cache.set("long", 2, ttl=60)
+        self.assertEqual(self.cache.get("short"), 1)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get_many(["short", "long"]), [None, 2])
+
+    def test_add(self):
+        """ add() doesn't overwrite an existing entry """
+        self.assertTrue(self.cache.add("stamp", 5))
+        self.assertFalse(self.cache.add("stamp", 9))
+        self.assertEqual(self.cache.get("stamp"), 5)
+
+    def test_incr(self):
+        """ incr() counts from 0 or from the stored integer """
+        self.assertEqual(self.cache.incr("new"), 1)
+        self.assertEqual(self.cache.incr("new"), 2)
+        self.cache.add("old", 41)
+        self.assertEqual(self.cache.incr("old"), 42)
+        self.assertEqual(self.cache.get("old"), 42)
+
+    def test_clear(self):
+        """ clear() drops every entry """
+        self.cache.set("a", 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("a"))
+
+
+######################################################################
+#  B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestLRUCache(BackendTests, unittest.TestCase):
+    """ Test Cases for the in-process LRU """
+
+    def setUp(self):
+        self.cache = LRUCache(max_entries=3)
+
+    def test_eviction(self):
+        """ The least recently used entry goes first """
+        for key in "abc":
+            self.cache.set(key, key)
+        self.cache.get("a")
+        self.cache.set("d", "d")
+        self.assertEqual(self.cache.get_many(["a", "b", "c", "d"]), ["a", None, "c", "d"])
+
+    def test_concurrent_add(self):
+        """ Only one of the threads adding the same key stores it """
+        self.cache.max_entries = 1000
+        results = []
+
+        def add(value):
+            results.extend(self.cache.add(key, value) for key in range(200))
+
+        threads = [threading.Thread(target=add, args=(value,)) for value in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 200)
+
+
+class TestSQLiteCache(BackendTests, unittest.TestCase):
+    """ Test Cases for the SQLite file cache """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.db")
+        self.cache = SQLiteCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        """ Caches on the same file see each other's entries """
+        other = SQLiteCache(self.path)
+        self.cache.set("a", [1])
+        self.assertEqual(other.get("a"), [1])
+        self.assertEqual(other.incr("stamp"), 1)
+        self.assertEqual(self.cache.incr("stamp"), 2)
+
+    def test_backend(self):
+        """ sqlite:/// URLs use a SQLite file """
+        self.assertIsInstance(backend("sqlite:///" + self.path), SQLiteCache)
+
+
+class TestRedisCache(BackendTests, unittest.TestCase):
+    """ Test Cases for the Redis protocol client, against a stand-in server """
+
+    def setUp(self):
+        self.server = RedisStandIn(password="secret").start()
+        self.cache = RedisCache(self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_url(self):
+        """ The password and the database number come from the URL """
+        self.cache.set("a", 1)
+        self.assertIn("a", self.server.databases[1])
+        self.assertEqual(self.server.commands[:3], ["AUTH", "SELECT", "SET"])
+        self.assertIsInstance(backend(self.server.url), RedisCache)
+        self.assertIsNone(backend(""))
+        self.assertRaises(ValueError, backend, "memcached://localhost")
+
+    def test_reconnects(self):
+        """ A dropped connection is opened again for the next command """
+        self.cache.set("a", 1)
+        self.cache._local.connection[0].close()  # pylint: disable=protected-access
+        self.assertEqual(self.cache.get("a"), 1)
+
+    def test_errors(self):
+        """ Refused commands and unreachable servers raise CacheError """
+        self.assertRaises(CacheError, RedisCache(self.server.url.replace("secret", "wrong")).get, "a")
+        self.server.stop()
+        self.cache._local.connection = None  # pylint: disable=protected-access
+        self.assertRaises(CacheError, self.cache.get, "a")
+        self.server = RedisStandIn().start()  # for tearDown
+
+
+class FailingCache(LRUCache):
+    """ An LRU that fails while down is set, counting the calls it got """
+
+    def __init__(self):
+        super().__init__()
+        self.down = False
+        self.calls = 0
+
+    def get_many(self, keys):
+        self.calls += 1
+        if self.down:
+            raise CacheError("unreachable")
+        return super().get_many(keys)
+
+    def incr(self, key):
+        self.calls += 1
+        if self.down:
+            raise CacheError("unreachable")
+        return super().incr(key)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """ Test Cases for the cache left alone after a failure """
+
+    def test_left_alone_after_a_failure(self):
+        """ Reads fail without trying until retry_after passed """
+        failing = FailingCache()
+        breaker = CircuitBreaker(failing, retry_after=0.1)
+        failing.set("a", 1)
+        self.assertEqual(breaker.get("a"), 1)
+        failing.down = True
+        self.assertRaises(CacheError, breaker.get, "a")
+        self.assertTrue(breaker.down)
+        self.assertRaises(CacheError, breaker.get, "a")
+        self.assertEqual(failing.calls, 2)
+        # increments are never skipped
+        self.assertRaises(CacheError, breaker.incr, "stamp")
+        self.assertEqual(failing.calls, 3)
+        failing.down = False
+        self.assertRaises(CacheError, breaker.get, "a")
+        time.sleep(0.15)
+        self.assertEqual(breaker.get("a"), 1)
+        self.assertFalse(breaker.down)
+        self.assertEqual(failing.calls, 4)
+
+
+######################################################################
+#  T I E R E D   C A C H E   T E S T   C A S E S
+######################################################################
+class TestTieredCache(unittest.TestCase):
+    """ Test Cases for the L1 over L2 cache with version stamps """
+
+    def setUp(self):
+        self.server = RedisStandIn().start()
+        self.shared = RedisCache(self.server.url)
+        # two workers sharing one L2
+        self.worker = TieredCache(LRUCache(), self.shared)
+        self.other = TieredCache(LRUCache(), RedisCache(self.server.url))
+        self.calls = 0
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _compute(self, value):
+        """ Returns a function that counts its calls """
+
+        def compute():
+            self.calls += 1
+            return value
+
+        return compute
+
+    def test_read_through(self):
+        """ A value is computed once then served by L1, then by L2 for the other workers """
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute([1])), [1])
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute([2])), [1])
+        self.assertEqual(self.other.fetch("k", ["lists"], self._compute([3])), [1])
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(self.worker.fetch("none", ["lists"], self._compute(None)))
+        self.assertIsNone(self.worker.fetch("none", ["lists"], self._compute(None)))
+        self.assertEqual(self.calls, 3)  # None is not cached
+
+    def test_bump_invalidates_every_worker(self):
+        """ Bumping a stamp in one worker makes all of them compute again """
+        self.worker.fetch("a", ["all", "promotion:1"], self._compute("v1"))
+        self.worker.fetch("b", ["all", "promotion:2"], self._compute("v1"))
+        self.other.fetch("a", ["all", "promotion:1"], self._compute("v1"))
+        self.worker.bump(["promotion:1"])
+        self.assertEqual(self.other.fetch("a", ["all", "promotion:1"], self._compute("v2")), "v2")
+        self.assertEqual(self.worker.fetch("a", ["all", "promotion:1"], self._compute("v3")), "v2")
+        self.assertEqual(self.other.fetch("b", ["all", "promotion:2"], self._compute("v2")), "v1")
+        self.other.bump(["all"])
+        self.assertEqual(self.worker.fetch("b", ["all", "promotion:2"], self._compute("v4")), "v4")
+
+    def test_stamps_survive_a_flush(self):
+        """ Stamps that were lost never come back to a value used before """
+        before = self.worker.stamps(["lists"])
+        self.shared.clear()
+        self.assertGreater(self.worker.stamps(["lists"]), before)
+
+    def test_l1_only(self):
+        """ Without L2 the stamps live in L1 """
+        cache = TieredCache()
+        cache.fetch("k", ["lists"], self._compute(1))
+        cache.bump(["lists"])
+        self.assertEqual(cache.fetch("k", ["lists"], self._compute(2)), 2)
+
+    def test_failing_l2(self):
+        """ An unreachable L2 sends the reads to compute() """
+        self.server.stop()
+        self.shared._local.connection = None  # pylint: disable=protected-access
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute(1)), 1)
+        self.assertTrue(self.worker.l2.down)
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute(2)), 2)
+        self.assertEqual(self.worker.bump(["lists"]), [None])  # only logged
+        self.server = RedisStandIn().start()  # for tearDown
+
+    def test_not_local(self):
+        """ Values fetched with local=False are only kept in L2 """
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute([1]), False), [1])
+        self.assertEqual(self.worker.fetch("k", ["lists"], self._compute([2]), False), [1])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(self.worker.l1._entries), 0)  # pylint: disable=protected-access
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
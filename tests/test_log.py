@@ -0,0 +1,149 @@
+"""
+Test cases for the Structured Logging
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import json
+import logging
+import threading
+import unittest
+from flask import Flask
+from service.log import JSONFormatter, flush, init_logging, lazy, stop
+
+
+class RecordingHandler(logging.Handler):
+    """ Keeps the formatted records and the threads that wrote them """
+
+    def __init__(self, gate=None):
+        super().__init__()
+        self.lines = []
+        self.threads = []
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate:
+            self.gate.wait(5)
+        self.lines.append(self.format(record))
+        self.threads.append(threading.current_thread())
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogging(unittest.TestCase):
+    """ Test Cases for the logging through the queue """
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.listener = None
+
+    def tearDown(self):
+        if self.listener:
+            stop(self.listener)
+
+    def _app(self, handler=None, **config):
+        """ Returns an app logging to the recording handler """
+        app = Flask("log_test_{}".format(id(self)))
+        app.config.update(config)
+        app.logger.handlers = [handler or self.handler]
+        self.listener = init_logging(app)
+        return app
+
+    def test_off_the_request_thread(self):
+        """ The listener formats and writes the records """
+        app = self._app(LOG_FORMAT="text")
+        self.assertIs(init_logging(app), self.listener)
+        app.logger.info("Promotion with ID [%s] created.", 7)
+        flush(app)
+        self.assertEqual(self.handler.lines, ["Promotion with ID [7] created."])
+        self.assertIsNot(self.handler.threads[0], threading.current_thread())
+
+    def test_lazy_values(self):
+        """ lazy() values are computed by the listener, once, and only for kept records """
+        app = self._app(LOG_LEVEL="INFO", LOG_FORMAT="text")
+        calls = []
+
+        def codes():
+            calls.append(threading.current_thread())
+            return ["SAVE10"]
+
+        app.logger.debug("Promotions %s", lazy(codes))
+        value = lazy(codes)
+        app.logger.info("Promotions %s %r", value, value)
+        flush(app)
+        self.assertEqual(self.handler.lines, ["Promotions ['SAVE10'] ['SAVE10']"])
+        self.assertEqual(len(calls), 1)
+        self.assertIsNot(calls[0], threading.current_thread())
+
+    def test_arguments_are_copied(self):
+        """ Changing a list or a dict after logging it doesn't change the record """
+        release = threading.Event()
+        handler = RecordingHandler(release)
+        app = self._app(handler, LOG_FORMAT="text")
+        products, args = [1, 2], {"active": "1"}
+        app.logger.info("Products %s matching %s", products, args)
+        products.append(3)
+        args["title"] = "sale"
+        release.set()
+        flush(app)
+        self.assertEqual(handler.lines, ["Products [1, 2] matching {'active': '1'}"])
+
+    def test_json(self):
+        """ Records are JSON objects with their extra fields """
+        app = self._app()
+        app.logger.warning(
+            "%s", "Promotion 3 was changed", extra={"status_code": 412, "codes": lazy(list, "AB")}
+        )
+        try:
+            raise ValueError("bad amount")
+        except ValueError:
+            app.logger.exception("Cannot save")
+        flush(app)
+        first, second = [json.loads(line) for line in self.handler.lines]
+        self.assertEqual(first["message"], "Promotion 3 was changed")
+        self.assertEqual(first["level"], "WARNING")
+        self.assertEqual(first["logger"], app.logger.name)
+        self.assertEqual(first["status_code"], 412)
+        self.assertEqual(first["codes"], ["A", "B"])
+        self.assertTrue(first["time"].endswith("Z"))
+        self.assertIn("ValueError: bad amount", second["exception"])
+
+    def test_full_queue(self):
+        """ Records that don't fit in the queue are dropped then counted """
+        release = threading.Event()
+        handler = RecordingHandler(release)
+        app = self._app(handler, LOG_FORMAT="text", LOG_QUEUE_SIZE=2)
+        app.logger.info("first")
+        for _ in range(100):  # until the listener took the first one
+            if self.listener.queue.empty():
+                break
+            threading.Event().wait(0.01)
+        for number in range(5):
+            app.logger.info("record %d", number)  # never blocks
+        release.set()
+        flush(app)
+        app.logger.info("last")
+        flush(app)
+        self.assertEqual(handler.lines, [
+            "first",
+            "record 0",
+            "record 1",
+            "Dropped 3 log records, the log queue was full",
+            "last",
+        ])
+
+    def test_formatter(self):
+        """ Records without extra fields have the four standard ones """
+        record = logging.makeLogRecord({"name": "service", "msg": "%d results", "args": (3,)})
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(sorted(entry), ["level", "logger", "message", "time"])
+        self.assertEqual(entry["message"], "3 results")
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Test cases for the Price Bands of the best promotion
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import random
+import unittest
+from service.models import PromoType, price_breakpoints, select_best_promo
+from service.pricebands import PriceBands
+from service.scheduler import ActivePromotion
+
+
+######################################################################
+#  P R I C E   B A N D S   T E S T   C A S E S
+######################################################################
+class TestPriceBands(unittest.TestCase):
+    """ Test Cases for PriceBands """
+
+    def setUp(self):
+        self.selections = 0
+
+    def _select(self, candidates, price):
+        """ select_best_promo() that counts its calls """
+        self.selections += 1
+        return select_best_promo(candidates, price)
+
+    def _bands(self, *promotions):
+        candidates = tuple(
+            ActivePromotion(index, code, promo_type, amount, False)
+            for index, (code, promo_type, amount) in enumerate(promotions, start=1)
+        )
+        return PriceBands(candidates, self._select, price_breakpoints(candidates))
+
+    def test_selected_once_per_band(self):
+        """ Prices of the same band reuse the first selection """
+        bands = self._bands(("TEN", PromoType.DISCOUNT, 10), ("FIVE_OFF", PromoType.FIXED, 5))
+        self.assertEqual(bands.breakpoints, [0, 50])
+        codes = [bands.best(price).promo_code for price in (20, 40, 49, 60, 100, 1000)]
+        self.assertEqual(codes, ["FIVE_OFF"] * 3 + ["TEN"] * 3)
+        self.assertEqual(self.selections, 2)
+        self.assertEqual(len(bands), 2)
+
+    def test_breakpoints_are_selected_every_time(self):
+        """ A price on a breakpoint is never memoized """
+        bands = self._bands(("TEN", PromoType.DISCOUNT, 10), ("FIVE_OFF", PromoType.FIXED, 5))
+        self.assertEqual(bands.best(50).promo_code, "TEN")  # a tie goes to the first
+        self.assertEqual(bands.best(50.0000000001).promo_code, "TEN")
+        self.assertEqual(self.selections, 2)
+        self.assertEqual(len(bands), 0)
+        self.assertRaises(ZeroDivisionError, bands.best, 0)
+
+    def test_without_fixed_promotions(self):
+        """ The price doesn't matter without FIXED promotions """
+        bands = self._bands(("HALF", PromoType.BOGO, 1), ("TEN", PromoType.DISCOUNT, 10))
+        self.assertEqual(bands.breakpoints, [])
+        self.assertEqual({bands.best(price).promo_code for price in (1, 10, 1e6)}, {"HALF"})
+        self.assertEqual(self.selections, 1)
+        self.assertIsNone(self._bands().best(10))
+
+    def test_same_as_select_best_promo(self):
+        """ Every price gets the promotion select_best_promo() picks """
+        rng = random.Random(7)
+        types = list(PromoType)
+        for _ in range(200):
+            bands = self._bands(*[
+                ("P{}".format(index), rng.choice(types), rng.choice([0, 1, 5, 10, 25, 50, 99]))
+                for index in range(rng.randint(0, 6))
+            ])
+            prices = [rng.choice([1, 2, 10, 50, 100, 1000]) * rng.choice([1, 1.5, 3])
+                      for _ in range(20)] + bands.breakpoints[1:]
+            for price in prices:
+                self.assertIs(bands.best(price), select_best_promo(bands.candidates, price))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
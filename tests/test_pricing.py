@@ -0,0 +1,114 @@
+"""
+Test cases for Catalog Pricing
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import io
+import logging
+import unittest
+from datetime import datetime, timedelta
+from service.models import Promotion, Product, PromoType
+from service.pricing import load_promotions, price_catalog
+from service import app
+from .database import DATABASE_URI, DatabaseTestCase
+from .factories import PromotionFactory
+
+
+######################################################################
+#  C A T A L O G   P R I C I N G   T E S T   C A S E S
+######################################################################
+class TestCatalogPricing(DatabaseTestCase):
+    """ Test Cases for price_catalog """
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Promotion.init_db(app)
+
+    def setUp(self):
+        super().setUp()
+        now = datetime.now()
+        products = {product_id: Product(id=product_id) for product_id in (1, 2)}
+        for promo_code, promo_type, amount, is_site_wide, product_ids in [
+            ("SITE5", PromoType.DISCOUNT, 5, True, []),
+            ("TEN", PromoType.DISCOUNT, 10, False, [1]),
+            ("FIVE_OFF", PromoType.FIXED, 5, False, [1, 2]),
+            ("BOGO", PromoType.BOGO, 1, False, [2]),
+        ]:
+            promotion = PromotionFactory(
+                promo_code=promo_code,
+                promo_type=promo_type,
+                amount=amount,
+                is_site_wide=is_site_wide,
+                start_date=now - timedelta(days=1),
+                end_date=now + timedelta(days=1),
+            )
+            promotion.products = [products[i] for i in product_ids]
+            promotion.create()
+
+
+    def _price(self, catalog, workers=1, chunk_size=2):
+        out_file = io.StringIO()
+        rows = price_catalog(
+            io.StringIO(catalog), out_file, load_promotions(), workers, chunk_size
+        )
+        return rows, out_file.getvalue().splitlines()
+
+    def test_same_rules_as_apply_best_promo(self):
+        """ Every row gets the promotion apply_best_promo picks """
+        rows = [(product_id, price) for product_id in (1, 2, 3) for price in (4, 40, 60, 200)]
+        catalog = "product_id,price\n" + "".join("%d,%d\n" % row for row in rows)
+        for workers in (1, 2):
+            count, lines = self._price(catalog, workers)
+            self.assertEqual(count, len(rows))
+            self.assertEqual(lines[0], "product_id,price,promo_code")
+            for (product_id, price), line in zip(rows, lines[1:]):
+                best = Promotion.apply_best_promo(product_id, price)
+                expected = best[product_id] if best else ""
+                self.assertEqual(line, "%d,%d,%s" % (product_id, price, expected))
+
+    def test_only_active_promotions(self):
+        """ Promotions that ended or didn't start yet are not loaded """
+        now = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        product = Product.query.get(1)
+        for promo_code, start, end in [
+            ("ENDED", now - timedelta(days=2), now - timedelta(seconds=1)),
+            ("LAST", now - timedelta(days=2), now),
+            ("LATER", now + timedelta(seconds=1), now + timedelta(days=2)),
+        ]:
+            promotion = PromotionFactory(
+                promo_code=promo_code, is_site_wide=False, start_date=start, end_date=end
+            )
+            promotion.products = [product]
+            promotion.create()
+        site_wide, by_product = load_promotions(now)
+        self.assertEqual([promo.promo_code for promo in site_wide], ["SITE5"])
+        self.assertEqual(
+            [promo.promo_code for promo in by_product[1]], ["TEN", "FIVE_OFF", "LAST"]
+        )
+
+    def test_without_header(self):
+        """ The header row is optional """
+        self.assertEqual(
+            self._price("1,40\n"), (1, ["product_id,price,promo_code", "1,40,FIVE_OFF"])
+        )
+        self.assertEqual(self._price(""), (0, ["product_id,price,promo_code"]))
+
+    def test_bad_rows(self):
+        """ Bad rows are reported with their line number """
+        with self.assertRaisesRegex(ValueError, "line 3"):
+            self._price("product_id,price\n1,40\n1,cheap\n")
+        with self.assertRaisesRegex(ValueError, "line 1"):
+            self._price("1,0\n")
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
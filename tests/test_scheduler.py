@@ -0,0 +1,104 @@
+"""
+Test cases for the Active Promotion Scheduler
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+from datetime import datetime
+from service.models import PromoType
+from service.scheduler import ActivePromotion, BoundaryScheduler, END_GRACE
+
+
+######################################################################
+#  B O U N D A R Y   S C H E D U L E R   T E S T   C A S E S
+######################################################################
+class TestBoundaryScheduler(unittest.TestCase):
+    """ Test Cases for the BoundaryScheduler """
+
+    def setUp(self):
+        self.calls = 0
+        self.rows = [
+            (1, "ONE", PromoType.DISCOUNT, 10, True, datetime(2020, 10, 1), datetime(2020, 10, 31)),
+            (2, "TWO", PromoType.BOGO, 1, False, datetime(2020, 10, 15), datetime(2020, 11, 15)),
+        ]
+        self.scheduler = BoundaryScheduler(self._loader)
+
+    def _loader(self, now):
+        self.calls += 1
+        return [row for row in self.rows if row[6] >= now]
+
+    def test_snapshot_before_any_boundary(self):
+        """ Only started promotions are active and the next start is the boundary """
+        snapshot = self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.assertEqual(list(snapshot.promotions), [1])
+        self.assertEqual([promo.id for promo in snapshot.site_wide], [1])
+        self.assertEqual(snapshot.next_boundary, datetime(2020, 10, 15))
+
+    def test_snapshot_is_reused_until_boundary(self):
+        """ The loader only runs again once a boundary has passed """
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.scheduler.snapshot(datetime(2020, 10, 14, 23, 59))
+        self.assertEqual(self.calls, 1)
+        snapshot = self.scheduler.snapshot(datetime(2020, 10, 15))
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(sorted(snapshot.promotions), [1, 2])
+        self.assertEqual(snapshot.next_boundary, datetime(2020, 10, 31) + END_GRACE)
+
+    def test_promotion_is_active_on_its_end_date(self):
+        """ A promotion stays active up to and including its end_date """
+        snapshot = self.scheduler.snapshot(datetime(2020, 10, 31))
+        self.assertIn(1, snapshot.promotions)
+        snapshot = self.scheduler.snapshot(datetime(2020, 10, 31) + END_GRACE)
+        self.assertNotIn(1, snapshot.promotions)
+
+    def test_invalidate(self):
+        """ A write forces the next snapshot to be rebuilt """
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.rows.append(
+            (3, "THREE", PromoType.FIXED, 5, True, datetime(2020, 10, 1), datetime(2020, 12, 1))
+        )
+        self.scheduler.invalidate()
+        snapshot = self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(sorted(snapshot.promotions), [1, 3])
+
+    def test_shared_version_change(self):
+        """ The snapshot is rebuilt when the shared version moves """
+        version = [1]
+        self.scheduler = BoundaryScheduler(self._loader, version=lambda: version[0])
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.assertEqual(self.calls, 1)
+        version[0] = 2  # another process wrote
+        self.assertEqual(self.scheduler.snapshot(datetime(2020, 10, 10)).version, 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_active_promotion_is_immutable(self):
+        """ The read model can't be changed and compares by value """
+        promotion = ActivePromotion(1, "ONE", PromoType.DISCOUNT, 10, True)
+        self.assertRaises(AttributeError, setattr, promotion, "amount", 20)
+        self.assertRaises(AttributeError, delattr, promotion, "amount")
+        self.assertRaises(AttributeError, setattr, promotion, "title", "one")
+        self.assertEqual(promotion, ActivePromotion(1, "ONE", PromoType.DISCOUNT, 10, True))
+        self.assertNotEqual(promotion, ActivePromotion(1, "ONE", PromoType.BOGO, 10, True))
+        self.assertEqual(repr(promotion), "<ActivePromotion 'ONE' id=[1]>")
+
+    def test_stale_rebuild_is_not_kept(self):
+        """ A snapshot built while a write happened is not kept """
+        def loader(now):
+            self.scheduler.invalidate()  # a write sneaks in during the rebuild
+            return self._loader(now)
+
+        self.scheduler = BoundaryScheduler(loader)
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.scheduler.snapshot(datetime(2020, 10, 10))
+        self.assertEqual(self.calls, 2)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
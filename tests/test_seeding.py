@@ -0,0 +1,87 @@
+"""
+Test cases for the Synthetic Promotions
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import random
+import logging
+import unittest
+from datetime import datetime
+from service.models import (
+    Promotion,
+    Product,
+    PromoType,
+    ProductBestPromotion,
+    db,
+    promotion_products,
+)
+from service.seeding import Distribution, generate_promotions, seed
+from service import app
+from .database import DATABASE_URI, DatabaseTestCase
+from .factories import PromotionFactory
+
+
+######################################################################
+#  S E E D I N G   T E S T   C A S E S
+######################################################################
+class TestSeeding(DatabaseTestCase):
+    """ Test Cases for the synthetic data generator """
+
+    @classmethod
+    def setUpClass(cls):
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Promotion.init_db(app)
+
+    def _generate(self, distribution, count=2000, random_seed=7):
+        now = datetime(2020, 11, 3)
+        return list(
+            generate_promotions(
+                count, 1, list(range(1, 501)), distribution, random.Random(random_seed), now
+            )
+        )
+
+    def test_generate_follows_the_distribution(self):
+        """ Generated promotions have the configured shape """
+        distribution = Distribution(
+            type_weights={PromoType.BOGO: 1, PromoType.FIXED: 1},
+            site_wide_ratio=0.5,
+            max_fan_out=20,
+            unique_code_ratio=0.0,
+        )
+        generated = self._generate(distribution)
+        self.assertEqual(generated, self._generate(distribution))  # repeatable
+        rows = [row for row, _ in generated]
+        self.assertEqual({row["promo_type"] for row in rows}, {"BOGO", "FIXED"})
+        site_wide = sum(row["is_site_wide"] for row in rows)
+        self.assertTrue(800 < site_wide < 1200)
+        self.assertTrue(all(row["start_date"] < row["end_date"] for row in rows))
+        self.assertTrue(len({row["promo_code"] for row in rows}) < 50)
+        fan_outs = [len(links) for row, links in generated if not row["is_site_wide"]]
+        self.assertTrue(all(1 <= fan_out <= 20 for fan_out in fan_outs))
+        self.assertTrue(sorted(fan_outs)[len(fan_outs) // 2] < 5)  # skewed
+        unique = self._generate(Distribution(unique_code_ratio=1.0))
+        self.assertEqual(len({row["promo_code"] for row, _ in unique}), len(unique))
+
+    def test_seed(self):
+        """ Seeded rows land in the database next to existing ones """
+        PromotionFactory().create()
+        linked = seed(300, 100, random_seed=1, batch_size=64)
+        self.assertEqual(len(Promotion.all()), 301)
+        self.assertEqual(len(Product.all()), 100)
+        self.assertEqual(db.session.query(promotion_products).count(), linked)
+        self.assertTrue(ProductBestPromotion.query.count() > 0)
+        promotion = PromotionFactory()
+        promotion.create()
+        self.assertEqual(promotion.id, 302)  # the id sequence moved on
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Test cases for Request Coalescing
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import time
+import threading
+import unittest
+from service.singleflight import FlightTimeout, SingleFlight, normalize
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for SingleFlight """
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _slow(self, result):
+        """ Returns a function that blocks until the test releases it """
+
+        def function():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return function
+
+    def _in_threads(self, count, key, function, timeout=5):
+        """ Runs count identical calls at once, returns their outcomes """
+        outcomes = [None] * count
+
+        def run(index):
+            try:
+                outcomes[index] = self.flights.do(key, function, timeout)
+            except Exception as error:  # pylint: disable=broad-except
+                outcomes[index] = error
+
+        threads = [threading.Thread(target=run, args=(0,))]
+        threads[0].start()
+        self.started.wait(5)  # the first call is in flight
+        threads += [threading.Thread(target=run, args=(i,)) for i in range(1, count)]
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)  # let them join the call in flight
+        return threads, outcomes
+
+    def test_identical_calls_share_one_result(self):
+        """ Concurrent calls with the same key run the function once """
+        result = ["shared"]
+        threads, outcomes = self._in_threads(5, "key", self._slow(result))
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(outcome is result for outcome in outcomes))
+        # nothing is cached once the call finished
+        self.assertEqual(self.flights.do("key", lambda: "again"), "again")
+
+    def test_errors_are_shared(self):
+        """ The callers that waited get the exception of the call in flight """
+        error = ValueError("boom")
+        threads, outcomes = self._in_threads(3, "key", self._slow(error))
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [error] * 3)
+
+    def test_timeout(self):
+        """ Waiting callers give up after the timeout """
+        threads, outcomes = self._in_threads(2, "key", self._slow("slow"), timeout=0.01)
+        threads[1].join(5)
+        self.assertIsInstance(outcomes[1], FlightTimeout)
+        self.release.set()
+        threads[0].join(5)
+        self.assertEqual(outcomes[0], "slow")
+
+    def test_forget(self):
+        """ Calls made after forget() don't join the call in flight """
+        threads, outcomes = self._in_threads(1, "key", self._slow("before"))
+        self.flights.forget()
+        self.assertEqual(self.flights.do("key", lambda: "after"), "after")
+        self.release.set()
+        threads[0].join(5)
+        self.assertEqual(outcomes, ["before"])
+
+    def test_normalize(self):
+        """ The order and the unset arguments don't change the key """
+        self.assertEqual(
+            normalize("search", {"b": 2, "a": "x", "c": None}),
+            normalize("search", {"a": "x", "b": "2"}),
+        )
+        self.assertNotEqual(normalize("search", {"a": 1}), normalize("apply", {"a": 1}))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
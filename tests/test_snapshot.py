@@ -0,0 +1,88 @@
+"""
+Test cases for the Shared Promotion Snapshot
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from service.models import PromoType
+from service.snapshot import SharedSnapshot, SnapshotView, encode
+
+
+######################################################################
+#  S H A R E D   S N A P S H O T   T E S T   C A S E S
+######################################################################
+class TestSharedSnapshot(unittest.TestCase):
+    """ Test Cases for the SharedSnapshot """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "promotions.snapshot")
+        self.calls = 0
+        self.promotions = [
+            (2, None, PromoType.BOGO, 1, False, datetime(2020, 10, 15), datetime(2020, 11, 15)),
+            (1, "ONE", PromoType.DISCOUNT, 10, True, datetime(2020, 10, 1), datetime(2020, 10, 31)),
+        ]
+        self.links = [(7, 2), (7, 1), (3, 2), (9, 99)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _loader(self):
+        self.calls += 1
+        return self.promotions, self.links
+
+    def test_encode_round_trip(self):
+        """ Promotions and links are read back from the encoded bytes """
+        view = SnapshotView(encode(4, self.promotions, self.links), PromoType)
+        self.assertEqual(view.generation, 4)
+        self.assertEqual(len(view), 2)
+        self.assertEqual(list(view.rows(datetime(2020, 10, 1))), sorted(self.promotions))
+        self.assertEqual(
+            list(view.rows(datetime(2020, 11, 1))), [self.promotions[0]]
+        )
+        self.assertEqual(view.promotion_ids_for(7), [1, 2])
+        self.assertEqual(view.promotion_ids_for(3), [2])
+        self.assertEqual(view.promotion_ids_for(9), [])  # unknown promotion
+        self.assertEqual(view.promotion_ids_for(5), [])
+        self.assertRaises(ValueError, SnapshotView, bytes(64), PromoType)
+
+    def test_workers_share_the_snapshot(self):
+        """ A snapshot published by one worker is picked up by the others """
+        writer = SharedSnapshot(self._loader, PromoType)
+        reader = SharedSnapshot(self._loader, PromoType)
+        writer.configure(self.path)
+        reader.configure(self.path)
+        self.assertEqual(reader.generation(), 0)
+        self.assertEqual(reader.view().generation, 1)  # built on first use
+        self.assertEqual(writer.view().generation, 1)  # mapped, not rebuilt
+        self.assertEqual(self.calls, 1)
+        self.promotions = self.promotions[:1]
+        writer.publish()
+        self.assertEqual(reader.generation(), 2)
+        view = reader.view()
+        self.assertEqual([row[0] for row in view.rows(datetime(2020, 10, 1))], [2])
+        self.assertEqual(view.promotion_ids_for(7), [2])
+        self.assertEqual(self.calls, 2)
+
+    def test_disabled(self):
+        """ Nothing is shared until a path is configured """
+        snapshot = SharedSnapshot(self._loader, PromoType)
+        self.assertFalse(snapshot.enabled)
+        self.assertEqual(snapshot.generation(), 0)
+        snapshot.configure(self.path)
+        self.assertTrue(snapshot.enabled)
+        snapshot.configure(None)
+        self.assertFalse(snapshot.enabled)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
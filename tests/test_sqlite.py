@@ -0,0 +1,82 @@
+"""
+Test cases for the Embedded SQLite Backend
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from service import sqlite
+from service.routing import RoutingSQLAlchemy
+
+
+######################################################################
+#  S Q L I T E   T E S T   C A S E S
+######################################################################
+class TestSqlite(unittest.TestCase):
+    """ Test Cases for the SQLite connection tuning """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            self.directory, "promotions.db"
+        )
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["SQLITE_BUSY_TIMEOUT"] = "1234"
+        self.db = RoutingSQLAlchemy(self.app)
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.get_engine().dispose()
+        shutil.rmtree(self.directory)
+
+    def test_pragmas(self):
+        """ The settings of the app config override the defaults """
+        self.assertEqual(sqlite.pragmas({}), sqlite.DEFAULT_PRAGMAS)
+        settings = sqlite.pragmas({"SQLITE_SYNCHRONOUS": "full", "SQLITE_CACHE_SIZE": "-2000"})
+        self.assertEqual(settings["synchronous"], "FULL")
+        self.assertEqual(settings["cache_size"], -2000)
+        self.assertRaises(ValueError, sqlite.pragmas, {"SQLITE_SYNCHRONOUS": "0; DROP"})
+        self.assertRaises(ValueError, sqlite.pragmas, {"SQLITE_MMAP_SIZE": "big"})
+
+    def test_connections_are_tuned(self):
+        """ Every connection of a SQLite engine is set up when it is opened """
+        with self.app.app_context():
+            engine = self.db.get_engine()
+            self.assertEqual(engine.pool.__class__.__name__, "QueuePool")
+            with engine.connect() as connection:
+                values = {
+                    name: connection.execute("PRAGMA " + name).scalar()
+                    for name in sqlite.DEFAULT_PRAGMAS
+                }
+            self.assertEqual(values["journal_mode"], "wal")
+            self.assertEqual(values["synchronous"], 1)  # NORMAL
+            self.assertEqual(values["busy_timeout"], 1234)
+            self.assertEqual(values["cache_size"], sqlite.DEFAULT_PRAGMAS["cache_size"])
+            self.assertEqual(values["foreign_keys"], 1)
+
+    def test_savepoints(self):
+        """ Rolling back a savepoint keeps the rest of the transaction """
+        with self.app.app_context():
+            engine = self.db.get_engine()
+            engine.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+            with engine.connect() as connection:
+                transaction = connection.begin()
+                connection.execute("INSERT INTO item VALUES (1)")
+                savepoint = connection.begin_nested()
+                connection.execute("INSERT INTO item VALUES (2)")
+                savepoint.rollback()
+                transaction.commit()
+            self.assertEqual(engine.execute("SELECT id FROM item").fetchall(), [(1,)])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()